@@ -0,0 +1,269 @@
+#
+# --- MIT Open Source License --------------------------------------------------
+# PiB - Python Build System
+# Copyright (C) 2011 by Don Williamson
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+# ------------------------------------------------------------------------------
+#
+# Analysis.py: Reports generated from the metadata of previous builds. These run
+# without executing the pibfile so they're quick to iterate on.
+#
+# Usage:
+#
+#    pib -pch_candidates [-config name] [-target name] [-pch_threshold 0.5] [-pch_count 20]
+#    pib -header_report [-config name] [-target name] [-header_report_count 30] [-header_report_csv file]
+#    pib -affected file [file...] [-config name] [-target name]
+#
+
+import os
+import sys
+import csv
+import BuildSystem
+import Utils
+
+
+# Files with these extensions are treated as translation units when scanning metadata
+TranslationUnitExts = set([ ".c", ".cc", ".cpp", ".cxx" ])
+
+
+def GetTargets(metadata):
+
+    # Targets are stored as "Config:Target" so filter by the requested configs and any targets
+    config_names = [ name.lower() for name in Utils.GetSysArgvConfigNames() ]
+    build_targets = Utils.GetSysArgvProperties("-target", None)
+
+    targets = [ ]
+    for target in metadata.FileMetadata.keys():
+        (config, target_name) = target.split(":", 1)
+        if config_names != [ "all" ] and config.lower() not in config_names:
+            continue
+        if len(build_targets) and target_name not in build_targets:
+            continue
+        targets += [ target ]
+
+    return sorted(targets)
+
+
+def GetTranslationUnits(metadata, target):
+
+    # Map each translation unit to its metadata, as recorded on its last compile
+    tus = { }
+    for id, data in metadata.FileMetadata[target].items():
+        filename = metadata.GetFilename(id)
+        if os.path.splitext(filename)[1] in TranslationUnitExts:
+            tus[filename] = data
+
+    return tus
+
+
+def GetTranslationUnitIncludes(metadata, target):
+
+    # Map each translation unit to the list of files it includes
+    includes = { }
+    for filename, data in GetTranslationUnits(metadata, target).items():
+        includes[filename] = [ metadata.GetFilename(dep.Id) for dep in data.ImplicitDeps ]
+
+    return includes
+
+
+class FileSizes:
+
+    def __init__(self):
+
+        self.Sizes = { }
+
+    def __call__(self, filename):
+
+        # Files that no longer exist contribute nothing
+        if filename not in self.Sizes:
+            try:
+                self.Sizes[filename] = os.path.getsize(filename)
+            except OSError:
+                self.Sizes[filename] = 0
+        return self.Sizes[filename]
+
+
+#
+# Ranks headers by the number of bytes the compiler would no longer need to parse if they were
+# precompiled: the number of translation units including them multiplied by their size. Only
+# headers included by at least the threshold fraction of translation units are suggested, as
+# anything in the PCH gets included by every file that uses it.
+#
+def ReportPCHCandidates(metadata):
+
+    threshold = float(Utils.GetSysArgvProperty("-pch_threshold", "0.5"))
+    max_count = int(Utils.GetSysArgvProperty("-pch_count", "20"))
+    file_size = FileSizes()
+
+    for target in GetTargets(metadata):
+
+        tu_includes = GetTranslationUnitIncludes(metadata, target)
+        if len(tu_includes) == 0:
+            continue
+
+        # Count how many translation units include each header
+        counts = { }
+        for includes in tu_includes.values():
+            for include in includes:
+                counts[include] = counts.get(include, 0) + 1
+
+        # Rank by bytes parsed across the whole target
+        nb_tus = len(tu_includes)
+        candidates = [ (count * file_size(header), count, header) for header, count in counts.items() if count / nb_tus >= threshold ]
+        candidates = sorted(candidates, reverse=True)[:max_count]
+
+        print(f"PCH candidates for '{target}' ({nb_tus} translation units):")
+        if len(candidates) == 0:
+            print("   None above threshold")
+            continue
+
+        print("   %12s %8s %10s   %s" % ("Bytes Saved", "TUs", "Size", "Header"))
+        for (score, count, header) in candidates:
+            print("   %12d %8s %10d   %s" % (score, f"{count}/{nb_tus}", file_size(header), header))
+
+        print("")
+        print("   Suggested PCH contents:")
+        for (score, count, header) in candidates:
+            print(f'      #include "{header}"')
+        print("")
+
+
+#
+# For each header, reports how many translation units depend on it, the total number of bytes it
+# contributes across them and the expected cost of rebuilding all of them when it changes.
+#
+# The cost of a translation unit is its last recorded compile duration. Where no duration has been
+# recorded, its size (source plus all included bytes) is used instead, converted to seconds at the
+# average rate of the translation units that were timed. If none were timed, costs are left in bytes.
+#
+def ReportHeaderCosts(metadata):
+
+    max_count = int(Utils.GetSysArgvProperty("-header_report_count", "30"))
+    csv_filename = Utils.GetSysArgvProperty("-header_report_csv", "header_report.csv")
+    file_size = FileSizes()
+    rows = [ ]
+
+    for target in GetTargets(metadata):
+
+        tus = GetTranslationUnits(metadata, target)
+        if len(tus) == 0:
+            continue
+
+        # Approximate the size of each translation unit after preprocessing
+        tu_includes = { }
+        tu_sizes = { }
+        for filename, data in tus.items():
+            tu_includes[filename] = [ metadata.GetFilename(dep.Id) for dep in data.ImplicitDeps ]
+            tu_sizes[filename] = file_size(filename) + sum([ file_size(include) for include in tu_includes[filename] ])
+
+        # Derive a seconds-per-byte rate from any translation units with recorded durations
+        timed = [ filename for filename, data in tus.items() if data.BuildDuration != None ]
+        timed_bytes = sum([ tu_sizes[filename] for filename in timed ])
+        rate = None
+        if timed_bytes > 0:
+            rate = sum([ tus[filename].BuildDuration for filename in timed ]) / timed_bytes
+        units = "s" if rate != None else "bytes"
+
+        tu_costs = { }
+        for filename, data in tus.items():
+            if data.BuildDuration != None:
+                tu_costs[filename] = data.BuildDuration
+            elif rate != None:
+                tu_costs[filename] = tu_sizes[filename] * rate
+            else:
+                tu_costs[filename] = tu_sizes[filename]
+
+        # Accumulate per header
+        headers = { }
+        for filename, includes in tu_includes.items():
+            for include in includes:
+                if include not in headers:
+                    headers[include] = [ 0, 0 ]
+                headers[include][0] += 1
+                headers[include][1] += tu_costs[filename]
+
+        target_rows = [ ]
+        for header, (count, cost) in headers.items():
+            target_rows += [ (target, header, count, count * file_size(header), cost, units) ]
+        target_rows = sorted(target_rows, key=lambda row: row[4], reverse=True)
+        rows += target_rows
+
+        print(f"Header rebuild costs for '{target}' ({len(tus)} translation units, {len(timed)} timed):")
+        print("   %14s %8s %14s   %s" % ("Cost (" + units + ")", "TUs", "Bytes", "Header"))
+        for row in target_rows[:max_count]:
+            print("   %14.2f %8d %14d   %s" % (row[4], row[2], row[3], row[1]))
+        print("")
+
+    # Write everything out for use in other tools
+    with open(csv_filename, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow([ "Target", "Header", "DependentTUs", "IncludedBytes", "RebuildCost", "CostUnits" ])
+        writer.writerows(rows)
+    print("Written " + csv_filename)
+
+
+#
+# Lists the nodes that would rebuild if the given files changed, using the reverse dependency index
+# recorded on the last build of each target. Nodes are listed by their input file.
+#
+def ReportAffected(metadata):
+
+    filenames = Utils.GetSysArgvList("-affected")
+
+    for target in GetTargets(metadata):
+
+        file_metadata = metadata.FileMetadata[target]
+        affected = metadata.GetAffectedFiles(target, filenames)
+        nodes = [ metadata.GetFilename(id) for id in affected if id in file_metadata and file_metadata[id].ExplicitDeps != None ]
+
+        print(f"Affected nodes in '{target}':")
+        for filename in sorted(nodes):
+            print("   " + filename)
+        print("")
+
+
+def Run(pibfile):
+
+    # Is any analysis requested?
+    reports = [ ]
+    if "-pch_candidates" in sys.argv:
+        reports += [ ReportPCHCandidates ]
+    if "-header_report" in sys.argv:
+        reports += [ ReportHeaderCosts ]
+    if "-affected" in sys.argv:
+        reports += [ ReportAffected ]
+    if len(reports) == 0:
+        return False
+
+    # Metadata is stored alongside the pibfile
+    cur_dir = os.getcwd()
+    pibfile_dir = os.path.dirname(pibfile)
+    if pibfile_dir != "":
+        os.chdir(pibfile_dir)
+
+    if not os.path.exists(BuildSystem.BuildMetadata.OutputFilename):
+        print("ERROR: No build metadata found, build the targets first")
+    else:
+        metadata = BuildSystem.BuildMetadata.Load()
+        for report in reports:
+            report(metadata)
+
+    os.chdir(cur_dir)
+    return True
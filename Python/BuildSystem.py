@@ -30,10 +30,206 @@ import os
 import sys
 import gzip
 import pickle
-import binascii
+import struct
+import hashlib
 import Utils
 
 
+#
+# Zero the TimeDateStamp field of a COFF object at the given offset in the data. Handles both regular
+# COFF headers and the anonymous object headers used for /bigobj, /GL and short import objects.
+#
+def NormaliseCOFF(data, offset):
+
+    if len(data) < offset + 12:
+        return
+
+    if data[offset:offset + 4] == b"\x00\x00\xff\xff":
+        data[offset + 8:offset + 12] = b"\x00\x00\x00\x00"
+    else:
+        data[offset + 4:offset + 8] = b"\x00\x00\x00\x00"
+
+
+#
+# Zero the COFF TimeDateStamp and optional header CheckSum of a PE image. Note that the debug directory
+# still identifies the PDB with a unique GUID per link unless the linker is asked for reproducible
+# output with /Brepro.
+#
+def NormalisePE(data):
+
+    if len(data) < 0x40:
+        return
+    pe_offset = struct.unpack_from("<I", data, 0x3C)[0]
+    if data[pe_offset:pe_offset + 4] != b"PE\x00\x00" or len(data) < pe_offset + 92:
+        return
+
+    data[pe_offset + 8:pe_offset + 12] = b"\x00\x00\x00\x00"
+    data[pe_offset + 88:pe_offset + 92] = b"\x00\x00\x00\x00"
+
+
+#
+# Zero the date field of each member in an archive library, along with the timestamps of any COFF
+# objects contained within.
+#
+def NormaliseArchive(data):
+
+    offset = 8
+    while offset + 60 <= len(data):
+        data[offset + 16:offset + 28] = b"0           "
+        try:
+            size = int(data[offset + 48:offset + 58])
+        except ValueError:
+            return
+
+        # The linker members and long names member are not objects
+        name = bytes(data[offset:offset + 16])
+        if not name.startswith(b"/ ") and not name.startswith(b"// "):
+            NormaliseCOFF(data, offset + 60)
+
+        # Members are aligned to 2 bytes
+        offset += 60 + size + (size & 1)
+
+
+#
+# Hash the exported interface of an import library: the name, DLL, type and ordinal or hint of each
+# short import object. The objects holding the import descriptors are derived from the DLL name so
+# they're skipped. Returns None if the archive contains anything else, such as code.
+#
+def HashImportLibrary(data):
+
+    imports = [ ]
+    offset = 8
+    while offset + 60 <= len(data):
+        try:
+            size = int(data[offset + 48:offset + 58])
+        except ValueError:
+            return None
+        member = offset + 60
+        offset = member + size + (size & 1)
+
+        # The linker members and long names member only index the others
+        name = bytes(data[member - 60:member - 44])
+        if name.startswith(b"/ ") or name.startswith(b"// "):
+            continue
+
+        if data[member:member + 4] == b"\x00\x00\xff\xff":
+
+            # Short import header followed by the null-terminated symbol and DLL names, skipping
+            # the version, timestamp and data size
+            if size < 20:
+                return None
+            (machine, ordinal_hint, type) = struct.unpack_from("<2xH8xHH", data, member + 4)
+            names = bytes(data[member + 20:member + size]).split(b"\x00")
+            imports.append((machine, ordinal_hint, type, names[0], names[1] if len(names) > 1 else b""))
+            continue
+
+        # Import descriptor objects only have import data and debug sections
+        if size < 20:
+            return None
+        (nb_sections, opt_header_size) = struct.unpack_from("<H12xH", data, member + 2)
+        sections = member + 20 + opt_header_size
+        for i in range(nb_sections):
+            section_name = bytes(data[sections + i * 40:sections + i * 40 + 8])
+            if not section_name.startswith(b".idata$") and not section_name.startswith(b".debug$"):
+                return None
+
+    if len(imports) == 0:
+        return None
+
+    md5 = hashlib.md5()
+    for entry in sorted(imports):
+        md5.update(repr(entry).encode())
+    return md5.digest()
+
+
+#
+# Generate a hash of the file contents that ignores any timestamps written by the MSVC toolchain,
+# allowing rebuilt outputs that haven't really changed to be detected. Import libraries are hashed
+# by their exported interface, so that changes to a DLL that don't touch its exports don't cause
+# anything linking with it to relink. Returns None if the file can't be read.
+#
+def HashFile(filename):
+
+    try:
+        with open(filename, "rb") as f:
+            data = bytearray(f.read())
+    except OSError:
+        return None
+
+    if data.startswith(b"!<arch>\n"):
+        try:
+            interface_hash = HashImportLibrary(data)
+        except struct.error:
+            interface_hash = None
+        if interface_hash != None:
+            return interface_hash
+        NormaliseArchive(data)
+    elif data.startswith(b"MZ"):
+        NormalisePE(data)
+    elif os.path.splitext(filename)[1].lower() == ".obj":
+        NormaliseCOFF(data, 0)
+
+    return hashlib.md5(data).digest()
+
+
+#
+# Fingerprint of the command-line a node is built with, so that option changes can be detected
+#
+def HashCommandLine(cmdline):
+
+    return hashlib.md5(bytes("\0".join(cmdline), "utf-8")).digest()
+
+
+#
+# The state of files on disk is shared by all targets built in a run so that each file is only
+# stat'd and hashed once, no matter how many targets depend on it. Build steps invalidate the
+# state of the files they write.
+#
+_ModTimes = { }
+_ContentHashes = { }
+
+def GetModTime(filename):
+
+    # Missing files aren't cached as they're expected to be built
+    mod_time = _ModTimes.get(filename)
+    if mod_time == None:
+        try:
+            mod_time = os.path.getmtime(filename)
+        except OSError:
+            return None
+        _ModTimes[filename] = mod_time
+
+    return mod_time
+
+
+def GetContentHash(filename):
+
+    content_hash = _ContentHashes.get(filename)
+    if content_hash == None:
+        content_hash = HashFile(filename)
+        if content_hash == None:
+            return None
+        _ContentHashes[filename] = content_hash
+
+    return content_hash
+
+
+def InvalidateFileState(filename):
+
+    _ModTimes.pop(filename, None)
+    _ContentHashes.pop(filename, None)
+
+
+#
+# Files are identified by a 64-bit hash of their normalised path. Unlike a counter the same path
+# has the same id in every process so saved metadata can be merged, and unlike the crc32 this
+# replaced, collisions aren't a practical concern even with millions of paths.
+#
+def HashPath(path):
+
+    return int.from_bytes(hashlib.blake2b(bytes(path, "utf-8"), digest_size = 8).digest(), "little")
+
+
 #
 # File metadata that persists between builds to aid dependency evaluation and
 # track any changes.
@@ -45,16 +241,27 @@ class FileMetadata:
         self.ModTime = 0
         self.ImplicitDeps = [ ]
         self.ImplicitOutputs = [ ]
+        self.ExplicitDeps = None
+        self.BuildDuration = None
+        self.ContentHash = None
+        self.CommandLineHash = None
         self.CachedModTime = None
+        self.CachedContentHash = None
 
     # Custom state implementations for the pickle module to ignore transient data
     def __getstate__(self):
         state = self.__dict__.copy()
         del state["CachedModTime"]
+        del state["CachedContentHash"]
         return state
     def __setstate__(self, state):
+        self.BuildDuration = None
+        self.ContentHash = None
+        self.CommandLineHash = None
+        self.ExplicitDeps = None
         self.__dict__.update(state)
         self.CachedModTime = None
+        self.CachedContentHash = None
 
     def HasFileChanged(self, filename):
 
@@ -62,9 +269,8 @@ class FileMetadata:
         if self.CachedModTime == None:
 
             # Modtime get will only succeed if the file exists
-            try:
-                self.CachedModTime = os.path.getmtime(filename)
-            except:
+            self.CachedModTime = GetModTime(filename)
+            if self.CachedModTime == None:
                 # If the file no longer exists, it has changed
                 # Note this path will force the cached mod time to NOT update and call getmtime
                 # on each evaluation. This is safe and no slower than the original implementation
@@ -74,17 +280,36 @@ class FileMetadata:
         # Compare modification times
         return self.CachedModTime != self.ModTime
 
+    def HasContentChanged(self, filename):
+
+        # Hashing is much more expensive than getting the mod time so only do it once per build
+        if self.CachedContentHash == None:
+            self.CachedContentHash = GetContentHash(filename)
+            if self.CachedContentHash == None:
+                return True
+
+        return self.CachedContentHash != self.ContentHash
+
+    def SetBuiltContent(self, filename):
+
+        # The file has just been written so any cached state is out of date
+        self.CachedModTime = None
+        self.CachedContentHash = None
+        return self.HasContentChanged(filename)
+
     def UpdateModTime(self, filename):
 
         if self.CachedModTime != None:
             self.ModTime = self.CachedModTime
         else:
             # Only updates if the file exists
-            # Faster than first checking to see if the file exists
-            try:
-                self.ModTime = os.path.getmtime(filename)
-            except:
-                pass
+            mod_time = GetModTime(filename)
+            if mod_time != None:
+                self.ModTime = mod_time
+
+        # Content hashes are committed at the same time as mod times
+        if self.CachedContentHash != None:
+            self.ContentHash = self.CachedContentHash
 
     def SetImplicitDeps(self, env, deps):
 
@@ -116,41 +341,158 @@ class FileMetadata:
 #
 # Metadata that persists between builds
 #
+# The file is a header followed by the gzipped pickle of this class. The header holds a format
+# version and a checksum of the data so that corruption can be told apart from an old version:
+#
+#    "PiBM"                         Magic
+#    uint32                         Format version
+#    sha256                         Checksum of the following data
+#
+# Multiple PiB processes can build different targets in the same directory. Saving is done
+# under a lock file, merging with whatever other processes have saved since this one loaded,
+# and the file is replaced atomically so that it's never seen partially written.
+#
 class BuildMetadata:
 
     OutputFilename = "metadata.pib"
+    FileMagic = b"PiBM"
+    FileFormatVersion = 1
 
     def __init__(self):
 
-        self.Version = 2
+        self.Version = 3
         self.FileMap = { }
         self.FileMetadata = { }
+        self.OutputFiles = set()
+        self.TargetOutputs = { }
+        self.ReverseDeps = { }
         self.UserData = None
+        self.BuiltTargets = set()
+        self.PathIds = { }
+        self.TouchedFiles = { }
 
-    def Save(self):
+    # Custom state implementations for the pickle module to ignore transient data
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["BuiltTargets"]
+        del state["PathIds"]
+        del state["TouchedFiles"]
+        return state
+    def __setstate__(self, state):
+        self.OutputFiles = set()
+        self.TargetOutputs = { }
+        self.ReverseDeps = { }
+        self.__dict__.update(state)
+        self.BuiltTargets = set()
+        self.PathIds = { }
+        self.TouchedFiles = { }
 
-        with gzip.open(BuildMetadata.OutputFilename, "wb") as f:
-            pickle.dump(self, f)
+    def Save(self):
 
-    def Load():
+        with Utils.FileLock(BuildMetadata.OutputFilename + ".lock"):
 
-        try:
-            # Open and load the metadata file if it exists
+            # Keep the targets that other processes have built since this one loaded, replacing unreadable files
+            metadata = self
             if os.path.exists(BuildMetadata.OutputFilename):
-                with gzip.open(BuildMetadata.OutputFilename, "rb") as f:
-                    data = pickle.load(f)
+                try:
+                    (saved_metadata, error) = BuildMetadata.Read(BuildMetadata.OutputFilename)
+                    if saved_metadata != None:
+                        metadata = saved_metadata.Merge(self)
+                except Exception:
+                    pass
+
+            metadata.Write(BuildMetadata.OutputFilename)
+
+    def Merge(self, metadata):
+
+        # Targets built by the other metadata replace these, any others are kept
+        self.FileMap.update(metadata.FileMap)
+        self.OutputFiles |= metadata.OutputFiles
+        for target, file_metadata in metadata.FileMetadata.items():
+            if target in metadata.BuiltTargets or target not in self.FileMetadata:
+                self.FileMetadata[target] = file_metadata
+        for target, outputs in metadata.TargetOutputs.items():
+            if target in metadata.BuiltTargets or target not in self.TargetOutputs:
+                self.TargetOutputs[target] = outputs
+        for target, reverse_deps in metadata.ReverseDeps.items():
+            if target in metadata.BuiltTargets or target not in self.ReverseDeps:
+                self.ReverseDeps[target] = reverse_deps
+        if metadata.UserData != None:
+            self.UserData = metadata.UserData
+
+        return self
+
+    def Write(self, filename):
+
+        data = gzip.compress(pickle.dumps(self))
+        header = BuildMetadata.FileMagic + struct.pack("<I", BuildMetadata.FileFormatVersion) + hashlib.sha256(data).digest()
+
+        # Write to a temporary file that replaces the original once complete
+        temp_filename = filename + "." + str(os.getpid()) + ".tmp"
+        with open(temp_filename, "wb") as f:
+            f.write(header)
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_filename, filename)
+
+    def Read(filename):
+
+        with open(filename, "rb") as f:
+            data = f.read()
+
+        if data.startswith(BuildMetadata.FileMagic):
+            (version,) = struct.unpack_from("<I", data, 4)
+            if version != BuildMetadata.FileFormatVersion:
+                return (None, "version out of date")
+            if hashlib.sha256(data[40:]).digest() != data[8:40]:
+                return (None, "is corrupt")
+            metadata = pickle.loads(gzip.decompress(data[40:]))
+
+        else:
+            # Files written before the header was added are just the gzipped pickle
+            metadata = pickle.loads(gzip.decompress(data))
+
+        if hasattr(metadata, "Version") and metadata.Version == 2:
+            metadata.MigrateFileIds()
+        if not hasattr(metadata, "Version") or metadata.Version != 3:
+            return (None, "version out of date")
+
+        return (metadata, None)
 
-                    # Return if the version matches
-                    if hasattr(data, "Version") and data.Version == 2:
-                        return data
+    def MigrateFileIds(self):
 
-                    print("Metadata file version out of date, discarding...")
+        # Version 2 identified files by the crc32 of their path
+        ids = { crc: HashPath(filename) for crc, filename in self.FileMap.items() }
+        self.FileMap = { ids[crc]: filename for crc, filename in self.FileMap.items() }
+        self.OutputFiles = set([ ids[crc] for crc in self.OutputFiles ])
+
+        for target, file_metadata in self.FileMetadata.items():
+            for data in file_metadata.values():
+                for node in data.ImplicitDeps + data.ImplicitOutputs:
+                    if "CRC" in node.__dict__:
+                        node.Id = ids[node.__dict__.pop("CRC")]
+            self.FileMetadata[target] = { ids[crc]: data for crc, data in file_metadata.items() }
+
+        self.Version = 3
+
+    def Load():
+
+        # Open and load the metadata file if it exists
+        if not os.path.exists(BuildMetadata.OutputFilename):
+            return BuildMetadata()
+
+        try:
+            (metadata, error) = BuildMetadata.Read(BuildMetadata.OutputFilename)
+            if metadata != None:
+                return metadata
 
         # Handle malformed files
-        except:
-            print("Error loading Metadata file, discarding...")
+        except Exception as e:
+            error = "couldn't be loaded (" + str(e) + ")"
 
         # Return empty constructed build metadata if it can't be loaded
+        print("Metadata file " + error + ", discarding...")
         return BuildMetadata()
 
     def AddToFileMap(self, filename):
@@ -159,20 +501,36 @@ class BuildMetadata:
         if filename == None:
             return
 
-        # Generate the CRC
-        filename = Utils.NormalisePath(filename)
-        crc = binascii.crc32(bytes(filename, "utf-8"))
+        # Paths are interned as they're seen so that each is only normalised and hashed once
+        id = self.PathIds.get(filename)
+        if id == None:
+            path = Utils.NormalisePath(filename)
+            id = HashPath(path)
+            self.FileMap[id] = path
+            self.PathIds[filename] = id
 
-        # Check for collision
-        if crc in self.FileMap and filename != self.FileMap[crc]:
-            raise Exception("CRC collision with " + filename + " and " + self.FileMap[crc])
+        return id
 
-        self.FileMap[crc] = filename
-        return crc
+    def GetFilename(self, id):
 
-    def GetFilename(self, crc):
+        return self.FileMap[id]
 
-        return self.FileMap[crc]
+    def AddOutputFile(self, filename):
+
+        # Keep track of all files generated by build steps so that their contents can be compared
+        self.OutputFiles.add(self.AddToFileMap(filename))
+
+    def IsOutputFile(self, filename):
+
+        return self.AddToFileMap(filename) in self.OutputFiles
+
+    def AddTargetOutputs(self, target, filenames):
+
+        # Every file a target has produced, so that clean can remove them without evaluating the graph
+        outputs = self.TargetOutputs.get(target)
+        if outputs == None:
+            outputs = self.TargetOutputs[target] = set()
+        outputs.update(self.AddToFileMap(filename) for filename in filenames)
 
     def GetFileMetadata(self, target, filename):
 
@@ -186,22 +544,66 @@ class BuildMetadata:
             self.FileMetadata[target] = { }
         file_metadata = self.FileMetadata[target]
 
+        # Record which entries the build has looked at so that only those need updating after it
+        id = self.AddToFileMap(filename)
+        touched_files = self.TouchedFiles.get(target)
+        if touched_files == None:
+            touched_files = self.TouchedFiles[target] = set()
+        touched_files.add(id)
+
         # Return an existing metadata?
-        crc = self.AddToFileMap(filename)
-        if crc in file_metadata:
-            return file_metadata[crc]
+        if id in file_metadata:
+            return file_metadata[id]
 
         # Otherwise create a new one
         data = FileMetadata()
-        file_metadata[crc] = data
+        file_metadata[id] = data
         return data
 
     def UpdateModTimes(self, target):
 
-        # It's safe to update the mod times for any files which were different since the last build
-        file_metadata = self.FileMetadata[target]
-        for crc, metadata in file_metadata.items():
-            metadata.UpdateModTime(self.GetFilename(crc))
+        # It's safe to update the mod times for any files which were different since the last build.
+        # Files the build didn't evaluate keep their old mod times so any changes are seen next build.
+        self.BuiltTargets.add(target)
+        file_metadata = self.FileMetadata.get(target, { })
+        for id in self.TouchedFiles.pop(target, ()):
+            file_metadata[id].UpdateModTime(self.GetFilename(id))
+
+        self.UpdateReverseDeps(target)
+
+    def UpdateReverseDeps(self, target):
+
+        #
+        # Nodes are identified by their input file. This maps each file to the nodes that depend on it,
+        # implicitly or through an explicit dependency on the node with that input. It's rebuilt from
+        # the forward edges after each build so that edges removed by the build are dropped.
+        #
+        reverse_deps = { }
+        for id, data in self.FileMetadata.get(target, { }).items():
+            for dep_id in [ dep.Id for dep in data.ImplicitDeps ] + (data.ExplicitDeps or [ ]):
+                dependents = reverse_deps.get(dep_id)
+                if dependents == None:
+                    dependents = reverse_deps[dep_id] = set()
+                dependents.add(id)
+        self.ReverseDeps[target] = reverse_deps
+
+    def GetAffectedFiles(self, target, filenames):
+
+        # Everything that transitively depends on the files, including the files themselves
+        reverse_deps = self.ReverseDeps.get(target, { })
+        pending = set()
+        for filename in filenames:
+            for path in [ filename, os.path.relpath(filename), os.path.abspath(filename) ]:
+                pending.add(HashPath(Utils.NormalisePath(path)))
+
+        affected = set()
+        while len(pending):
+            id = pending.pop()
+            if id not in affected:
+                affected.add(id)
+                pending |= reverse_deps.get(id, set())
+
+        return affected
 
 
 #
@@ -221,27 +623,45 @@ class Node:
     def GetTempOutputFiles(self, env):
         return self.GetOutputFiles(env)
 
+    # The command-line used to build the node, if any, which triggers a build when it changes
+    def GetCommandLine(self, env):
+        return None
+
+    # Outputs whose contents are compared after a build to decide whether dependents need building
+    def GetContentHashFiles(self, env):
+        return self.GetOutputFiles(env)[:1]
+
+    # Every file the build step can write, for cleaning
+    def GetCleanFiles(self, env):
+        return self.GetOutputFiles(env) + self.GetTempOutputFiles(env)
+
+    # Nodes that are slow to build but needed by few others, like package downloads, can build in the
+    # background with only their dependents waiting for them
+    def RunsInBackground(self, env):
+        return False
+
 
 #
 # A file node is simply an ecapsulation around a file on disk with no build step
 #
 class FileNode (Node):
 
-    def __init__(self, crc):
+    def __init__(self, id):
 
         super().__init__()
-        self.CRC = crc
+        self.Id = id
 
     def GetInputFile(self, env):
-        return env.GetFilename(self.CRC)
+        return env.GetFilename(self.Id)
 
     def GetOutputFiles(self, env):
-        return [ env.GetFilename(self.CRC) ]
+        return [ env.GetFilename(self.Id) ]
 
 
 #
 # Used to depend on output files from build steps
-# Bound to the environment that generates the output file
+# Bound to the environment that generates the output file, or the view of it for the
+# config being built
 #
 class OutputFileNode (Node):
 
@@ -252,13 +672,17 @@ class OutputFileNode (Node):
         self.GetInputFileFunc = node.GetInputFile
         self.GetOutputFilesFunc = node.GetOutputFiles
 
+    def GetEnv(self, env):
+
+        return env if env.ConfigViewOf is self.Env else self.Env
+
     def GetInputFile(self, env):
 
-        return self.GetInputFileFunc(self.Env)
+        return self.GetInputFileFunc(self.GetEnv(env))
 
     def GetOutputFiles(self, env):
 
-        return self.GetOutputFilesFunc(self.Env)
+        return self.GetOutputFilesFunc(self.GetEnv(env))
 
 
 #
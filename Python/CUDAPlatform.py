@@ -159,6 +159,19 @@ class BuildPTXNode (BuildSystem.Node):
 
     def Build(self, env):
 
+        cmdline = self.GetCommandLine(env)
+        Utils.ShowCmdLine(env, cmdline)
+
+        # Launch the compiler and wait for it to finish
+        process = Process.OpenPiped(cmdline)
+        output = Process.WaitForPipeOutput(process)
+        if not env.NoToolOutput:
+            print(output)
+
+        return process.returncode == 0
+
+    def GetCommandLine(self, env):
+
         # Build command-line from current configuration
         cmdline = [ os.path.join(BinDir, "nvcc.exe") ]
         cmdline += [ '--ptx' ]
@@ -170,15 +183,7 @@ class BuildPTXNode (BuildSystem.Node):
 
         # Add input file before finishing
         cmdline += [ self.GetInputFile(env) ]
-        Utils.ShowCmdLine(env, cmdline)
-
-        # Launch the compiler and wait for it to finish
-        process = Process.OpenPiped(cmdline)
-        output = Process.WaitForPipeOutput(process)
-        if not env.NoToolOutput:
-            print(output)
-
-        return process.returncode == 0
+        return cmdline
 
     def GetInputFile(self, env):
 
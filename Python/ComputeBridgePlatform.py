@@ -16,40 +16,26 @@ def SetInstallPath(path):
     _InstallPath = path
 
 
-class Options:
+class Options (Utils.CommandLineOptions):
 
-    #
-    # TODO: Uses new dirty options checking mechanism.
-    #
     def __init__(self):
 
+        super().__init__()
+
         # List of include search paths and macros
         self.IncludePaths = [ ]
         self.DefineMacros = [ ]
 
-        self.Dirty = True
-        self.CommandLine = [ ]
-
-    def __setattr__(self, name, value):
+    def BuildCommandLine(self):
 
-        # Assign the field and mark the command-line as dirty
-        self.__dict__[name] = value
-        self.__dict__["Dirty"] = True
+        cmdline = [ ]
 
-    def UpdateCommandLine(self):
+        for path in self.IncludePaths:
+            cmdline += [ '-i', os.path.normpath(path) ]
 
-        if self.Dirty:
+        self.FormatDefines(cmdline)
 
-            cmdline = [ ]
-
-            for path in self.IncludePaths:
-                cmdline += [ '-i', os.path.normpath(path) ]
-
-            self.FormatDefines(cmdline)
-
-            # Update and mark as not dirty without calling into __setattr__
-            self.__dict__["CommandLine"] = cmdline
-            self.__dict__["Dirty"] = False
+        return cmdline
 
     def FormatDefines(self, cmdline):
 
@@ -78,6 +64,23 @@ class BuildNode (BuildSystem.Node):
 
     def Build(self, env):
 
+        cmdline = self.GetCommandLine(env)
+        Utils.ShowCmdLine(env, cmdline)
+
+        # Launch cbpp with a dependency scanner and wait for it to finish
+        scanner = Utils.LineScanner(env)
+        scanner.AddLineParser("Includes", 'cpp: included "', None, lambda line, length: line[length:-1])
+        process = Process.OpenPiped(cmdline, env.EnvironmentVariables)
+        Process.WaitForPipeOutput(process, scanner)
+
+        # Record the implicit dependencies for this file
+        data = env.GetFileMetadata(self.GetInputFile(env))
+        data.SetImplicitDeps(env, scanner.Includes)
+
+        return process.returncode == 0
+
+    def GetCommandLine(self, env):
+
         # Ensure command -line for current configuration is up-to-date
         options = self.OptionsMap[env.CurrentConfig.CmdLineArg]
         options.UpdateCommandLine()
@@ -94,19 +97,7 @@ class BuildNode (BuildSystem.Node):
         if len(output_files) > 1:
             cmdline += [ "-output_bin", output_files[1] ]
         cmdline += [ "-target", self.Target ]
-        Utils.ShowCmdLine(env, cmdline)
-
-        # Launch cbpp with a dependency scanner and wait for it to finish
-        scanner = Utils.LineScanner(env)
-        scanner.AddLineParser("Includes", 'cpp: included "', None, lambda line, length: line[length:-1])
-        process = Process.OpenPiped(cmdline, env.EnvironmentVariables)
-        Process.WaitForPipeOutput(process, scanner)
-
-        # Record the implicit dependencies for this file
-        data = env.GetFileMetadata(self.GetInputFile(env))
-        data.SetImplicitDeps(env, scanner.Includes)
-
-        return process.returncode == 0
+        return cmdline
 
     def GetInputFile(self, env):
 
@@ -1,5 +1,7 @@
 
+import os
 import Utils
+import BuildSystem
 
 
 #
@@ -11,7 +13,7 @@ CppLinkWeakDep = True
 
 class CppBuild:
     
-    def __init__(self, env, dirs, target, ext_libs = [], build = True):
+    def __init__(self, env, dirs, target, ext_libs = [], build = True, pch = None, deps = []):
 
         # Gather source/header files
         self.cpp_files = []
@@ -26,22 +28,42 @@ class CppBuild:
                 self.cpp_files += Utils.Glob(dir, "*.c")
                 self.hpp_files += Utils.Glob(dir, "*.h")
 
+        # Optional precompiled header for this target, specified as a (source, header) tuple
+        self.pch = None
+        if pch != None:
+            self.pch = env.PCHFile(pch[0], pch[1])
+
         # Create nodes for compiling the C+ files
-        self.obj_files = [ env.CPPFile(file) for file in self.cpp_files ]
+        # The PCH node compiles its own source file and provides the .obj to link with
+        self.obj_files = [ ]
+        for file in self.cpp_files:
+            if self.pch != None and os.path.normcase(os.path.normpath(file)) == os.path.normcase(os.path.normpath(self.pch.Path)):
+                continue
+            self.obj_files += [ env.CPPFile(file, None, self.pch) ]
+        if self.pch != None:
+            self.obj_files += [ self.pch ]
+
+        # Nodes that must be built before compiling, such as packages providing headers
+        for obj_file in self.obj_files:
+            obj_file.Dependencies += deps
 
         # Create file nodes for the input libraries
         # Split into two lists: strong/weak dependencies (see CppLinkWeakDep)
-        self.lib_files = [ env.NewFile(file) for file in ext_libs if type(file) != tuple ]
+        self.lib_files = [ env.NewFile(file) for file in ext_libs if type(file) == str ]
         self.weak_lib_files = [ env.NewFile(file[0]) for file in ext_libs if type(file) == tuple ]
 
+        # Libraries that are built by other nodes, such as packages, are explicit dependencies
+        # so that the output waits for them
+        input_files = self.obj_files + [ file for file in ext_libs if isinstance(file, BuildSystem.Node) ]
+
         # Link or use librarian dependent on output path
         self.output = None
         if target.endswith(".exe"):
-            self.output = self.exe = env.Link(target, self.obj_files, self.lib_files, self.weak_lib_files)
+            self.output = self.exe = env.Link(target, input_files, self.lib_files, self.weak_lib_files)
         elif target.endswith(".dll"):
-            self.output = self.dll = env.Link(target, self.obj_files, self.lib_files, self.weak_lib_files)
+            self.output = self.dll = env.Link(target, input_files, self.lib_files, self.weak_lib_files)
         elif target.endswith(".lib"):
-            self.output = self.lib = env.Lib(target, self.obj_files, self.lib_files)
+            self.output = self.lib = env.Lib(target, input_files, self.lib_files)
 
         # Build all the config command lines
         for config in env.Configs.values():
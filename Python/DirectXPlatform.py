@@ -87,10 +87,11 @@ else:
 #       vs_1_1 vs_2_0 vs_2_a vs_2_sw vs_3_0 vs_3_sw vs_4_0 vs_4_0_level_9_1
 #       vs_4_0_level_9_3 vs_4_0_level_9_0 vs_4_1 vs_5_0
 #
-class FXCompileOptions:
+class FXCompileOptions (Utils.CommandLineOptions):
     
     def __init__(self):
 
+        super().__init__()
         self.EntryPoint = None
         self.IncludePaths = [ ]
 
@@ -119,7 +120,7 @@ class FXCompileOptions:
         self.Defines = [ ]
         self.NoLogo = True
 
-    def UpdateCommandLine(self):
+    def BuildCommandLine(self):
 
         # Start with showing includes for dependency evaluation
         cmdline = [
@@ -156,7 +157,7 @@ class FXCompileOptions:
         if self.NoLogo:
             cmdline += [ '/nologo' ]
 
-        self.CommandLine = cmdline
+        return cmdline
 
     def FormatDefines(defines):
 
@@ -182,21 +183,7 @@ class FXCompileNode (BuildSystem.Node):
 
     def Build(self, env):
 
-        output_files = self.GetOutputFiles(env)
-
-        # Node entry point takes precendence over config specified entry-point
-        entry_point = self.EntryPoint
-        if entry_point == None:
-            entry_point = env.CurrentConfig.FXCompileOptions.EntryPoint
-
-        # Build command line
-        cmdline = [ os.path.join(x86BinDir, "fxc.exe") ]
-        cmdline += [ self.Path, '/T' + self.Profile ]
-        cmdline += env.CurrentConfig.FXCompileOptions.CommandLine
-        cmdline += self.DefineCmdLine
-        cmdline += self.BuildCommandLine
-        if entry_point:
-            cmdline += [ '/E' + entry_point ]
+        cmdline = self.GetCommandLine(env)
         Utils.ShowCmdLine(env, cmdline)
 
         # Create the include scanner and launch the compiler
@@ -211,6 +198,28 @@ class FXCompileNode (BuildSystem.Node):
 
         return process.returncode == 0
     
+    def GetCommandLine(self, env):
+
+        # Generates the output file command-line
+        self.GetOutputFiles(env)
+
+        # Node entry point takes precendence over config specified entry-point
+        options = env.CurrentConfig.FXCompileOptions
+        entry_point = self.EntryPoint
+        if entry_point == None:
+            entry_point = options.EntryPoint
+
+        # Build command line
+        options.UpdateCommandLine()
+        cmdline = [ os.path.join(x86BinDir, "fxc.exe") ]
+        cmdline += [ self.Path, '/T' + self.Profile ]
+        cmdline += options.CommandLine
+        cmdline += self.DefineCmdLine
+        cmdline += self.BuildCommandLine
+        if entry_point:
+            cmdline += [ '/E' + entry_point ]
+        return cmdline
+
     def GetInputFile(self, env):
 
         return self.Path
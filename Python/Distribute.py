@@ -0,0 +1,318 @@
+
+#
+# --- MIT Open Source License --------------------------------------------------
+# PiB - Python Build System
+# Copyright (C) 2011 by Don Williamson
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+# ------------------------------------------------------------------------------
+#
+# Distribute.py: Distributed compilation of C/C++ files across worker hosts.
+#
+# Building with "-distribute host[:port][,host[:port]...]" preprocesses each dirty file locally,
+# recording its dependencies as usual, and sends the preprocessed source to a worker to compile.
+# The object file and compiler output are sent back. Workers that are busy are skipped and those
+# that can't be reached aren't tried again; once all have been tried the file is compiled locally.
+# Compiles run in the background, with "-local_jobs N" limiting how many run on this machine.
+#
+# Workers are run on each host with:
+#
+#    python Distribute.py [-bind address] [-port port] [-jobs N]
+#
+# They bind to localhost unless told otherwise. A worker runs the compiler named by the client,
+# found on the worker's PATH, with the client's arguments so only expose workers on a trusted network.
+#
+# Protocol:
+#
+#    POST /compile      JSON { "args": [ compiler, options... ], "ext": ".i" }, a newline, then the preprocessed source
+#    200                X-PiB-Return-Code header, 4-byte little-endian output length, compiler output, object file
+#    503                The worker has no free compile slots
+#
+
+import os
+import re
+import sys
+import json
+import struct
+import tempfile
+import threading
+import http.client
+import http.server
+import concurrent.futures
+import Utils
+import Process
+
+
+DefaultPort = 8642
+DefaultHostJobs = 8
+RequestTimeout = 300
+
+# Compilers a worker will run, grouped by how they name their output
+_MSVCCompilers = { "cl", "cl.exe", "clang-cl", "clang-cl.exe" }
+_GCCCompilers = { "gcc", "g++", "cc", "c++", "clang", "clang++" }
+
+# Arguments that would have a compiler read or write files outside of the job, or load code
+_RejectedArgPrefixes = ( "/Fo", "/Fe", "/Fp", "/Fd", "/FI", "/Yc", "/Yu", "/B", "@", "-o", "-B", "-MF", "-include",
+                         "-specs", "-wrapper", "-fplugin", "-fpass-plugin", "-load" )
+
+_PreprocessedExts = { ".i", ".ii" }
+
+
+def GetCompilerStyle(args):
+
+    # Versioned drivers like "clang++-15" behave the same as the unversioned ones
+    name = os.path.basename(args[0]).lower()
+    name = re.sub(r"-[0-9.]+$", "", name)
+    if name in _MSVCCompilers:
+        return "msvc"
+    if name in _GCCCompilers:
+        return "gcc"
+    return None
+
+
+def CompilePreprocessed(args, source_file, obj_file, envvars = None):
+
+    # Add the output and input in the style of the compiler
+    if GetCompilerStyle(args) == "msvc":
+        args = args + [ "/Fo" + obj_file, source_file ]
+    else:
+        args = args + [ "-o", obj_file, source_file ]
+
+    process = Process.OpenPiped(args, envvars)
+    output = process.stdout.read()
+    process.wait()
+
+    # cl.exe always reports the name of the file it's compiling, which has already been shown
+    lines = output.split(b"\n", 1)
+    if lines[0].strip() == bytes(os.path.basename(source_file), "utf-8"):
+        output = lines[1] if len(lines) > 1 else b""
+
+    return (process.returncode, output)
+
+
+#
+# Compile requests are refused when all slots are busy rather than queued, so that the
+# client can try another worker or compile the file itself.
+#
+class WorkerRequestHandler (http.server.BaseHTTPRequestHandler):
+
+    def do_POST(self):
+
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length)
+
+        if self.path != "/compile":
+            self.send_error(404)
+            return
+
+        if not self.server.Slots.acquire(blocking = False):
+            self.send_error(503)
+            return
+
+        # The slot must be released however the compile fails
+        try:
+            (returncode, output, obj_data) = self.Compile(body)
+        except (ValueError, KeyError) as e:
+            self.send_error(400, str(e))
+            return
+        except OSError as e:
+            self.send_error(500, str(e))
+            return
+        finally:
+            self.server.Slots.release()
+
+        response = struct.pack("<I", len(output)) + output + obj_data
+        self.send_response(200)
+        self.send_header("X-PiB-Return-Code", str(returncode))
+        self.send_header("Content-Length", str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def Compile(self, body):
+
+        # Validate the request before running anything
+        (header, source) = body.split(b"\n", 1)
+        request = json.loads(header)
+        args = request["args"]
+        ext = request["ext"]
+        if type(args) != list or len(args) == 0 or any(type(arg) != str for arg in args):
+            raise ValueError("Invalid arguments")
+
+        # The compiler is found on the worker's own PATH, never at a location chosen by the client
+        if "/" in args[0] or "\\" in args[0]:
+            raise ValueError("Compiler must not be a path")
+        if GetCompilerStyle(args) == None or ext not in _PreprocessedExts:
+            raise ValueError("Unsupported compiler or source")
+        if any(arg.startswith(_RejectedArgPrefixes) for arg in args[1:]):
+            raise ValueError("Unsupported argument")
+
+        with tempfile.TemporaryDirectory(prefix = "pib_") as dir:
+
+            source_file = os.path.join(dir, "source" + ext)
+            obj_file = os.path.join(dir, "source.obj")
+            with open(source_file, "wb") as f:
+                f.write(source)
+
+            (returncode, output) = CompilePreprocessed(args, source_file, obj_file)
+
+            obj_data = b""
+            if returncode == 0 and os.path.exists(obj_file):
+                with open(obj_file, "rb") as f:
+                    obj_data = f.read()
+
+        return (returncode, output, obj_data)
+
+    def log_message(self, format, *args):
+
+        if "-verbose" in sys.argv:
+            super().log_message(format, *args)
+
+
+#
+# A worker that was reached but couldn't run the compile. Other workers would fail the same way
+# so the file is compiled locally, without giving up on the worker.
+#
+class RequestError (Exception):
+    pass
+
+
+def RunWorker():
+
+    bind = Utils.GetSysArgvProperty("-bind", "127.0.0.1")
+    port = int(Utils.GetSysArgvProperty("-port", DefaultPort))
+    jobs = int(Utils.GetSysArgvProperty("-jobs", os.cpu_count()))
+
+    server = http.server.ThreadingHTTPServer((bind, port), WorkerRequestHandler)
+    server.Slots = threading.BoundedSemaphore(jobs)
+    print("PiB worker listening on " + bind + ":" + str(port) + " with " + str(jobs) + " jobs")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+#
+# Client side of distribution, owned by the environment. Compile nodes that can be distributed
+# provide:
+#
+#    GetPreprocessedFile(env)       Where to write the preprocessed source
+#    Preprocess(env, filename)      Preprocess locally, recording implicit dependencies
+#    GetRemoteCommandLine(env)      Compiler and options for the preprocessed source
+#
+class Distributor:
+
+    def __init__(self, hosts, local_jobs):
+
+        self.Hosts = [ ]
+        for host in hosts:
+            (name, sep, port) = host.partition(":")
+            self.Hosts += [ (name, int(port) if port != "" else DefaultPort) ]
+
+        self.LocalSlots = threading.Semaphore(local_jobs)
+        self.Executor = concurrent.futures.ThreadPoolExecutor(local_jobs + DefaultHostJobs * len(self.Hosts))
+        self.Lock = threading.Lock()
+        self.Unreachable = set()
+        self.NextHost = 0
+
+    def Submit(self, fn, *args):
+
+        return self.Executor.submit(fn, *args)
+
+    def GetHosts(self):
+
+        # Rotate through the reachable hosts so that jobs are spread evenly
+        with self.Lock:
+            hosts = [ host for host in self.Hosts if host not in self.Unreachable ]
+            self.NextHost += 1
+            if len(hosts):
+                index = self.NextHost % len(hosts)
+                hosts = hosts[index:] + hosts[:index]
+
+        return hosts
+
+    def CompileRemote(self, host, args, ext, source):
+
+        connection = http.client.HTTPConnection(host[0], host[1], timeout = RequestTimeout)
+        try:
+            body = bytes(json.dumps({ "args": args, "ext": ext }), "utf-8") + b"\n" + source
+            connection.request("POST", "/compile", body)
+            response = connection.getresponse()
+            data = response.read()
+        finally:
+            connection.close()
+
+        # Busy workers return nothing
+        if response.status == 503:
+            return None
+        if response.status != 200:
+            raise RequestError("Worker returned " + str(response.status) + " " + response.reason)
+
+        returncode = int(response.getheader("X-PiB-Return-Code"))
+        (length,) = struct.unpack_from("<I", data)
+        return (returncode, data[4:4 + length], data[4 + length:])
+
+    def Compile(self, env, node):
+
+        # Preprocessing is local work so it shares the local job slots
+        preprocessed_file = node.GetPreprocessedFile(env)
+        with self.LocalSlots:
+            if not node.Preprocess(env, preprocessed_file):
+                return False
+
+        with open(preprocessed_file, "rb") as f:
+            source = f.read()
+        args = node.GetRemoteCommandLine(env)
+        ext = os.path.splitext(preprocessed_file)[1]
+        obj_file = node.GetOutputFiles(env)[0]
+
+        result = None
+        for host in self.GetHosts():
+            try:
+                result = self.CompileRemote(host, args, ext, source)
+            except RequestError as e:
+                Utils.Print(env, "WARNING: Worker " + host[0] + ":" + str(host[1]) + " couldn't compile (" + str(e) + "), compiling locally")
+                break
+            except (OSError, http.client.HTTPException, ValueError, struct.error) as e:
+                with self.Lock:
+                    self.Unreachable.add(host)
+                Utils.Print(env, "WARNING: Worker " + host[0] + ":" + str(host[1]) + " unavailable (" + str(e) + ")")
+                continue
+            if result != None:
+                break
+
+        if result != None:
+            (returncode, output, obj_data) = result
+            if returncode == 0:
+                with open(obj_file, "wb") as f:
+                    f.write(obj_data)
+
+        else:
+            # All workers are busy or unreachable
+            with self.LocalSlots:
+                (returncode, output) = CompilePreprocessed(args, preprocessed_file, obj_file, env.EnvironmentVariables)
+
+        Utils.RemoveFile(preprocessed_file)
+        if not env.NoToolOutput:
+            Utils.Print(env, output.decode(errors = "replace").rstrip())
+
+        return returncode == 0
+
+
+if __name__ == "__main__":
+    RunWorker()
@@ -29,28 +29,76 @@
 
 import os
 import sys
+import copy
+import json
+import time
+import shutil
+import threading
 import fnmatch
+import concurrent.futures
 import Utils
 import BuildSystem
+import Distribute
 import MSVCPlatform
+import GCCPlatform
 import WindowsPlatform
 
 
+# Number of files each thread deletes at a time during clean
+CleanBatchSize = 64
+
+
+#
+# Building with -explain records the first reason each node rebuilt as JSON lines in the file given
+# by -explain_file. Each record has the path that triggered the rebuild and the root cause, found by
+# following changed dependencies down to the file that started it. After each target the root causes
+# responsible for the most rebuilds are listed.
+#
+class ExplainLog:
+
+    def __init__(self, filename):
+
+        self.File = open(filename, "w")
+        self.Lock = threading.Lock()
+        self.RootCounts = { }
+
+    def Record(self, target, node_path, cause):
+
+        (reason, path, root_reason, root) = cause
+        record = { "target": target, "node": node_path, "reason": reason, "path": path, "root_reason": root_reason, "root": root }
+        with self.Lock:
+            self.File.write(json.dumps(record) + "\n")
+            counts = self.RootCounts.setdefault(target, { })
+            counts[(root_reason, root)] = counts.get((root_reason, root), 0) + 1
+
+    def PrintSummary(self, target, count = 10):
+
+        with self.Lock:
+            self.File.flush()
+            counts = self.RootCounts.pop(target, { })
+        if len(counts) == 0:
+            return
+
+        print("Rebuild root causes:")
+        for (root_reason, root), nb_nodes in sorted(counts.items(), key = lambda item: item[1], reverse = True)[:count]:
+            print("   %8d   %-24s %s" % (nb_nodes, root_reason, root))
+
+
 #
 # This may or may not work out in the future but it's a nice convenience that ties building configurations
 # with generating project files for the configurations.
 #
 class Config:
 
-    def __init__(self, name, arg, base_config_options):
+    def __init__(self, name, arg, base_config_options, toolchain = MSVCPlatform):
 
         self.Name = name
         self.CmdLineArg = arg
         self.IntermediatePath = "obj/" + name
         self.OutputPath = "bin/" + name
-        self.CPPOptions = MSVCPlatform.VCCompileOptions(base_config_options)
-        self.LinkOptions = MSVCPlatform.VCLinkOptions(base_config_options)
-        self.LibOptions = MSVCPlatform.VCLibOptions(base_config_options)
+        self.CPPOptions = toolchain.CompileOptions(base_config_options)
+        self.LinkOptions = toolchain.LinkOptions(base_config_options)
+        self.LibOptions = toolchain.LibOptions(base_config_options)
 
     def SetPaths(self, path):
 
@@ -71,7 +119,7 @@ class Config:
 
 
 #
-# The build environment - currently only Visual Studio 2005 is supported.
+# The build environment - drives either Visual Studio (MSVCPlatform) or GCC/Clang (GCCPlatform).
 # Contains the main dependency graph evaluation and a host of other things which
 # couldn't be put elsewhere.
 #
@@ -79,57 +127,108 @@ class Environment:
 
     def New():
 
-        # Load the metadata first as that encodes as much of the cached environment state as possible
+        # Use Visual Studio where it's installed, unless the user asks otherwise
+        toolchain = Utils.GetSysArgvProperty("-toolchain")
+        if toolchain == None:
+            toolchain = "msvc" if MSVCPlatform.VSToolsDir != None or MSVCPlatform.VCCrossCompile else "gcc"
+
+        # Fetching the MSVC envvars is an expensive operation so start it while the metadata loads
+        wait_for_envvars = None
+        if toolchain == "msvc" and not MSVCPlatform.VCCrossCompile and MSVCPlatform.VSToolsDir != None:
+            wait_for_envvars = MSVCPlatform.GetCachedVisualCEnvAsync()
+
         metadata = BuildSystem.BuildMetadata.Load()
 
-        # Check to see if the MSVC envvars are in the metadata before figuring them out,
-        # as that's quite an expensive operation
-        if metadata.UserData == None:
-            envvars = MSVCPlatform.GetVisualCEnv()
-            if envvars == None:
+        if toolchain != "msvc":
+
+            # GCC/Clang run in the current environment
+            if GCCPlatform.CXX == None:
+                print("ERROR: Failed to find installed GCC or Clang")
                 return None
-            metadata.UserData = envvars
+            return Environment(None, metadata, GCCPlatform)
+
+        # Cross-compiling with the LLVM tools is configured entirely on the command-line
+        if MSVCPlatform.VCCrossCompile:
+            return Environment(None, metadata, MSVCPlatform)
+
+        if MSVCPlatform.VSToolsDir == None:
+            print("ERROR: Failed to find installed Visual Studio")
+            return None
 
-        return Environment(metadata.UserData, metadata)
+        envvars = wait_for_envvars()
+        if envvars == None:
+            return None
 
-    def __init__(self, envvars, metadata):
+        return Environment(envvars, metadata, MSVCPlatform)
+
+    def __init__(self, envvars, metadata, toolchain = MSVCPlatform):
 
         # Construc the environment variables
         self.EnvironmentVariables = envvars
+        self.Toolchain = toolchain
 
         # Force node builds irrespective of dependencies?
         self.ForceBuild = "-force" in sys.argv
         self.NoToolOutput = "-no_tool_output" in sys.argv
         self.ShowCmdLine = "-show_cmdline" in sys.argv
-        self.ConfigName = Utils.GetSysArgvProperty("-config", "debug")
         self.Verbose = "-verbose" in sys.argv
 
+        # Record why nodes rebuild?
+        self.Explain = None
+        self.RebuildCauses = { }
+        if "-explain" in sys.argv:
+            self.Explain = ExplainLog(Utils.GetSysArgvProperty("-explain_file", "pib_explain.jsonl"))
+
+        # Runs nodes that build in the background when not distributing
+        self.BackgroundExecutor = concurrent.futures.ThreadPoolExecutor(4)
+
+        # Distribute compiles to worker hosts?
+        self.Distributor = None
+        hosts = Utils.GetSysArgvProperty("-distribute", None)
+        if hosts != None:
+            local_jobs = int(Utils.GetSysArgvProperty("-local_jobs", os.cpu_count()))
+            self.Distributor = Distribute.Distributor(hosts.split(","), local_jobs)
+
         # Show environment variables
-        if "-show_env" in sys.argv:
-            for k,v in metadata.UserData.items():
+        if "-show_env" in sys.argv and envvars != None:
+            for k,v in envvars.items():
                 print(k, "=", v)
 
         # Parse any build filters in the command-line
         self.BuildTargets = Utils.GetSysArgvProperties("-target", None)
         self.BuildInputFilter = Utils.GetSysArgvProperty("-input_filter", None)
+        self.BuildAffectedFiles = Utils.GetSysArgvList("-build_affected")
+        self.AffectedFiles = None
         if self.BuildInputFilter != None:
             self.BuildInputFilter = self.BuildInputFilter.lower()
 
         # Set up some default configurations
         self.Configs = { }
-        self.Configs["debug"] = Config("Debug", "debug", MSVCPlatform.VCBaseConfig.DEBUG)
-        self.Configs["release"] = Config("Release", "release", MSVCPlatform.VCBaseConfig.RELEASE)
+        self.Configs["debug"] = Config("Debug", "debug", toolchain.BaseConfig.DEBUG, toolchain)
+        self.Configs["release"] = Config("Release", "release", toolchain.BaseConfig.RELEASE, toolchain)
+
+        # Several configs can be built at once with "-config debug,release" or "-config all",
+        # with the first used as the current config
+        self.BuildConfigNames = Utils.GetSysArgvConfigNames()
+        self.ConfigName = "debug" if self.BuildConfigNames == [ "all" ] else self.BuildConfigNames[0]
         self.CurrentConfig = self.Configs[self.ConfigName]
+        self.ConfigViews = { }
+        self.ConfigViewOf = None
 
         # Load existing file metadata from disk
         self.BuildMetadata = metadata
         self.CurrentBuildTarget = None
 
+        # Results of nodes built so far, shared between targets so that each is only built once per run,
+        # along with the target that built them
+        self.BuiltNodes = { }
+        self.BuiltNodeTargets = { }
+
     def NewFile(self, filename):
 
         # Always add to the file map
-        crc = self.BuildMetadata.AddToFileMap(filename)
-        return BuildSystem.FileNode(crc)
+        id = self.BuildMetadata.AddToFileMap(filename)
+        return BuildSystem.FileNode(id)
 
     def NewFiles(self, path, pattern):
 
@@ -139,17 +238,24 @@ class Environment:
 
         return BuildSystem.OutputFileNode(env, node)
 
-    def CPPFile(self, filename, override_cpp_opts = None):
+    def CPPFile(self, filename, override_cpp_opts = None, pch = None):
+
+        return self.Toolchain.CompileNode(filename, override_cpp_opts, pch)
 
-        return MSVCPlatform.VCCompileNode(filename, override_cpp_opts)
+    def PCHFile(self, filename, header, override_cpp_opts = None, force_include = False):
+
+        # Files compile without the precompiled header if the toolchain doesn't support them
+        if self.Toolchain.PCHNode == None:
+            return None
+        return self.Toolchain.PCHNode(filename, header, override_cpp_opts, force_include)
 
     def Link(self, filename, obj_files, lib_files = [], weak_lib_files = []):
 
-        return MSVCPlatform.VCLinkNode(filename, obj_files, lib_files, weak_lib_files)
+        return self.Toolchain.LinkNode(filename, obj_files, lib_files, weak_lib_files)
 
     def Lib(self, filename, dependencies, lib_files = []):
 
-        return MSVCPlatform.VCLibNode(filename, dependencies, lib_files)
+        return self.Toolchain.LibNode(filename, dependencies, lib_files)
     
     def CopyFile(self, source, dest_path):
 
@@ -201,9 +307,9 @@ class Environment:
 
         return copy_objs
 
-    def GetFilename(self, crc):
+    def GetFilename(self, id):
 
-        return self.BuildMetadata.GetFilename(crc)
+        return self.BuildMetadata.GetFilename(id)
 
     def GetFileMetadata(self, filename):
 
@@ -219,6 +325,7 @@ class Environment:
         # Delete the output before subsequent builds so that aborts can be detected next build.
         for file in files:
             Utils.RemoveFile(file)
+            BuildSystem.InvalidateFileState(file)
 
     def MakeOutputDirs(files):
 
@@ -230,10 +337,26 @@ class Environment:
             if dirname != "":
                 Utils.Makedirs(dirname)
 
+    def HaveOutputsChanged(self, node):
+
+        # Hash all outputs so that their content is committed at the end of the build
+        changed = False
+        for filename in node.GetContentHashFiles(self):
+            self.BuildMetadata.AddOutputFile(filename)
+            changed |= self.GetFileMetadata(filename).SetBuiltContent(filename)
+
+        return changed
+
     def ExecuteNodeBuild(self, node, tab):
 
         # Get some info about the input/output files
         input_filename = node.GetInputFile(self)
+
+        # Only nodes that depend on the files passed to -build_affected are evaluated, the rest of
+        # the graph beneath them can't contain any that do
+        if self.AffectedFiles != None and self.BuildMetadata.AddToFileMap(input_filename) not in self.AffectedFiles:
+            return (False, True)
+
         output_filenames = node.GetOutputFiles(self)
         input_metadata = self.GetFileMetadata(input_filename)
 
@@ -246,36 +369,78 @@ class Environment:
 
         # Have any of the explicit dependencies changed?
         requires_build = self.ForceBuild
+        reason = ("force", input_filename) if requires_build else None
         success = True
+        pending_deps = [ ]
         for dep in node.Dependencies:
             if self.Verbose:
                 print(tab + "   Explicit dependency: " + str(dep))
             (a, b) = self.ExecuteNodeBuild(dep, tab + "   ")
+            if dep in self.PendingBuilds:
+                pending_deps.append(dep)
+            if a and reason == None:
+                reason = ("explicit_dependency", dep)
             requires_build |= a
             success &= b
             if a and self.Verbose:
                 print(tab + "      Changed: " + str(dep))
 
+        # Record explicit dependencies for the reverse dependency index, including those of nodes with
+        # no build step so that chains through them, like package files, aren't broken
+        if input_metadata != None and (Utils.ObjectHasMethod(node, "Build") or len(node.Dependencies)):
+            dep_ids = [ self.BuildMetadata.AddToFileMap(dep.GetInputFile(self)) for dep in node.Dependencies ]
+            input_metadata.ExplicitDeps = [ id for id in dep_ids if id != None ]
+
+        # Nodes with no build step pass on the wait for any dependencies building in the background
+        if len(pending_deps) and not Utils.ObjectHasMethod(node, "Build"):
+            self.PendingBuilds[node] = pending_deps
+
         # Have any of the implicit dependencies changed?
         if not requires_build and input_metadata != None:
             for dep in input_metadata.ImplicitDeps:
                 (a, b) = self.ExecuteNodeBuild(dep, tab + "   ")
+                if a and reason == None:
+                    reason = ("implicit_dependency", dep)
                 requires_build |= a
                 success &= b
                 if a and self.Verbose:
                     print(tab + "Implicit dependency changed: " + str(dep))
 
+        # Has the command-line used to build the node changed since it was last built?
+        cmdline_hash = None
+        if input_metadata != None:
+            cmdline = node.GetCommandLine(self)
+            if cmdline != None:
+                cmdline_hash = BuildSystem.HashCommandLine(cmdline)
+
+                # Adopt the fingerprint of nodes built before fingerprints were recorded
+                if input_metadata.CommandLineHash == None:
+                    input_metadata.CommandLineHash = cmdline_hash
+                elif not requires_build and input_metadata.CommandLineHash != cmdline_hash:
+                    requires_build = True
+                    reason = ("command_line", input_filename)
+                    if self.Verbose:
+                        print(tab + "Command-line has changed: " + str(node))
+
         # If the dependencies haven't changed, check to see if the node itself has been changed
         if not requires_build and input_metadata != None and input_metadata.HasFileChanged(input_filename):
-            requires_build = True
-            if self.Verbose:
-                print(tab + "Input has changed: " + input_filename + ", " + str(node))
+
+            # Generated files can be rewritten by a build step with exactly the same contents
+            if self.BuildMetadata.IsOutputFile(input_filename) and not input_metadata.HasContentChanged(input_filename):
+                if self.Verbose:
+                    print(tab + "Input rebuilt with no content change: " + input_filename + ", " + str(node))
+            else:
+                requires_build = True
+                reason = ("input_changed", input_filename)
+                if self.Verbose:
+                    print(tab + "Input has changed: " + input_filename + ", " + str(node))
 
         # If any output files don't exist and no build is required, we must build!
         if not requires_build:
             for output_file in output_filenames:
                 if input_filename != output_file and not os.path.exists(output_file):
                     requires_build = True
+                    reason = ("missing_output", output_file)
                     if self.Verbose:
                         print(tab + "Output file doesn't exist: " + output_file)
                     break
@@ -283,11 +448,19 @@ class Environment:
         # If any implicit output files don't exist and no build is required, we must build!
         if not requires_build and input_metadata != None:
             for output_file in input_metadata.ImplicitOutputs:
-                output_filename = self.GetFilename(output_file.CRC)
+                output_filename = self.GetFilename(output_file.Id)
                 if not os.path.exists(output_filename):
                     requires_build = True
+                    reason = ("missing_implicit_output", output_filename)
                     if self.Verbose:
                         print(tab + "Implicit output file doesn't exist: " + output_filename)
+                    break
+
+        # Remember why the node needs building so that its dependents can find the root cause
+        cause = None
+        if requires_build and self.Explain != None:
+            cause = self.GetRebuildCause(reason)
+            self.RebuildCauses[node] = cause
 
         # At the last minute, cancel any builds if they're excluded by the input filter
         if requires_build and self.BuildInputFilter != None:
@@ -299,43 +472,222 @@ class Environment:
         if requires_build and success:
             if Utils.ObjectHasMethod(node, "Build"):
 
-                # Prepare for build aborts
-                Environment.DeleteTempOutput(node.GetTempOutputFiles(self))
-                Environment.MakeOutputDirs(node.GetOutputFiles(self))
-
-                if not node.Build(self):
-                    success = False
+                if cause != None:
+                    self.Explain.Record(self.CurrentBuildTarget, node.GetInputFile(self), cause)
+
+                # Nodes already built for another target aren't built again
+                if node not in self.BuiltNodes:
+
+                    # Prepare for build aborts
+                    Environment.DeleteTempOutput(node.GetTempOutputFiles(self))
+                    Environment.MakeOutputDirs(node.GetOutputFiles(self))
+
+                    # Distributed compiles and background nodes are assumed to change and succeed until their
+                    # dependents wait on them. Both wait for any dependencies still building in the background.
+                    future = None
+                    if self.Distributor != None and hasattr(node, "CanDistribute") and node.CanDistribute(self):
+                        future = self.Distributor.Submit(self.RunBackgroundNodeBuild, node, pending_deps, input_metadata, cmdline_hash)
+                    elif node.RunsInBackground(self):
+                        future = self.BackgroundExecutor.submit(self.RunBackgroundNodeBuild, node, pending_deps, input_metadata, cmdline_hash)
+                    if future != None:
+                        self.PendingBuilds[node] = future
+                        self.BuildResults[node] = (True, True)
+                        return (True, True)
+
+                # Dependencies building in the background must complete first
+                success = self.WaitForBuilds(pending_deps)
+                if success:
+                    (success, outputs_changed) = self.RunNodeBuild(node, input_metadata, cmdline_hash)
+
+                    # Dependents only need building if the contents of the outputs have changed
+                    if success and not outputs_changed:
+                        requires_build = False
+                        if self.Verbose:
+                            print(tab + "Outputs unchanged: " + str(node))
 
         # Record the build result incase this node is visited again in this build step
         self.BuildResults[node] = (requires_build, success)
         return (requires_build, success)
+
+    def GetRebuildCause(self, reason):
+
+        # Returns (reason, path, root reason, root path), following changed dependencies to their cause
+        (kind, subject) = reason
+        if not isinstance(subject, BuildSystem.Node):
+            return (kind, subject, kind, subject)
+
+        path = subject.GetInputFile(self)
+        dep_cause = self.RebuildCauses.get(subject)
+        if dep_cause == None:
+            return (kind, path, kind, path)
+        return (kind, path, dep_cause[2], dep_cause[3])
+
+    def RunNodeBuild(self, node, input_metadata, cmdline_hash):
+
+        # Nodes shared between targets are only built once, with the result recorded for each target
+        success = self.BuiltNodes.get(node)
+        if success == None:
+
+            start_time = time.perf_counter()
+            success = node.Build(self)
+            self.BuiltNodes[node] = success
+            self.BuiltNodeTargets[node] = self.CurrentBuildTarget
+
+            # Record how long the build step took for later analysis
+            if input_metadata != None:
+                input_metadata.BuildDuration = time.perf_counter() - start_time
+
+            # Record everything written for the target's clean, even if the build failed part way
+            self.BuildMetadata.AddTargetOutputs(self.CurrentBuildTarget, self.GetNodeCleanFiles(node))
+
+            # Anything cached about the outputs is now out of date, including those that aren't declared
+            # outputs but are hashed for dependents, like a DLL's import library
+            for filename in node.GetOutputFiles(self) + node.GetContentHashFiles(self) + node.GetCleanFiles(self):
+                BuildSystem.InvalidateFileState(filename)
+            if input_metadata != None:
+                for output_file in input_metadata.ImplicitOutputs:
+                    BuildSystem.InvalidateFileState(self.GetFilename(output_file.Id))
+
+        else:
+            self.CopyBuiltNodeMetadata(node, input_metadata)
+
+        # Record the command-line used
+        if success and input_metadata != None:
+            input_metadata.CommandLineHash = cmdline_hash
+
+        return (success, success and self.HaveOutputsChanged(node))
+
+    def CopyBuiltNodeMetadata(self, node, input_metadata):
+
+        # The build only recorded dependencies and outputs for the target that built the node
+        build_target = self.BuiltNodeTargets.get(node)
+        if build_target == None or build_target == self.CurrentBuildTarget:
+            return
+
+        if input_metadata != None:
+            built_metadata = self.BuildMetadata.GetFileMetadata(build_target, node.GetInputFile(self))
+            input_metadata.SetImplicitDeps(self, [ self.GetFilename(dep.Id) for dep in built_metadata.ImplicitDeps ])
+            input_metadata.SetImplicitOutputs(self, [ self.GetFilename(output.Id) for output in built_metadata.ImplicitOutputs ])
+            input_metadata.BuildDuration = built_metadata.BuildDuration
+
+        self.BuildMetadata.AddTargetOutputs(self.CurrentBuildTarget, self.GetNodeCleanFiles(node))
+
+    def RunBackgroundNodeBuild(self, node, pending_deps, input_metadata, cmdline_hash):
+
+        if not self.WaitForBuilds(pending_deps):
+            return (False, False)
+        return self.RunNodeBuild(node, input_metadata, cmdline_hash)
+
+    def WaitForBuilds(self, nodes):
+
+        # Failures are recorded for any other dependents of the node
+        success = True
+        for node in list(nodes):
+            pending = self.PendingBuilds[node]
+            if type(pending) == list:
+                node_success = self.WaitForBuilds(pending)
+            else:
+                (node_success, outputs_changed) = pending.result()
+            if not node_success:
+                self.BuildResults[node] = (True, False)
+                success = False
+
+        return success
     
-    def ExecuteNodeClean(self, node):
+    def GetNodeCleanFiles(self, node):
+
+        files = node.GetCleanFiles(self)
+        input_metadata = self.GetFileMetadata(node.GetInputFile(self))
+        if input_metadata:
+            files += [ self.GetFilename(output_file.Id) for output_file in input_metadata.ImplicitOutputs ]
+        return files
+
+    def GatherCleanFiles(self, node, files, visited):
+
+        # Shared dependencies are only visited once
+        if node in visited:
+            return
+        visited.add(node)
 
         for dep in node.Dependencies:
-            self.ExecuteNodeClean(dep)
+            self.GatherCleanFiles(dep, files, visited)
 
         # Only clean if there is a build step for this node
         if Utils.ObjectHasMethod(node, "Build"):
+            files.update(self.GetNodeCleanFiles(node))
+
+    def ExecuteNodeClean(self, build_graphs):
+
+        # Files in the graph and any others the target produced in previous builds
+        files = set()
+        visited = set()
+        for node in build_graphs:
+            self.GatherCleanFiles(node, files, visited)
+        outputs = self.BuildMetadata.TargetOutputs.get(self.CurrentBuildTarget, set())
+        files.update(self.GetFilename(id) for id in outputs)
+        outputs.clear()
+
+        # Remove the intermediate directory in one go if no other target has files in it
+        dirs = [ ]
+        if "-clean_dirs" in sys.argv:
+            dir = self.CurrentConfig.IntermediatePath
+            other_files = [ self.GetFilename(id) for target, ids in self.BuildMetadata.TargetOutputs.items() if target != self.CurrentBuildTarget for id in ids ]
+            if not Utils.IsPathUnder(os.getcwd(), dir) and not any(Utils.IsPathUnder(file, dir) for file in other_files):
+                dirs = [ dir ]
+                files = [ file for file in files if not Utils.IsPathUnder(file, dir) ]
+
+        if self.Verbose:
+            for file in sorted(files):
+                print("Deleting: " + file)
+            for dir in dirs:
+                print("Deleting directory: " + dir)
+
+        # Delete in batches across a pool of threads as each removal is a slow call into the OS
+        files = sorted(files)
+        batches = [ files[i:i + CleanBatchSize] for i in range(0, len(files), CleanBatchSize) ]
+        with concurrent.futures.ThreadPoolExecutor(min(32, os.cpu_count() * 4)) as executor:
+            list(executor.map(Environment.DeleteTempOutput, batches))
+            list(executor.map(lambda dir: shutil.rmtree(dir, ignore_errors = True), dirs))
+
+    def GetBuildConfigs(self):
+
+        # Configs added by the pibfile are included in "all"
+        if self.BuildConfigNames == [ "all" ]:
+            return list(self.Configs.values())
+        return [ self.Configs[name] for name in self.BuildConfigNames ]
+
+    def GetConfigView(self, config):
+
+        #
+        # A view shares everything with this environment, including the metadata and any file state
+        # cached during the build, but has its own current config and per-build results. Nodes are
+        # evaluated with the view so that they use its config.
+        #
+        view = self.ConfigViews.get(config.Name)
+        if view == None:
+            view = copy.copy(self)
+            view.CurrentConfig = config
+            view.ConfigViewOf = self
+            view.BuiltNodes = { }
+            view.BuiltNodeTargets = { }
+            self.ConfigViews[config.Name] = view
+
+        return view
 
-            # Clean output files
-            output_files = node.GetOutputFiles(self)
-            for file in output_files:
-                if self.Verbose:
-                    print("Deleting: " + file)
-                Utils.RemoveFile(file)
-            
-            # Clean implicit output files
-            input_metadata = self.GetFileMetadata(node.GetInputFile(self))
-            if input_metadata:
-                for output_file in input_metadata.ImplicitOutputs:
-                    output_filename = self.GetFilename(output_file.CRC)
-                    if self.Verbose:
-                        print("Deleting: " + file)
-                    Utils.RemoveFile(output_filename)
-    
     def Build(self, build_graphs, target = None):
 
+        if len(self.BuildConfigNames) == 1 and self.BuildConfigNames[0] != "all":
+            self.BuildConfig(build_graphs, target)
+            return
+
+        # Build each config concurrently through its own view of the environment
+        views = [ self.GetConfigView(config) for config in self.GetBuildConfigs() ]
+        with concurrent.futures.ThreadPoolExecutor(len(views)) as executor:
+            futures = [ executor.submit(view.BuildConfig, build_graphs, target) for view in views ]
+            [ future.result() for future in futures ]
+
+    def BuildConfig(self, build_graphs, target):
+
         # Apply the current build target
         self.CurrentBuildTarget = self.CurrentConfig.Name + ":"
         if target == None:
@@ -345,6 +697,13 @@ class Environment:
 
         # Reset build results on each build
         self.BuildResults = { }
+        self.PendingBuilds = { }
+        self.RebuildCauses = { }
+
+        # Limit the build to nodes affected by the given files, if the target has been built before
+        self.AffectedFiles = None
+        if self.BuildAffectedFiles != None and self.CurrentBuildTarget in self.BuildMetadata.ReverseDeps:
+            self.AffectedFiles = self.BuildMetadata.GetAffectedFiles(self.CurrentBuildTarget, self.BuildAffectedFiles)
 
         # Promote to a list if necessary
         if type(build_graphs) != type([]):
@@ -359,16 +718,21 @@ class Environment:
         target_name = ""
         if target != None:
             target_name = " target '" + target + "'"
+        if self.ConfigViewOf != None:
+            target_name += " (" + self.CurrentConfig.Name + ")"
 
         # Clean outputs?
         if "clean" in sys.argv or "rebuild" in sys.argv:
             print("PiB Cleaning" + target_name + "...")
-            [ self.ExecuteNodeClean(bg) for bg in build_graphs ]
+            self.ExecuteNodeClean(build_graphs)
 
         # Build the graph?
         if "rebuild" in sys.argv or not "clean" in sys.argv:
             print("PiB Building" + target_name + "...")
             [ self.ExecuteNodeBuild(bg, "") for bg in build_graphs ]
+            self.WaitForBuilds(self.PendingBuilds.keys())
+            if self.Explain != None:
+                self.Explain.PrintSummary(self.CurrentBuildTarget)
 
         self.BuildMetadata.UpdateModTimes(self.CurrentBuildTarget)
         self.CurrentBuildTarget = None
@@ -0,0 +1,718 @@
+
+#
+# --- MIT Open Source License --------------------------------------------------
+# PiB - Python Build System
+# Copyright (C) 2011 by Don Williamson
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+# ------------------------------------------------------------------------------
+#
+# GCCPlatform.py: Command-line parameter abstraction and build nodes for GCC and
+# Clang, which share the same driver command-line.
+#
+# The interface mirrors MSVCPlatform so that the environment can use either as its
+# toolchain. Dependencies are discovered by asking the compiler to write a Makefile
+# fragment (-MD -MF) as it compiles, rather than scanning its output.
+#
+# GCC Command-Line Options
+# https://gcc.gnu.org/onlinedocs/gcc/Invoking-GCC.html
+#
+
+import os
+import re
+import sys
+import shutil
+import Utils
+import Process
+import BuildSystem
+
+
+#
+# Locate the compiler drivers and archiver. Each can be overridden on the command-line
+# or with the usual environment variables, otherwise the first found in the path is used.
+# Passing "-toolchain clang" prefers Clang over GCC.
+#
+def FindTool(arg, envvar, names):
+
+    tool = Utils.GetSysArgvProperty(arg)
+    if tool == None:
+        tool = os.getenv(envvar)
+    if tool == None:
+        for name in names:
+            if shutil.which(name) != None:
+                tool = name
+                break
+
+    return tool
+
+if Utils.GetSysArgvProperty("-toolchain") == "clang":
+    CC = FindTool("-cc", "CC", [ "clang", "gcc", "cc" ])
+    CXX = FindTool("-cxx", "CXX", [ "clang++", "g++", "c++" ])
+else:
+    CC = FindTool("-cc", "CC", [ "gcc", "clang", "cc" ])
+    CXX = FindTool("-cxx", "CXX", [ "g++", "clang++", "c++" ])
+AR = FindTool("-ar", "AR", [ "ar", "llvm-ar" ])
+
+# Show chosen tools
+if "-gcc_show_env" in sys.argv:
+    print("CC = ", CC)
+    print("CXX = ", CXX)
+    print("AR = ", AR)
+
+
+#
+# Makefile dependency fragments written by -MD look like:
+#
+#    obj/Debug/src/main.o: src/main.cpp src/main.h \
+#      /usr/include/stdio.h
+#
+# Lines are continued with a backslash, spaces in filenames are escaped with a backslash and
+# dollars are doubled. The rule separator is a colon followed by whitespace so that Windows
+# drive letters aren't mistaken for it. Only the first rule matters; -MP adds empty rules
+# for each header after it.
+#
+_DepfileRuleEnd = re.compile(rb":(?:[ \t]|$)")
+_DepfileToken = re.compile(rb"(?:\\ |[^\s])+")
+
+def ParseDepfile(filename):
+
+    try:
+        with open(filename, "rb") as f:
+            data = f.read()
+    except OSError:
+        return None
+
+    # Join continued lines and isolate the first rule
+    data = data.replace(b"\\\r\n", b" ").replace(b"\\\n", b" ")
+    rule = data.split(b"\n", 1)[0]
+    match = _DepfileRuleEnd.search(rule)
+    if match == None:
+        return None
+
+    deps = [ ]
+    for token in _DepfileToken.findall(rule, match.end()):
+        token = token.replace(b"\\ ", b" ").replace(b"\\#", b"#").replace(b"$$", b"$")
+        deps.append(os.fsdecode(token))
+
+    return deps
+
+
+#
+# GCC/Clang Compiler
+#
+# Options:
+#
+#    -c                             Compiles without linking
+#    -MD                            Write a Makefile dependency fragment while compiling
+#    -MF file                       Specifies the dependency fragment filename
+#    -o file                        Specifies the output .o file
+#    -w                             Disable all warnings
+#    -Wall, -Wextra, -Wpedantic     Increasing sets of warnings
+#    -Werror                        Treat warnings as errors
+#    -Wno-warning                   Disable a specific warning
+#
+#    -O0                            Disable optimisations
+#    -Os                            Favour smaller code
+#    -O2                            Favour faster code
+#    -O3                            Full optimisation, including aggressive inlining and vectorisation
+#    -flto                          Enable link-time optimisation
+#
+#    -march=arch                    Specifies architecture for code generation
+#    -ffast-math                    Relax IEEE floating-point compliance
+#    -fPIC                          Generate position independent code for shared libraries
+#    -fno-rtti                      Disable runtime type information
+#    -fno-exceptions                Disable exception handling
+#    -g                             Produce debugging info
+#
+#    -D name[=value]                Defines a preprocessing symbol for your source file
+#    -I dir                         Adds a directory to the list of directories searched for include files
+#    -include file                  Preprocess the specified include file before the source file
+#    -std=standard                  Language standard to compile against
+#
+# Warning levels map to:
+#
+#    0  -w
+#    1  Compiler defaults
+#    2  -Wall
+#    3  -Wall -Wextra
+#    4  -Wall -Wextra -Wpedantic
+#
+
+GCCBaseConfig = Utils.enum(
+    'DEBUG',
+    'RELEASE'
+)
+
+GCCArchitecture = Utils.enum(
+    DEFAULT = None,
+    NATIVE = '-march=native',
+    SSE2 = '-msse2',
+    AVX = '-mavx',
+    AVX2 = '-mavx2'
+)
+
+GCCOptimisations = Utils.enum(
+    DISABLE = '-O0',
+    SIZE = '-Os',
+    SPEED = '-O2',
+    FULL = '-O3'
+)
+
+GCCStandard = Utils.enum(
+    CPP_14 = '-std=c++14',
+    CPP_17 = '-std=c++17',
+    CPP_20 = '-std=c++20',
+    C_11 = '-std=c11',
+    C_17 = '-std=c17',
+)
+
+
+class GCCCompileOptions (Utils.CommandLineOptions):
+
+    def __init__(self, config):
+
+        super().__init__()
+
+        # Initialise the requested config settings
+        if config == GCCBaseConfig.DEBUG:
+            self.InitDebug()
+        elif config == GCCBaseConfig.RELEASE:
+            self.InitRelease()
+
+    def InitDebug(self):
+
+        # Default settings for all compiler options
+        self.Architecture = GCCArchitecture.DEFAULT
+        self.CompileAsC = False
+        self.CStandard = None
+        self.DebuggingInfo = True
+        self.Defines = [ ]
+        self.DisabledWarnings = [ ]
+        self.ExceptionHandling = True
+        self.FastMath = False
+        self.ForcedIncludes = [ ]
+        self.IncludePaths = [ ]
+        self.Optimisations = GCCOptimisations.DISABLE
+        self.PositionIndependentCode = False
+        self.RTTI = True
+        self.Standard = None
+        self.WarningLevel = 2
+        self.WarningsAsErrors = False
+        self.WholeProgramOptimisation = False
+        self.UpdateCommandLine()
+
+    def InitRelease(self):
+
+        # Initialise changes from debug
+        self.InitDebug()
+        self.Optimisations = GCCOptimisations.SPEED
+        self.Defines.extend( [ 'NDEBUG' ])
+        self.UpdateCommandLine()
+
+    def BuildCommandLine(self):
+
+        # Compile only & we need the dependency fragment for dependency evaluation
+        cmdline = [
+            '-c',                   # Compile only
+            '-MD',                  # Write dependencies for evaluation
+        ]
+
+        # Construct the command line from the set options
+
+        if self.WarningLevel == 0:
+            cmdline += [ '-w' ]
+        if self.WarningLevel >= 2:
+            cmdline += [ '-Wall' ]
+        if self.WarningLevel >= 3:
+            cmdline += [ '-Wextra' ]
+        if self.WarningLevel >= 4:
+            cmdline += [ '-Wpedantic' ]
+
+        if self.WarningsAsErrors:
+            cmdline += [ '-Werror' ]
+
+        for warning in self.DisabledWarnings:
+            cmdline += [ '-Wno-' + str(warning) ]
+
+        if self.Architecture != None:
+            cmdline += [ self.Architecture ]
+
+        if self.FastMath:
+            cmdline += [ '-ffast-math' ]
+
+        if self.DebuggingInfo:
+            cmdline += [ '-g' ]
+
+        if not self.RTTI:
+            cmdline += [ '-fno-rtti' ]
+
+        if not self.ExceptionHandling:
+            cmdline += [ '-fno-exceptions' ]
+
+        if self.PositionIndependentCode:
+            cmdline += [ '-fPIC' ]
+
+        cmdline += [ self.Optimisations ]
+
+        if self.WholeProgramOptimisation:
+            cmdline += [ '-flto' ]
+
+        for define in self.Defines:
+            cmdline += [ '-D', define ]
+
+        for include in self.IncludePaths:
+            cmdline += [ '-I', include ]
+
+        for include in self.ForcedIncludes:
+            cmdline += [ '-include', include ]
+
+        if self.CompileAsC:
+            cmdline += [ '-x', 'c' ]
+
+        return cmdline
+
+
+#
+# GCC/Clang Linker, invoked through the C++ compiler driver
+#
+# Options:
+#
+#    -o file                        Specifies the output filename
+#    -shared                        Builds a shared library
+#    -L dir                         Adds a library search path
+#    -l library                     Links with a library found in the search paths
+#    -Wl,-rpath,dir                 Adds a runtime library search path
+#    -Wl,--fatal-warnings           Treat linker warnings as errors
+#    -s                             Strip all symbols from the output
+#    -flto                          Perform link-time optimisation
+#
+
+class GCCLinkOptions (Utils.CommandLineOptions):
+
+    def __init__(self, config):
+
+        super().__init__()
+
+        # Initialise the requested config settings
+        if config == GCCBaseConfig.DEBUG:
+            self.InitDebug()
+        elif config == GCCBaseConfig.RELEASE:
+            self.InitRelease()
+
+    def InitDebug(self):
+
+        # Default settings for all linker options
+        self.DLL = False
+        self.LibPaths = [ ]
+        self.Libraries = [ ]
+        self.LTO = False
+        self.RPaths = [ ]
+        self.StripSymbols = False
+        self.WarningsAsErrors = False
+        self.UpdateCommandLine()
+
+    def InitRelease(self):
+
+        # Initialise changes from debug
+        self.InitDebug()
+        self.UpdateCommandLine()
+
+    def BuildCommandLine(self):
+
+        cmdline = [ ]
+
+        if self.DLL:
+            cmdline += [ '-shared' ]
+
+        if self.LTO:
+            cmdline += [ '-flto' ]
+
+        if self.StripSymbols:
+            cmdline += [ '-s' ]
+
+        if self.WarningsAsErrors:
+            cmdline += [ '-Wl,--fatal-warnings' ]
+
+        for lib in self.LibPaths:
+            cmdline += [ '-L', lib ]
+
+        for path in self.RPaths:
+            cmdline += [ '-Wl,-rpath,' + path ]
+
+        return cmdline
+
+
+#
+# Archiver (ar)
+#
+# Options:
+#
+#    r                              Insert files into the archive, replacing existing members
+#    c                              Don't warn when creating the archive
+#    s                              Write an object file index
+#    D                              Deterministic mode: zero timestamps, uids and gids
+#
+
+class GCCLibOptions (Utils.CommandLineOptions):
+
+    def __init__(self, config):
+
+        super().__init__()
+
+        # Initialise the requested config settings
+        if config == GCCBaseConfig.DEBUG:
+            self.InitDebug()
+        elif config == GCCBaseConfig.RELEASE:
+            self.InitRelease()
+
+    def InitDebug(self):
+
+        # Default settings for all archiver options
+        self.Deterministic = True
+        self.UpdateCommandLine()
+
+    def InitRelease(self):
+
+        # Initialise changes from debug
+        self.InitDebug()
+        self.UpdateCommandLine()
+
+    def BuildCommandLine(self):
+
+        flags = "rcs"
+        if self.Deterministic:
+            flags += "D"
+
+        return [ flags ]
+
+
+#
+# A node for compiling a single C/C++ file to a .o file
+#
+class GCCCompileNode (BuildSystem.Node):
+
+    def __init__(self, path, override_cpp_opts, pch = None):
+
+        super().__init__()
+        self.Path = path
+        self.OverrideCPPOptions = override_cpp_opts
+        self.PCH = pch
+
+    def Build(self, env):
+
+        # Distributed builds preprocess here and compile elsewhere
+        if env.Distributor != None and self.CanDistribute(env):
+            return env.Distributor.Compile(env, self)
+
+        output_files = self.GetOutputFiles(env)
+        return self.RunCompiler(env, self.GetCommandLine(env), output_files[1])
+
+    def RunCompiler(self, env, cmdline, depfile):
+
+        Utils.Print(env, "Compiling: " + self.Path)
+        Utils.ShowCmdLine(env, cmdline)
+
+        # Run the compiler
+        process = Process.OpenPiped(cmdline, env.EnvironmentVariables)
+        output = Process.WaitForPipeOutput(process)
+        if not env.NoToolOutput and output != "":
+            Utils.Print(env, output)
+
+        if process.returncode != 0:
+            return False
+
+        # The first dependency listed is the input file itself
+        deps = ParseDepfile(depfile)
+        if deps == None:
+            Utils.Print(env, "ERROR: Couldn't parse dependency file " + depfile)
+            return False
+
+        # Record the implicit dependencies for this file
+        data = env.GetFileMetadata(self.GetInputFile(env))
+        data.SetImplicitDeps(env, deps[1:])
+
+        return True
+
+    def IsC(self, env):
+
+        # C files use the C driver, unless forced the other way
+        cpp_opts = self.GetCPPOptions(env)
+        return cpp_opts.CompileAsC or os.path.splitext(self.Path)[1].lower() == ".c"
+
+    def GetCompilerCommandLine(self, env, options):
+
+        cpp_opts = self.GetCPPOptions(env)
+        if self.IsC(env):
+            cmdline = [ CC ] + options
+            standard = cpp_opts.CStandard
+        else:
+            cmdline = [ CXX ] + options
+            standard = cpp_opts.Standard
+
+        if standard != None:
+            cmdline += [ standard ]
+        return cmdline
+
+    def GetCommandLine(self, env):
+
+        output_files = self.GetOutputFiles(env)
+
+        # Construct the command-line
+        cpp_opts = self.GetCPPOptions(env)
+        cpp_opts.UpdateCommandLine()
+        cmdline = self.GetCompilerCommandLine(env, cpp_opts.CommandLine)
+        cmdline += [ "-MF", output_files[1], "-o", output_files[0], self.GetInputFile(env) ]
+        return cmdline
+
+    def CanDistribute(self, env):
+
+        return True
+
+    def GetPreprocessedFile(self, env):
+
+        path = os.path.splitext(self.GetOutputFiles(env)[0])[0]
+        return path + (".i" if self.IsC(env) else ".ii")
+
+    def Preprocess(self, env, preprocessed_file):
+
+        output_files = self.GetOutputFiles(env)
+
+        cpp_opts = self.GetCPPOptions(env)
+        cpp_opts.UpdateCommandLine()
+        cmdline = self.GetCompilerCommandLine(env, cpp_opts.CommandLine)
+        cmdline += [ "-E", "-MF", output_files[1], "-o", preprocessed_file, self.GetInputFile(env) ]
+        return self.RunCompiler(env, cmdline, output_files[1])
+
+    def GetRemoteCommandLine(self, env):
+
+        cpp_opts = self.GetCPPOptions(env)
+        cpp_opts.UpdateCommandLine()
+
+        # Includes and defines have already been applied
+        options = [ ]
+        cpp_options = iter(cpp_opts.CommandLine)
+        for option in cpp_options:
+            if option == "-I" or option == "-D" or option == "-include":
+                next(cpp_options)
+            elif option != "-MD":
+                options += [ option ]
+
+        cmdline = self.GetCompilerCommandLine(env, options)
+        cmdline += [ "-x", "cpp-output" if self.IsC(env) else "c++-cpp-output" ]
+        return cmdline
+
+    def SetCPPOptions(self, override_cpp_opts):
+
+        self.OverrideCPPOptions = override_cpp_opts
+
+    def GetCPPOptions(self, env):
+
+        return env.CurrentConfig.CPPOptions if self.OverrideCPPOptions is None else self.OverrideCPPOptions
+
+    def GetInputFile(self, env):
+
+        return self.Path
+
+    def GetOutputFiles(self, env):
+
+        # Get the relocated path minus extension
+        path = os.path.splitext(self.Path)[0]
+        path = os.path.join(env.CurrentConfig.IntermediatePath, path)
+        return [ path + ".o", path + ".d" ]
+
+    def GetTempOutputFiles(self, env):
+
+        return self.GetOutputFiles(env)
+
+
+#
+# A node for linking an executable or shared library given an output path and list of dependencies
+#
+class GCCLinkNode (BuildSystem.Node):
+
+    def __init__(self, path, obj_files, lib_files, weak_lib_files):
+
+        super().__init__()
+        self.Path = path
+
+        # Object files are explicit dependencies, lib files are implicit
+        self.Dependencies = obj_files
+        self.LibFiles = lib_files
+        self.WeakLibFiles = weak_lib_files
+
+    def Build(self, env):
+
+        output_files = self.GetOutputFiles(env)
+        Utils.Print(env, "Linking: " + output_files[0] + "\n")
+
+        cmdline = self.GetCommandLine(env)
+        Utils.ShowCmdLine(env, cmdline)
+
+        # Run the link process
+        process = Process.OpenPiped(cmdline, env.EnvironmentVariables)
+        output = Process.WaitForPipeOutput(process)
+        if not env.NoToolOutput and output != "":
+            Utils.Print(env, output)
+
+        #
+        # Library files are passed to the linker with full paths so, unlike link.exe, there's no need to
+        # ask the linker where it found them. Weak library files are excluded from the dependencies.
+        #
+        data = env.GetFileMetadata(self.GetInputFile(env))
+        data.SetImplicitDeps(env, [ dep.GetOutputFiles(env)[0] for dep in self.LibFiles ])
+
+        return process.returncode == 0
+
+    def GetCommandLine(self, env):
+
+        output_files = self.GetOutputFiles(env)
+
+        # Construct the command-line; libraries have to follow the objects that reference them
+        link_opts = env.CurrentConfig.LinkOptions
+        link_opts.UpdateCommandLine()
+        cmdline = [ CXX ] + link_opts.CommandLine
+        cmdline += [ "-o", output_files[0] ]
+        cmdline += [ dep.GetOutputFiles(env)[0] for dep in self.Dependencies ]
+        cmdline += [ dep.GetOutputFiles(env)[0] for dep in self.LibFiles ]
+        cmdline += [ dep.GetOutputFiles(env)[0] for dep in self.WeakLibFiles ]
+        cmdline += [ "-l" + lib for lib in link_opts.Libraries ]
+        return cmdline
+
+    def GetInputFile(self, env):
+
+        # The output is named by the platform rather than the target path
+        return self.GetOutputFiles(env)[0]
+
+    def GetPrimaryOutput(self, config):
+
+        # Get the relocated path minus extension
+        path = os.path.splitext(self.Path)[0]
+        path = os.path.join(config.OutputPath, path)
+
+        if os.name == "nt":
+            ext = ".dll" if config.LinkOptions.DLL else ".exe"
+        else:
+            ext = ".so" if config.LinkOptions.DLL else ""
+
+        return (path, ext)
+
+    def GetOutputFiles(self, env):
+
+        (path, ext) = self.GetPrimaryOutput(env.CurrentConfig)
+        return [ path + ext ]
+
+    def __repr__(self):
+
+        return "LINK: " + self.Path
+
+
+#
+# A node for compositing a set of dependencies into a static library archive.
+# Archives can't be merged by ar so any input library files are ignored; pass
+# them on to the link step instead.
+#
+class GCCLibNode (BuildSystem.Node):
+
+    def __init__(self, path, dependencies, lib_files):
+
+        super().__init__()
+        self.Path = path
+        self.Dependencies = dependencies
+        self.LibFiles = lib_files
+
+    def Build(self, env):
+
+        output_files = self.GetOutputFiles(env)
+
+        cmdline = self.GetCommandLine(env)
+        Utils.Print(env, "Librarian: " + output_files[0])
+        Utils.ShowCmdLine(env, cmdline)
+
+        if len(self.LibFiles):
+            Utils.Print(env, "WARNING: Library files can't be merged into " + output_files[0])
+
+        # Run the archiver process
+        process = Process.OpenPiped(cmdline, env.EnvironmentVariables)
+        output = Process.WaitForPipeOutput(process)
+        if not env.NoToolOutput and output != "":
+            Utils.Print(env, output)
+
+        return process.returncode == 0
+
+    def GetCommandLine(self, env):
+
+        output_files = self.GetOutputFiles(env)
+
+        # Construct the command-line
+        lib_opts = env.CurrentConfig.LibOptions
+        lib_opts.UpdateCommandLine()
+        cmdline = [ AR ] + lib_opts.CommandLine
+        cmdline += [ output_files[0] ]
+        cmdline += [ dep.GetOutputFiles(env)[0] for dep in self.Dependencies ]
+        return cmdline
+
+    def GetInputFile(self, env):
+
+        # The output is named by the platform rather than the target path
+        return self.GetOutputFiles(env)[0]
+
+    def GetPrimaryOutput(self, config):
+
+        # Get the relocated path minus extension
+        path = os.path.splitext(self.Path)[0]
+        path = os.path.join(config.OutputPath, path)
+        return (path, ".a")
+
+    def GetOutputFiles(self, env):
+
+        (path, ext) = self.GetPrimaryOutput(env.CurrentConfig)
+        return [ path + ext ]
+
+
+# Toolchain interface used by the environment, precompiled headers aren't supported
+BaseConfig = GCCBaseConfig
+CompileOptions = GCCCompileOptions
+LinkOptions = GCCLinkOptions
+LibOptions = GCCLibOptions
+CompileNode = GCCCompileNode
+PCHNode = None
+LinkNode = GCCLinkNode
+LibNode = GCCLibNode
+
+
+def __RunTests():
+
+    options = GCCCompileOptions(GCCBaseConfig.DEBUG)
+    print(options.BuildCommandLine())
+    options = GCCCompileOptions(GCCBaseConfig.RELEASE)
+    print(options.BuildCommandLine())
+
+    options = GCCLinkOptions(GCCBaseConfig.DEBUG)
+    print (options.BuildCommandLine())
+    options = GCCLinkOptions(GCCBaseConfig.RELEASE)
+    print (options.BuildCommandLine())
+
+    options = GCCLibOptions(GCCBaseConfig.DEBUG)
+    print (options.BuildCommandLine())
+    options = GCCLibOptions(GCCBaseConfig.RELEASE)
+    print (options.BuildCommandLine())
+
+
+if __name__ == "__main__":
+    __RunTests()
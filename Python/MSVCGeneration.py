@@ -29,12 +29,25 @@
 
 import os
 import uuid
+import posixpath
 import hashlib
 import base64
 import sys
+import concurrent.futures
 import Utils
 
 
+# Visual Studio's project type for C++ projects, referenced by each project in a solution
+VCProjectTypeGUID = "8BC9CEB8-8B4A-11D0-8D11-00A0C91BCB3F"
+
+# Project and filter GUIDs are derived from names in this namespace so that they're the same
+# on every generation and every machine
+ProjectNamespace = uuid.UUID("1ad4ef91-1ad6-40d7-b46c-89d5577ae218")
+
+# Changing how projects are written forces regeneration of existing ones
+GeneratorVersion = "3"
+
+
 class MSVCGeneration2005:
     VisualStudio = "2005"
     Solution = "9.00"
@@ -105,6 +118,32 @@ vcproj_config = """		<Configuration
             />
         </Configuration>"""
 
+def ProjectGUID(name):
+
+    # Projects are named relative to the pibfile, which the solution is also generated from. The
+    # separators and case are normalised explicitly as os.path only does so on Windows.
+    if os.path.isabs(name):
+        try:
+            name = os.path.relpath(name)
+        except ValueError:
+            pass
+    name = posixpath.normpath(name.replace("\\", "/")).lower()
+    return str(uuid.uuid5(ProjectNamespace, name)).upper()
+
+
+def WriteIfChanged(filename, text):
+
+    # Leaving identical files untouched stops Visual Studio from reloading them
+    if os.path.exists(filename):
+        with open(filename, "r") as f:
+            if f.read() == text:
+                return False
+
+    with open(filename, "w") as f:
+        f.write(text)
+    return True
+
+
 def CreateFolderLists(dict):
 
     # Gather a list of folders first
@@ -125,37 +164,38 @@ def CreateFolderLists(dict):
     return folders + files
 
 
-def WriteProjectFiles(f, tab, name, entries):
+def WriteProjectFiles(lines, tab, name, entries, guid, path = ""):
 
     # Write file markup if this is a file
     if entries == None:
-        print(tab + "<File", file=f)
-        print(tab + '\tRelativePath="' + name + '"', file=f)
-        print(tab + "\t>", file=f)
-        print(tab + "</File>", file=f)
+        lines.append(tab + "<File")
+        lines.append(tab + '\tRelativePath="' + name + '"')
+        lines.append(tab + "\t>")
+        lines.append(tab + "</File>")
         return
 
-    # Open a filter tag if this is a named folder
+    # Open a filter tag if this is a named folder, identified by its path within the project
     if name != "":
-        print(tab + "<Filter", file=f)
+        path += "/" + name
+        lines.append(tab + "<Filter")
         tab += "\t"
-        print(tab + 'Name="' + name + '"', file=f)
-        print(tab + 'UniqueIdentifier="{' + str(uuid.uuid1()) + '}"', file=f)
-        print(tab + ">", file=f)
+        lines.append(tab + 'Name="' + name + '"')
+        lines.append(tab + 'UniqueIdentifier="{' + str(uuid.uuid5(ProjectNamespace, guid + path.lower())).upper() + '}"')
+        lines.append(tab + ">")
 
     # Recurse into the entries of this folder
     for entry in entries:
-        WriteProjectFiles(f, tab, entry[0], entry[1])
+        WriteProjectFiles(lines, tab, entry[0], entry[1], guid, path)
 
     # Close the filter tag
     if name != "":
-        print(tab[:-1] + "</Filter>", file=f)
+        lines.append(tab[:-1] + "</Filter>")
 
 
 def DoesProjectNeedUpdating(vcproj_path, files):
 
     # Hash all the inputs
-    md5 = hashlib.md5()
+    md5 = hashlib.md5(bytes(GeneratorVersion, "utf-8"))
     for file in files:
         md5.update(bytes(file, "utf-8"))
     
@@ -171,24 +211,19 @@ def DoesProjectNeedUpdating(vcproj_path, files):
     if not os.path.exists(vcproj_path):
         return src_digest
 
-    with open(vcproj_path, "r") as f:
-
-        # Search the file for the previous digest
-        dst_digest = None
-        lines = f.readlines()
-        for i in range(len(lines)):
-            if 'Name="PiBDigest"' in lines[i] and i + 1 < len(lines):
-                dst_digest = lines[i + 1].split('"')[1]
-
-        # Regeneration required if it's not there
-        if dst_digest == None:
-            return src_digest
+    # The previous digest is kept in a small file alongside the project so that the project
+    # itself doesn't need to be read; regeneration is required if it's not there
+    digest_path = vcproj_path + ".pibdigest"
+    if not os.path.exists(digest_path):
+        return src_digest
+    with open(digest_path, "r") as f:
+        dst_digest = f.read().strip()
 
-        # If they're equal, no need to return a new digest
-        if src_digest == dst_digest:
-            return None
+    # If they're equal, no need to return a new digest
+    if src_digest == dst_digest:
+        return None
 
-        return src_digest
+    return src_digest
 
 
 # Need: input files, configurations and args to run for configurations
@@ -208,13 +243,14 @@ def VCGenerateProjectFile(env, name, files, output, targets=None, configs=None,
     vcproj_path = name + ".vcproj"
     vcproj_name = os.path.basename(name)
     vcproj_dir = os.path.dirname(vcproj_path)
-    vcproj_guid = str(uuid.uuid1()).upper()
+    vcproj_guid = ProjectGUID(name)
 
     # Remove the file if requested
     if "-remove_vcfiles" in sys.argv:
         if os.path.exists(vcproj_path):
             print("Deleting " + vcproj_path)
             os.remove(vcproj_path)
+        Utils.RemoveFile(vcproj_path + ".pibdigest")
         return
 
     # Ensure the paths are normalised for stable hashing
@@ -255,18 +291,18 @@ def VCGenerateProjectFile(env, name, files, output, targets=None, configs=None,
     for include in include_search:
         include_search_str += include + ";"
 
-    f = open(vcproj_path, "w")
+    lines = [ ]
 
-    print('<?xml version="1.0" encoding="Windows-1252"?>', file=f)
+    lines.append('<?xml version="1.0" encoding="Windows-1252"?>')
 
     # Generate the header
     vcproj_header = ProjectHeader()
     header_xml = vcproj_header.replace("%NAME%", vcproj_name)
     header_xml = header_xml.replace("%GUID%", vcproj_guid)
-    print(header_xml, file=f)
+    lines.append(header_xml)
 
     # Generate each configuration
-    print("\t<Configurations>", file=f)
+    lines.append("\t<Configurations>")
     for name, config in env.Configs.items():
 
         xml = vcproj_config.replace("%CONFIG%", config.Name)
@@ -291,11 +327,11 @@ def VCGenerateProjectFile(env, name, files, output, targets=None, configs=None,
         else:
             xml = xml.replace("%OUTPUT%", "")
 
-        print(xml, file=f)
+        lines.append(xml)
 
-    print("\t</Configurations>", file=f)
-    print("\t<References>", file=f)
-    print("\t</References>", file=f)
+    lines.append("\t</Configurations>")
+    lines.append("\t<References>")
+    lines.append("\t</References>")
 
     # Create a hierarchical dictionary of folders and files
     folders = { }
@@ -329,27 +365,42 @@ def VCGenerateProjectFile(env, name, files, output, targets=None, configs=None,
     # Convert the dictionaries into sorted lists
     folders = CreateFolderLists(folders)
 
-    print("\t<Files>", file=f)
-    WriteProjectFiles(f, "\t\t", "", folders)
-    print("\t</Files>", file=f)
+    lines.append("\t<Files>")
+    WriteProjectFiles(lines, "\t\t", "", folders, vcproj_guid)
+    lines.append("\t</Files>")
     
+    lines.append("\t<Globals>")
+    lines.append("\t</Globals>")
+    lines.append("</VisualStudioProject>")
+
+    WriteIfChanged(vcproj_path, "\n".join(lines) + "\n")
+
     # Write the digest for detecting regeneration
-    print("\t<Globals>", file=f)
-    print("\t\t<Global", file=f)
-    print('\t\t\tName="PiBDigest"', file=f)
-    print('\t\t\tValue="' + digest + '"', file=f)
-    print("\t\t/>", file=f)
-    print("\t</Globals>", file=f)
+    with open(vcproj_path + ".pibdigest", "w") as f:
+        f.write(digest + "\n")
 
-    print("</VisualStudioProject>", file=f)
-    f.close()
+    return vcproj_guid
+
+
+def VCGenerateProjectFiles(env, projects):
+
+    #
+    # Generates independent projects in parallel, returning their GUIDs in order. Each entry is
+    # a dictionary of keyword arguments to VCGenerateProjectFile, e.g.
+    #
+    #    VCGenerateProjectFiles(env, [ { "name": "build/core", "files": core_files, "output": core_lib },
+    #                                  { "name": "build/game", "files": game_files, "output": game_exe } ])
+    #
+    with concurrent.futures.ThreadPoolExecutor(os.cpu_count()) as executor:
+        futures = [ executor.submit(VCGenerateProjectFile, env, **project) for project in projects ]
+        return [ future.result() for future in futures ]
 
 
 def DoesSolutionNeedUpdating(sln_path, projects):
 
     # Hash all the inputs
     # TODO: Output filename
-    md5 = hashlib.md5()
+    md5 = hashlib.md5(bytes(GeneratorVersion, "utf-8"))
     for name in projects:
         md5.update(bytes(name, "utf-8"))
 
@@ -386,18 +437,6 @@ def DoesSolutionNeedUpdating(sln_path, projects):
         return src_digest
 
 
-def ReadProjectGUID(vcproj_path):
-    
-    with open(vcproj_path, "r") as f:
-        
-        for line in f.readlines():
-            
-            line = line.strip()
-            if line.startswith("ProjectGUID="):
-                guid = line.split("=")[1][1:-1]
-                return guid
-
-
 def VCGenerateSolutionFile(env, name, add_dependencies, projects):
 
     sln_path = name + ".sln"
@@ -416,10 +455,10 @@ def VCGenerateSolutionFile(env, name, add_dependencies, projects):
 
     print("Generating Solution File: " + sln_path)
 
-    f = open(sln_path, "w")
+    lines = [ ]
 
     sln_header = SolutionHeader()
-    print(sln_header, file=f)
+    lines.append(sln_header)
 
     # Write the project summary
     guids = { }
@@ -427,49 +466,49 @@ def VCGenerateSolutionFile(env, name, add_dependencies, projects):
     for name in projects:
         vcproj_path = os.path.normpath(name + ".vcproj")
         vcproj_name = os.path.basename(name)
-        guids[name] = ReadProjectGUID(vcproj_path)
+        guids[name] = "{" + ProjectGUID(name) + "}"
 
         # Need the vcproj path relative to the solution for Visual Studio
         vcproj_path = os.path.relpath(vcproj_path, os.path.dirname(sln_path))
-        print('Project("{' + str(uuid.uuid1()).upper() + '}") = "' + vcproj_name + '", "' + vcproj_path + '", "' + guids[name] + '"', file=f)
+        lines.append('Project("{' + VCProjectTypeGUID + '}") = "' + vcproj_name + '", "' + vcproj_path + '", "' + guids[name] + '"')
 
         # Ensure the Solution build order matches the order in which projects were passed
         if add_dependencies and prev_guid != None:
-            print("\tProjectSection(ProjectDependencies) = postProject", file=f)
-            print("\t\t" + prev_guid + " = " + prev_guid, file=f)
-            print("\tEndProjectSection", file=f)
+            lines.append("\tProjectSection(ProjectDependencies) = postProject")
+            lines.append("\t\t" + prev_guid + " = " + prev_guid)
+            lines.append("\tEndProjectSection")
 
         prev_guid = guids[name]
-        print("EndProject", file=f)
+        lines.append("EndProject")
 
-    print("Global", file=f)
-    print("\tGlobalSection(SolutionConfigurationPlatforms) = preSolution", file=f)
+    lines.append("Global")
+    lines.append("\tGlobalSection(SolutionConfigurationPlatforms) = preSolution")
 
     # Write the configuration summary
     for config in env.Configs.values():
-        print("\t\t" + config.Name + "|Win32 = " + config.Name + "|Win32", file=f)
+        lines.append("\t\t" + config.Name + "|Win32 = " + config.Name + "|Win32")
 
-    print("\tEndGlobalSection", file=f)
-    print("\tGlobalSection(ProjectConfigurationPlatforms) = postSolution", file=f)
+    lines.append("\tEndGlobalSection")
+    lines.append("\tGlobalSection(ProjectConfigurationPlatforms) = postSolution")
 
     # Write how each solution configs to each project config
     for name in projects:
         for config in env.Configs.values():
             config_name = config.Name + "|Win32"
             prefix = "\t\t" + guids[name] + "." + config_name
-            print(prefix + ".ActiveCfg = " + config_name, file=f)
-            print(prefix + ".Build.0 = " + config_name, file=f)
+            lines.append(prefix + ".ActiveCfg = " + config_name)
+            lines.append(prefix + ".Build.0 = " + config_name)
 
-    print("\tEndGlobalSection", file=f)
-    print("\tGlobalSection(SolutionProperties) = preSolution", file=f)
-    print("\t\tHideSolutionNode = FALSE", file=f)
-    print("\tEndGlobalSection", file=f)
+    lines.append("\tEndGlobalSection")
+    lines.append("\tGlobalSection(SolutionProperties) = preSolution")
+    lines.append("\t\tHideSolutionNode = FALSE")
+    lines.append("\tEndGlobalSection")
 
     # Record the solution digest
-    print("\tGlobalSection(ExtensibilityGlobals) = postSolution", file=f)
-    print("\t\tPiBDigest = " + digest, file=f)
-    print("\tEndGlobalSection", file=f)
+    lines.append("\tGlobalSection(ExtensibilityGlobals) = postSolution")
+    lines.append("\t\tPiBDigest = " + digest)
+    lines.append("\tEndGlobalSection")
 
-    print("EndGlobal", file=f)
+    lines.append("EndGlobal")
 
-    f.close()
+    WriteIfChanged(sln_path, "\n".join(lines) + "\n")
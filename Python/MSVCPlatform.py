@@ -48,6 +48,10 @@
 
 import os
 import sys
+import glob
+import json
+import hashlib
+import threading
 import Utils
 import Process
 import BuildSystem
@@ -55,6 +59,7 @@ import BuildSystem
 
 VSToolsDir = None
 VCVarsPath = None
+VCVarsArch = "x86"
 VCIncludeDir = None
 VCLibraryDir = None
 VSCRTVer = None
@@ -132,6 +137,89 @@ if VSToolsDir == None:
         VCIncludeDir = os.path.join(VSInstallDir, "VC/include")
         VCLibraryDir = os.path.join(VSInstallDir, "VC/lib")
 
+
+#
+# Cross-compilation from non-Windows hosts uses the LLVM drop-in replacements for the Visual C++ tools,
+# which accept the same command-lines. Headers and libraries come from a copy of the Visual C++ and
+# Windows SDK directories made on a Windows machine, specified with:
+#
+#    -msvc_sysroot <dir>            Root of the copied directories
+#    -msvc_arch {x86|x64}           Target architecture, defaulting to x86 to match vcvarsall
+#
+# Either the layout produced by xwin or a copy of the "VC/Tools/MSVC" and "Windows Kits/10" install
+# directories is recognised. clang-cl embeds debug information in each .obj and lld-link doesn't
+# link incrementally so neither generates the .pdb/.idb/.ilk files that the Microsoft tools do.
+#
+VCSysroot = Utils.GetSysArgvProperty("-msvc_sysroot", os.getenv("PIB_MSVC_SYSROOT"))
+VCSysrootArch = Utils.GetSysArgvProperty("-msvc_arch", "x86")
+VCCrossCompile = VCSysroot != None
+
+if VCCrossCompile:
+    VCCompiler = "clang-cl"
+    VCLinker = "lld-link"
+    VCLibrarian = "llvm-lib"
+else:
+    VCCompiler = "cl.exe"
+    VCLinker = "link.exe"
+    VCLibrarian = "lib.exe"
+
+
+def GetLatestDir(pattern):
+
+    # Version directories sort in release order so the last is the latest
+    dirs = sorted(glob.glob(pattern))
+    return dirs[-1] if len(dirs) else None
+
+
+def GetSysrootDirs(sysroot, arch):
+
+    # xwin names 64-bit directories differently to the Microsoft installs
+    vc_arch = { "x86": "x86", "x64": "x64" }[arch]
+    xwin_arch = { "x86": "x86", "x64": "x86_64" }[arch]
+
+    include_dirs = [ ]
+    lib_dirs = [ ]
+
+    # xwin splat layout
+    include_dirs += [ os.path.join(sysroot, "crt/include") ]
+    include_dirs += [ os.path.join(sysroot, "sdk/include", dir) for dir in [ "ucrt", "um", "shared", "winrt" ] ]
+    lib_dirs += [ os.path.join(sysroot, "crt/lib", xwin_arch) ]
+    lib_dirs += [ os.path.join(sysroot, "sdk/lib", dir, xwin_arch) for dir in [ "um", "ucrt" ] ]
+
+    # Copied install layout
+    vc_dir = GetLatestDir(os.path.join(sysroot, "VC/Tools/MSVC/*"))
+    if vc_dir != None:
+        include_dirs += [ os.path.join(vc_dir, "include") ]
+        lib_dirs += [ os.path.join(vc_dir, "lib", vc_arch) ]
+    sdk_include_dir = GetLatestDir(os.path.join(sysroot, "Windows Kits/10/Include/*"))
+    if sdk_include_dir != None:
+        include_dirs += [ os.path.join(sdk_include_dir, dir) for dir in [ "ucrt", "um", "shared", "winrt" ] ]
+    sdk_lib_dir = GetLatestDir(os.path.join(sysroot, "Windows Kits/10/Lib/*"))
+    if sdk_lib_dir != None:
+        lib_dirs += [ os.path.join(sdk_lib_dir, dir, vc_arch) for dir in [ "um", "ucrt" ] ]
+
+    include_dirs = [ dir for dir in include_dirs if os.path.isdir(dir) ]
+    lib_dirs = [ dir for dir in lib_dirs if os.path.isdir(dir) ]
+    return (include_dirs, lib_dirs)
+
+
+# Arguments that point the LLVM tools at the sysroot and target architecture
+VCSysrootIncludeDirs = [ ]
+VCSysrootLibDirs = [ ]
+VCSysrootTargetArgs = [ ]
+VCSysrootCompileArgs = [ ]
+VCSysrootLibArgs = [ ]
+if VCCrossCompile:
+    (VCSysrootIncludeDirs, VCSysrootLibDirs) = GetSysrootDirs(VCSysroot, VCSysrootArch)
+    if len(VCSysrootIncludeDirs) == 0:
+        print("ERROR: No Visual C++ or Windows SDK directories found in " + VCSysroot)
+    VCSysrootTargetArgs = [ "--target=" + { "x86": "i686", "x64": "x86_64" }[VCSysrootArch] + "-pc-windows-msvc" ]
+    VCSysrootCompileArgs += VCSysrootTargetArgs
+    for dir in VCSysrootIncludeDirs:
+        VCSysrootCompileArgs += [ "/imsvc", dir ]
+    VCSysrootLibArgs = [ "/LIBPATH:" + dir for dir in VCSysrootLibDirs ]
+
+
 # Show chosen environment
 if "-msvc_show_env" in sys.argv:
     print("VSToolsDir = ", VSToolsDir)
@@ -139,10 +227,9 @@ if "-msvc_show_env" in sys.argv:
     print("VCVarsPath = ", VCVarsPath)
     print("VCIncludeDir = ", VCIncludeDir)
     print("VCLibraryDir = ", VCLibraryDir)
-
-if VSToolsDir == None:
-    print("ERROR: Failed to find installed Visual Studio")
-    sys.exit(1)
+    print("VCSysroot = ", VCSysroot)
+    print("VCSysrootIncludeDirs = ", VCSysrootIncludeDirs)
+    print("VCSysrootLibDirs = ", VCSysrootLibDirs)
 
 
 #
@@ -167,7 +254,7 @@ def GetVisualCEnv():
         return None
 
     # Run the batch file, output the environment and prepare it for parsing
-    process = Process.OpenPiped(VCVarsPath + " x86 & echo ===ENVBEGIN=== & set")
+    process = Process.OpenPiped(VCVarsPath + " " + VCVarsArch + " & echo ===ENVBEGIN=== & set")
     output = Process.WaitForPipeOutput(process)
     output = output.split("===ENVBEGIN=== \r\n")[1]
     output = output.splitlines()
@@ -189,6 +276,89 @@ def GetVisualCEnv():
     return env
 
 
+#
+# Running vcvarsall.bat takes seconds so its environment is cached per-user and shared by all projects.
+# Entries are keyed on a fingerprint of everything that changes the environment, so that toolchain
+# updates are picked up without any manual invalidation.
+#
+class ToolchainEnvCache:
+
+    DefaultDir = os.getenv("PIB_TOOLCHAIN_CACHE", os.path.join(os.path.expanduser("~"), ".pib", "toolchains"))
+
+    def __init__(self, cache_dir = DefaultDir):
+
+        self.CacheDir = cache_dir
+
+    def GetFilename(self, fingerprint):
+
+        key = hashlib.sha256(bytes(json.dumps(fingerprint), "utf-8")).hexdigest()[:24]
+        return os.path.join(self.CacheDir, key + ".json")
+
+    def Read(self, fingerprint):
+
+        # Unreadable entries are treated as missing and replaced
+        try:
+            with open(self.GetFilename(fingerprint), "r") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if entry.get("fingerprint") != fingerprint:
+            return None
+        return entry.get("env")
+
+    def Write(self, fingerprint, env):
+
+        # Written whole and moved into place as other builds may be reading it
+        Utils.Makedirs(self.CacheDir)
+        filename = self.GetFilename(fingerprint)
+        temp_filename = filename + "." + str(os.getpid()) + ".tmp"
+        with open(temp_filename, "w") as f:
+            json.dump({ "fingerprint": fingerprint, "env": env }, f)
+        os.replace(temp_filename, filename)
+
+    def Get(self, fingerprint, provider):
+
+        env = self.Read(fingerprint)
+        if env == None:
+            env = provider()
+            if env != None:
+                self.Write(fingerprint, env)
+        return env
+
+    def GetAsync(self, fingerprint, provider):
+
+        #
+        # Starts fetching the environment on a thread so that other startup work can overlap with it.
+        # Returns a function that waits for and returns the result.
+        #
+        result = [ None ]
+        def Fetch():
+            result[0] = self.Get(fingerprint, provider)
+        thread = threading.Thread(target = Fetch, daemon = True)
+        thread.start()
+
+        def Wait():
+            thread.join()
+            return result[0]
+        return Wait
+
+
+def GetVisualCEnvFingerprint():
+
+    # The batch file changes with each toolchain update
+    mod_time = None
+    if VCVarsPath != None and os.path.exists(VCVarsPath):
+        mod_time = os.path.getmtime(VCVarsPath)
+    return [ VCVarsPath, mod_time, VCVarsArch, Utils.GetSysArgvProperty("-msvc_ver") ]
+
+
+def GetCachedVisualCEnvAsync(cache = None):
+
+    if cache == None:
+        cache = ToolchainEnvCache()
+    return cache.GetAsync(GetVisualCEnvFingerprint(), GetVisualCEnv)
+
+
 #
 # Visual C++ Compiler (cl.exe)
 #
@@ -228,17 +398,20 @@ def GetVisualCEnv():
 #    /MTd                           References multi-threaded LIBCMTD.lib, code is linked statically. Defines _DEBUG, _MT.
 #
 #    /Fopathname                    Specifies the output .obj file
-#    /Fppathname                    Provides a path name for a precompiled header instead of using the default payh name
+#    /Fppathname                    Provides a path name for a precompiled header instead of using the default path name
 #    /Fdpathname                    Specifies a name for the PDB file
 #
 #    /GS[-]                         Detects buffer overruns that overwrite the return address (on by default)
 #    /RTC{c|s|u}                    Controls runtime error checking
+#    /Z7                            Produce debugging info in .obj files
 #    /Zi                            Produce debugging info in PDB files
 #    /ZI                            Produce debugging info in PDB files with edit and continue (X86 ONLY)
 #
 #    /D[= | #[{string|number}] ]    Defines a preprocessing symbol for your source file
 #    /I[ ]directory                 Adds a directory to the list of directories searched for include files
 #
+#    /FI[ ]filename                 Preprocess the specified include file before the source file
+#
 #    /Y-                            Ignores all other PCH compiler options in the current build
 #    /Yc[filename]                  Create a PCH
 #    /Yu[filename]                  Use a PCH
@@ -287,6 +460,7 @@ VCOptimisations = Utils.enum(
 
 VCDebuggingInfo = Utils.enum(
     DISABLE = None,
+    OBJ = '/Z7',
     PDB = '/Zi',
     PDBEDITANDCONTINUE = '/ZI'
 )
@@ -314,10 +488,12 @@ VCStandard = Utils.enum(
 )
 
 
-class VCCompileOptions:
+class VCCompileOptions (Utils.CommandLineOptions):
 
     def __init__(self, config):
 
+        super().__init__()
+
         # Initialise the requested config settings
         if config == VCBaseConfig.DEBUG:
             self.InitDebug()
@@ -352,6 +528,7 @@ class VCCompileOptions:
         self.WarningsAsErrors = False
         self.WholeProgramOptimisation = False
         self.Standard = None
+        self.ForcedIncludes = [ ]
         self.UpdateCommandLine()
 
     def InitRelease(self):
@@ -368,7 +545,7 @@ class VCCompileOptions:
         self.Defines.extend( [ 'NDEBUG' ])
         self.UpdateCommandLine()
 
-    def UpdateCommandLine(self):
+    def BuildCommandLine(self):
 
         # Compile only & we need showIncludes for dependency evaluation
         # Complete exception handling
@@ -409,8 +586,9 @@ class VCCompileOptions:
 
         cmdline += [ self.CallingConvention ]
 
+        # clang-cl only writes debugging info to the .obj
         if self.DebuggingInfo != None:
-            cmdline += [ self.DebuggingInfo ]
+            cmdline += [ '/Z7' if VCCrossCompile else self.DebuggingInfo ]
 
         if self.RuntimeChecks:
             cmdline += [ "/RTC1" ]
@@ -435,6 +613,9 @@ class VCCompileOptions:
         for include in self.IncludePaths:
             cmdline += [ '/I', include ]
 
+        for include in self.ForcedIncludes:
+            cmdline += [ '/FI' + include ]
+
         if self.ReportClassLayout:
             cmdline += [ '/d1reportAllClassLayout' ]
 
@@ -450,7 +631,7 @@ class VCCompileOptions:
         if self.Standard != None:
             cmdline += [ self.Standard ]
 
-        self.CommandLine = cmdline
+        return cmdline
 
 
 #
@@ -518,10 +699,12 @@ VCSubsystem = Utils.enum(
 )
 
 
-class VCLinkOptions:
+class VCLinkOptions (Utils.CommandLineOptions):
 
     def __init__(self, config):
 
+        super().__init__()
+
         # Initialise the requested config settings
         if config == VCBaseConfig.DEBUG:
             self.InitDebug()
@@ -560,13 +743,16 @@ class VCLinkOptions:
         self.DupComdats = VCDupComdats.FOLD
         self.UpdateCommandLine()
 
-    def UpdateCommandLine(self):
+    def BuildCommandLine(self):
 
         cmdline = [
             '/ERRORREPORT:NONE',    # Don't send any ICEs to Microsoft
-            '/VERBOSE:LIB'          # Show libs searched for dependency evaluation
         ]
 
+        # Show libs searched for dependency evaluation, lld-link doesn't report them
+        if not VCCrossCompile:
+            cmdline += [ '/VERBOSE:LIB' ]
+
         if self.SafeSEH:
             cmdline += [ "/SAFESEH" ]
 
@@ -609,7 +795,7 @@ class VCLinkOptions:
         for path in self.LibPaths:
             cmdline += [ "/LIBPATH:" + path ]
 
-        self.CommandLine = cmdline
+        return cmdline
 
 
 #
@@ -639,10 +825,12 @@ class VCLinkOptions:
 #    /OUT:"D:\dev\projects\TestProject\Release\TestProject.lib" /NOLOGO /LTCG
 #
 
-class VCLibOptions:
+class VCLibOptions (Utils.CommandLineOptions):
 
     def __init__(self, config):
 
+        super().__init__()
+
         # Initialise the requested config settings
         if config == VCBaseConfig.DEBUG:
             self.InitDebug()
@@ -669,7 +857,7 @@ class VCLibOptions:
         self.LTCG = True
         self.UpdateCommandLine()
 
-    def UpdateCommandLine(self):
+    def BuildCommandLine(self):
 
         cmdline = [
             '/ERRORREPORT:NONE'     # Don't send ICEs to Microsoft
@@ -699,7 +887,7 @@ class VCLibOptions:
         if self.NoDefaultLibs:
             cmdline += [ "/NODEFAULTLIB" ]
 
-        self.CommandLine = cmdline
+        return cmdline
 
 
 #
@@ -707,22 +895,24 @@ class VCLibOptions:
 #
 class VCCompileNode (BuildSystem.Node):
 
-    def __init__(self, path, override_cpp_opts):
+    def __init__(self, path, override_cpp_opts, pch = None):
 
         super().__init__()
         self.Path = path
         self.OverrideCPPOptions = override_cpp_opts
+        self.PCH = None
+        self.SetPCH(pch)
 
     def Build(self, env):
 
-        output_files = self.GetOutputFiles(env)
+        # Distributed builds preprocess here and compile elsewhere
+        if env.Distributor != None and self.CanDistribute(env):
+            return env.Distributor.Compile(env, self)
+
+        return self.RunCompiler(env, self.GetCommandLine(env))
+
+    def RunCompiler(self, env, cmdline):
 
-        # Construct the command-line
-        cpp_opts = self.GetCPPOptions(env)
-        cmdline = [ "cl.exe" ] + cpp_opts.CommandLine
-        if len(output_files) > 1:
-            cmdline += [ "/Fd" + output_files[1] ]
-        cmdline += [ "/Fo" + output_files[0], self.GetInputFile(env) ]
         Utils.ShowCmdLine(env, cmdline)
 
         # Create the include scanner and launch the compiler
@@ -737,6 +927,59 @@ class VCCompileNode (BuildSystem.Node):
 
         return process.returncode == 0
 
+    def CanDistribute(self, env):
+
+        # Precompiled headers and PDBs are shared between compiles so can't be built elsewhere
+        cpp_opts = self.GetCPPOptions(env)
+        return self.PCH == None and (cpp_opts.DebuggingInfo in (None, VCDebuggingInfo.OBJ) or VCCrossCompile)
+
+    def GetPreprocessedFile(self, env):
+
+        return os.path.splitext(self.GetOutputFiles(env)[0])[0] + ".i"
+
+    def Preprocess(self, env, preprocessed_file):
+
+        cpp_opts = self.GetCPPOptions(env)
+        cpp_opts.UpdateCommandLine()
+        cmdline = [ VCCompiler ] + VCSysrootCompileArgs + cpp_opts.CommandLine
+        cmdline += [ "/P", "/Fi" + preprocessed_file, self.GetInputFile(env) ]
+        return self.RunCompiler(env, cmdline)
+
+    def GetRemoteCommandLine(self, env):
+
+        cpp_opts = self.GetCPPOptions(env)
+        cpp_opts.UpdateCommandLine()
+
+        # Includes and defines have already been applied
+        cmdline = [ VCCompiler ] + VCSysrootTargetArgs
+        options = iter(cpp_opts.CommandLine)
+        for option in options:
+            if option == "/I" or option == "/D":
+                next(options)
+            elif option != "/showIncludes" and not option.startswith("/FI"):
+                cmdline += [ option ]
+
+        # The .i extension isn't recognised as C++ source
+        if not cpp_opts.CompileAsC:
+            cmdline += [ "/TP" ]
+
+        return cmdline
+
+    def GetCommandLine(self, env):
+
+        output_files = self.GetOutputFiles(env)
+
+        # Construct the command-line
+        cpp_opts = self.GetCPPOptions(env)
+        cpp_opts.UpdateCommandLine()
+        cmdline = [ VCCompiler ] + VCSysrootCompileArgs + cpp_opts.CommandLine
+        cmdline += self.GetPCHCommandLine(env)
+        pdb_file = self.GetPDBFile(env)
+        if pdb_file != None:
+            cmdline += [ "/Fd" + pdb_file ]
+        cmdline += [ "/Fo" + output_files[0], self.GetInputFile(env) ]
+        return cmdline
+
     def SetCPPOptions(self, override_cpp_opts):
 
         self.OverrideCPPOptions = override_cpp_opts
@@ -745,6 +988,21 @@ class VCCompileNode (BuildSystem.Node):
 
         return env.CurrentConfig.CPPOptions if self.OverrideCPPOptions is None else self.OverrideCPPOptions
 
+    def SetPCH(self, pch):
+
+        # Swap the explicit dependency on any previous precompiled header
+        if self.PCH in self.Dependencies:
+            self.Dependencies.remove(self.PCH)
+        self.PCH = pch
+        if pch != None:
+            self.Dependencies.append(pch)
+
+    def GetPCHCommandLine(self, env):
+
+        if self.PCH == None:
+            return [ ]
+        return self.PCH.GetUseCommandLine(env)
+
     def GetInputFile(self, env):
 
         return self.Path
@@ -757,24 +1015,96 @@ class VCCompileNode (BuildSystem.Node):
 
         files = [ path + ".obj" ]
 
-        cpp_opts = self.GetCPPOptions(env)
-        if cpp_opts.DebuggingInfo != None:
-
-            # The best we can do here is ensure that the obj\src directory for
-            # a group of files shares the same pdb/idb
-            path = os.path.dirname(path)
-            files += [ os.path.join(path, "vc100.pdb") ]
+        pdb_file = self.GetPDBFile(env)
+        if pdb_file != None:
+            files += [ pdb_file ]
 
-            if cpp_opts.DebuggingInfo == VCDebuggingInfo.PDBEDITANDCONTINUE:
-                files += [ os.path.join(path, "vc100.idb") ]
+            if self.GetCPPOptions(env).DebuggingInfo == VCDebuggingInfo.PDBEDITANDCONTINUE:
+                files += [ os.path.join(os.path.dirname(pdb_file), "vc100.idb") ]
 
         return files
 
+    def GetPDBFile(self, env):
+
+        # /Z7 writes debugging info to the .obj, with no PDB
+        cpp_opts = self.GetCPPOptions(env)
+        if cpp_opts.DebuggingInfo in (None, VCDebuggingInfo.OBJ) or VCCrossCompile:
+            return None
+
+        # Compiles using a precompiled header must write to the PDB it was built with, which the
+        # dependency on the PCH node ensures exists before they start
+        if self.PCH != None:
+            return self.PCH.GetPDBFile(env)
+
+        # The best we can do here is ensure that the obj\src directory for
+        # a group of files shares the same pdb/idb
+        path = os.path.join(env.CurrentConfig.IntermediatePath, os.path.dirname(self.Path))
+        return os.path.join(path, "vc100.pdb")
+
     def GetTempOutputFiles(self, env):
 
         return [ self.GetOutputFiles(env)[0] ]
 
 
+#
+# A node for creating a precompiled header from a single C/C++ file that includes the header.
+# The .obj output is kept as the first output so that this node can be passed to the linker
+# alongside the other object files; it carries the debug information the .pch refers to.
+#
+# Compile nodes that use the .pch depend on this node so that they're rebuilt when the
+# header, or anything it includes, changes. Any compile nodes using the .pch must be built
+# with the same options as this node and, with PDB debugging info, write to the same PDB,
+# wherever they are.
+#
+class VCPCHNode (VCCompileNode):
+
+    def __init__(self, path, header, override_cpp_opts, force_include = False):
+
+        super().__init__(path, override_cpp_opts)
+        self.Header = header
+        self.ForceInclude = force_include
+
+    def CanDistribute(self, env):
+
+        return False
+
+    def GetPCHCommandLine(self, env):
+
+        cmdline = [ "/Yc" + self.Header, "/Fp" + self.GetPCHFile(env) ]
+        if self.ForceInclude:
+            cmdline += [ "/FI" + self.Header ]
+        return cmdline
+
+    def GetUseCommandLine(self, env):
+
+        cmdline = [ "/Yu" + self.Header, "/Fp" + self.GetPCHFile(env) ]
+        if self.ForceInclude:
+            cmdline += [ "/FI" + self.Header ]
+        return cmdline
+
+    def GetPCHFile(self, env):
+
+        path = os.path.splitext(self.Path)[0]
+        path = os.path.join(env.CurrentConfig.IntermediatePath, path)
+        return path + ".pch"
+
+    def GetOutputFiles(self, env):
+
+        return super().GetOutputFiles(env) + [ self.GetPCHFile(env) ]
+
+    def GetTempOutputFiles(self, env):
+
+        return [ self.GetOutputFiles(env)[0], self.GetPCHFile(env) ]
+
+    def GetContentHashFiles(self, env):
+
+        return [ self.GetOutputFiles(env)[0], self.GetPCHFile(env) ]
+
+    def __repr__(self):
+
+        return "PCH: " + self.Path
+
+
 #
 # A node for linking an EXE or DLL given an output path and list of dependencies
 #
@@ -795,14 +1125,7 @@ class VCLinkNode (BuildSystem.Node):
         output_files = self.GetOutputFiles(env)
         Utils.Print(env, "Linking: " + output_files[0] + "\n")
 
-        # Construct the command-line
-        cmdline = [ "link.exe" ] + env.CurrentConfig.LinkOptions.CommandLine
-        cmdline += [ '/OUT:' + output_files[0] ]
-        if env.CurrentConfig.LinkOptions.MapFile:
-            cmdline += [ "/MAP:" + output_files[1] ]
-        cmdline += [ dep.GetOutputFiles(env)[0] for dep in self.Dependencies ]
-        cmdline += [ dep.GetOutputFiles(env)[0] for dep in self.LibFiles ]
-        cmdline += [ dep.GetOutputFiles(env)[0] for dep in self.WeakLibFiles ]
+        cmdline = self.GetCommandLine(env)
         Utils.ShowCmdLine(env, cmdline)
 
         #
@@ -822,13 +1145,18 @@ class VCLinkNode (BuildSystem.Node):
         process = Process.OpenPiped(cmdline, env.EnvironmentVariables)
         Process.PollPipeOutput(process, scanner)
 
+        # lld-link doesn't report the libraries it searches so locate them the same way it would
+        lib_paths = scanner.Includes
+        if VCCrossCompile:
+            lib_paths = self.FindLibFiles(env)
+
         #
         # Weak library files are those that should be provided as input to the link step but not used
         # as dependencies to check if the link step needs to be rebuilt. Search for those in the scanner
         # output and exclude them from the implicit dependency list.
         #
         includes = [ ]
-        for include in scanner.Includes:
+        for include in lib_paths:
 
             ignore_dep = False
             for lib in self.WeakLibFiles:
@@ -846,6 +1174,38 @@ class VCLinkNode (BuildSystem.Node):
 
         return process.returncode == 0
 
+    def GetCommandLine(self, env):
+
+        output_files = self.GetOutputFiles(env)
+
+        # Construct the command-line
+        link_opts = env.CurrentConfig.LinkOptions
+        link_opts.UpdateCommandLine()
+        cmdline = [ VCLinker ] + link_opts.CommandLine + VCSysrootLibArgs
+        cmdline += [ '/OUT:' + output_files[0] ]
+        if link_opts.MapFile:
+            cmdline += [ "/MAP:" + output_files[1] ]
+        cmdline += [ dep.GetOutputFiles(env)[0] for dep in self.Dependencies ]
+        cmdline += [ dep.GetOutputFiles(env)[0] for dep in self.LibFiles ]
+        cmdline += [ dep.GetOutputFiles(env)[0] for dep in self.WeakLibFiles ]
+        return cmdline
+
+    def FindLibFiles(self, env):
+
+        # Libraries are searched for in the working directory, then the user paths, then the sysroot
+        search_paths = [ "" ] + env.CurrentConfig.LinkOptions.LibPaths + VCSysrootLibDirs
+
+        lib_files = [ ]
+        for dep in self.LibFiles + self.WeakLibFiles:
+            filename = dep.GetOutputFiles(env)[0]
+            for path in search_paths:
+                lib_file = os.path.join(path, filename)
+                if os.path.exists(lib_file):
+                    lib_files += [ lib_file ]
+                    break
+
+        return lib_files
+
     def GetInputFile(self, env):
 
         path = os.path.join(env.CurrentConfig.OutputPath, self.Path)
@@ -878,11 +1238,30 @@ class VCLinkNode (BuildSystem.Node):
         if env.CurrentConfig.LinkOptions.Debug:
             files += [ path + ".pdb" ]
 
-        if env.CurrentConfig.LinkOptions.Incremental:
+        if env.CurrentConfig.LinkOptions.Incremental and not VCCrossCompile:
             files += [ path + ".ilk" ]
 
         return files
 
+    def GetCleanFiles(self, env):
+
+        # DLLs are also written with an import library and exports file
+        files = self.GetOutputFiles(env)
+        (path, ext) = self.GetPrimaryOutput(env.CurrentConfig)
+        if ext == ".dll":
+            files += [ path + ".lib", path + ".exp" ]
+        return files
+
+    def GetContentHashFiles(self, env):
+
+        # Anything linking with a DLL only needs relinking when its exported interface changes, which
+        # is what the import library hash captures. Nodes that use the DLL file itself, like copies,
+        # still see its modification time change.
+        (path, ext) = self.GetPrimaryOutput(env.CurrentConfig)
+        if ext == ".dll":
+            return [ path + ".lib" ]
+        return self.GetOutputFiles(env)[:1]
+
     def __repr__(self):
 
         return "LINK: " + self.Path
@@ -906,11 +1285,7 @@ class VCLibNode (BuildSystem.Node):
 
         output_files = self.GetOutputFiles(env)
 
-        # Construct the command-line
-        cmdline = [ "lib.exe" ] + env.CurrentConfig.LibOptions.CommandLine
-        cmdline += [ '/OUT:' + output_files[0] ]
-        cmdline += [ dep.GetOutputFiles(env)[0] for dep in self.Dependencies ]
-        cmdline += [ dep.GetOutputFiles(env)[0] for dep in self.LibFiles ]
+        cmdline = self.GetCommandLine(env)
         Utils.Print(env, "Librarian: " + output_files[0])
         Utils.ShowCmdLine(env, cmdline)
 
@@ -922,6 +1297,19 @@ class VCLibNode (BuildSystem.Node):
 
         return process.returncode == 0
 
+    def GetCommandLine(self, env):
+
+        output_files = self.GetOutputFiles(env)
+
+        # Construct the command-line
+        lib_opts = env.CurrentConfig.LibOptions
+        lib_opts.UpdateCommandLine()
+        cmdline = [ VCLibrarian ] + lib_opts.CommandLine + VCSysrootLibArgs
+        cmdline += [ '/OUT:' + output_files[0] ]
+        cmdline += [ dep.GetOutputFiles(env)[0] for dep in self.Dependencies ]
+        cmdline += [ dep.GetOutputFiles(env)[0] for dep in self.LibFiles ]
+        return cmdline
+
     def GetInputFile(self, env):
 
         path = os.path.join(env.CurrentConfig.OutputPath, self.Path)
@@ -940,6 +1328,17 @@ class VCLibNode (BuildSystem.Node):
         return [ path + ext ]
 
 
+# Toolchain interface used by the environment
+BaseConfig = VCBaseConfig
+CompileOptions = VCCompileOptions
+LinkOptions = VCLinkOptions
+LibOptions = VCLibOptions
+CompileNode = VCCompileNode
+PCHNode = VCPCHNode
+LinkNode = VCLinkNode
+LibNode = VCLibNode
+
+
 def __RunTests():
 
     options = VCCompileOptions(VCBaseConfig.DEBUG)
@@ -60,10 +60,7 @@ class BuildOpenCLNode (BuildSystem.Node):
 
     def Build(self, env):
 
-        # Build command-line from current configuration
-        cmdline = [ os.path.join(_InstallPath, "oclpc.exe") ]
-        cmdline += env.CurrentConfig.OpenCLCompileOptions.CommandLine
-        cmdline += [ self.GetInputFile(env) ]
+        cmdline = self.GetCommandLine(env)
         Utils.ShowCmdLine(env, cmdline)
 
         # Launch the compiler and wait for it to finish
@@ -80,6 +77,14 @@ class BuildOpenCLNode (BuildSystem.Node):
 
         return process.returncode == 0
 
+    def GetCommandLine(self, env):
+
+        # Build command-line from current configuration
+        cmdline = [ os.path.join(_InstallPath, "oclpc.exe") ]
+        cmdline += env.CurrentConfig.OpenCLCompileOptions.CommandLine
+        cmdline += [ self.GetInputFile(env) ]
+        return cmdline
+
     def GetInputFile(self, env):
 
         return self.Source.GetOutputFiles(env)[0]
@@ -26,70 +26,260 @@
 # Packages.py: Experimental, simple package "manager"
 #
 
-import io
 import os
 import shutil
+import glob
+import json
+import hashlib
 import tempfile
+import threading
+import time
+import http.client
+import urllib.error
+import urllib.parse
 import urllib.request
 import zipfile
+import concurrent.futures
 
+import BuildSystem
 import Process
 import Utils
 
-def DownloadFile(url):
-    # Generate a temporary download location
-    filename = os.path.join(tempfile._get_default_tempdir(), next(tempfile._get_candidate_names()))
+# Completed downloads are kept here, keyed by URL and expected hash
+DownloadCacheDir = os.getenv("PIB_DOWNLOAD_CACHE", os.path.join(tempfile.gettempdir(), "pib_downloads"))
+
+DownloadBlockSize = 1024 * 1024
+
+class DownloadProgress:
+    def __init__(self, length):
+        self.Length = length
+        self.Size = 0
+        self.Percent = -1
+        self.Lock = threading.Lock()
+
+    def Add(self, size):
+        # Display progress percentage as it changes
+        with self.Lock:
+            self.Size += size
+            if self.Length:
+                percent = int(self.Size / self.Length * 100)
+                if percent != self.Percent:
+                    self.Percent = percent
+                    print(f"\t{percent} %\r", end="")
+
+def DownloadRange(url, filename, start, end, progress):
+    # Resume from whatever a previous, interrupted attempt left behind
+    have = os.path.getsize(filename) if os.path.exists(filename) else 0
+    if end != None and start + have >= end:
+        progress.Add(have)
+        return
+
+    request = urllib.request.Request(url)
+    if start + have > 0 or end != None:
+        range_end = str(end - 1) if end != None else ""
+        request.add_header("Range", f"bytes={start + have}-{range_end}")
+
+    with urllib.request.urlopen(request) as response:
+        # Servers that ignore the range send everything again
+        mode = "ab"
+        if response.status != 206:
+            if start > 0:
+                raise ValueError(f"Server ignored range request for {url}")
+            mode = "wb"
+            have = 0
+        progress.Add(have)
+
+        # Without a range the response says how much to expect, if anything
+        expected = end - start if end != None else None
+        content_length = response.getheader("content-length")
+        if expected == None and content_length:
+            expected = have + int(content_length)
+
+        # Stream blocks straight to disk, stopping at the end of the range
+        remaining = end - start - have if end != None else None
+        with open(filename, mode) as f:
+            while remaining == None or remaining > 0:
+                block_size = DownloadBlockSize if remaining == None else min(DownloadBlockSize, remaining)
+                block_buffer = response.read(block_size)
+                if not block_buffer:
+                    break
+                f.write(block_buffer)
+                progress.Add(len(block_buffer))
+                if remaining != None:
+                    remaining -= len(block_buffer)
+
+    # Connections can close early without error, leaving what was received to resume from
+    size = os.path.getsize(filename)
+    if expected != None and size != expected:
+        raise ValueError(f"Download of {url} received {size} bytes of range {start}-{start + expected}")
+
+def HashFile(filename):
+    sha256 = hashlib.sha256()
+    with open(filename, "rb") as f:
+        while True:
+            block_buffer = f.read(DownloadBlockSize)
+            if not block_buffer:
+                break
+            sha256.update(block_buffer)
+    return sha256.hexdigest()
+
+def GetDownloadFilename(url, sha256=None, cache_dir=None):
+    # Files are cached by URL and, when given, their expected hash
+    if cache_dir == None:
+        cache_dir = DownloadCacheDir
+    key = hashlib.sha256(bytes(url + (sha256 or ""), "utf-8")).hexdigest()[:24]
+    basename = os.path.basename(urllib.parse.urlparse(url).path)
+    return os.path.join(cache_dir, f"{key}-{basename}")
+
+def DownloadFile(url, sha256=None, connections=1, cache_dir=None):
+    filename = GetDownloadFilename(url, sha256, cache_dir)
+    cache_dir = os.path.dirname(filename)
+
+    if os.path.exists(filename):
+        print(f"Using cached download of {url}")
+        return filename
 
     print(f"Downloading {url}")
+    Utils.Makedirs(cache_dir)
 
-    # Query server for download
-    response = urllib.request.urlopen(url)
-    length = response.getheader("content-length")
+    # Query server for download, not all of which answer HEAD requests
+    length = None
+    accept_ranges = None
+    try:
+        request = urllib.request.Request(url, method="HEAD")
+        with urllib.request.urlopen(request) as response:
+            length = response.getheader("content-length")
+            accept_ranges = response.getheader("accept-ranges")
+    except urllib.error.HTTPError:
+        pass
 
-    # Determine download block size for progress
     if length:
         print(f"   Size: {length} bytes")
         length = int(length)
-        block_size = max(4096, length // 100)
     else:
         print("   Size Unknown")
-        block_size = 1024 * 1024
-
-    # Download in blocks
-    buffer = io.BytesIO()
-    size = 0
-    while True:
-        block_buffer = response.read(block_size)
-        if not block_buffer:
-            break
-        buffer.write(block_buffer)
-        size += len(block_buffer)
-
-        # Display progress percentage
-        if length:
-            print(f"\t{int(size / length * 100)} %\r", end="")
+
+    # Split into ranged fetches when the server supports them, each written to its own part file
+    ranges = [ (0, length if accept_ranges == "bytes" else None) ]
+    if connections > 1 and length and accept_ranges == "bytes":
+        range_size = (length + connections - 1) // connections
+        ranges = [ (start, min(start + range_size, length)) for start in range(0, length, range_size) ]
+    parts = [ f"{filename}.part{r[0]}-{r[1] if r[1] != None else ''}" for r in ranges ]
+
+    # Parts left by an attempt that split the download differently can't be resumed from
+    for part in glob.glob(glob.escape(filename) + ".part*"):
+        if part not in parts:
+            Utils.RemoveFile(part)
+
+    progress = DownloadProgress(length)
+    if len(ranges) == 1:
+        DownloadRange(url, parts[0], ranges[0][0], ranges[0][1], progress)
+    else:
+        with concurrent.futures.ThreadPoolExecutor(len(ranges)) as executor:
+            futures = [ executor.submit(DownloadRange, url, part, r[0], r[1], progress) for part, r in zip(parts, ranges) ]
+            for future in futures:
+                future.result()
 
     # Clear progress line
     print()
 
-    # Write download to file
-    with open(filename, "wb") as f:
-        f.write(buffer.getbuffer())
+    # Join the parts
+    download = filename + ".download"
+    if len(parts) == 1:
+        os.replace(parts[0], download)
+    else:
+        with open(download, "wb") as f:
+            for part in parts:
+                with open(part, "rb") as part_file:
+                    shutil.copyfileobj(part_file, f, DownloadBlockSize)
+        for part in parts:
+            Utils.RemoveFile(part)
+
+    # Never cache a download that doesn't match the advertised size
+    size = os.path.getsize(download)
+    if length and size != length:
+        Utils.RemoveFile(download)
+        raise ValueError(f"Download of {url} is {size} bytes, expected {length}")
+
+    # Only verified downloads make it into the cache
+    if sha256 != None:
+        digest = HashFile(download)
+        if digest != sha256.lower():
+            print(f"ERROR: Download of {url} has hash {digest}, expected {sha256}")
+            Utils.RemoveFile(download)
+            return None
 
+    os.replace(download, filename)
     return filename
 
-def ExtractZipFileTo(filename, path):
-    # Extract entire zip file
+# Each extraction records the archive it came from and what it contains in this file
+ExtractManifestName = ".pibextract"
+
+def ReadExtractManifest(path):
+    try:
+        with open(os.path.join(path, ExtractManifestName), "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return { "archive": None, "members": { } }
+
+def WriteExtractManifest(path, manifest):
+    filename = os.path.join(path, ExtractManifestName)
+    with open(filename + ".tmp", "w") as f:
+        json.dump(manifest, f)
+    os.replace(filename + ".tmp", filename)
+
+def ExtractZipMembers(filename, path, names):
+    # Zip files can't be read from several threads at once so each thread opens its own
+    local = threading.local()
+    handles = [ ]
+    def Extract(name):
+        if not hasattr(local, "zf"):
+            local.zf = zipfile.ZipFile(filename)
+            handles.append(local.zf)
+        local.zf.extract(name, path)
+
+    try:
+        with concurrent.futures.ThreadPoolExecutor(min(os.cpu_count(), max(1, len(names)))) as executor:
+            for future in [ executor.submit(Extract, name) for name in names ]:
+                future.result()
+    finally:
+        for zf in handles:
+            zf.close()
+
+def ExtractZipFileTo(filename, path, archive_hash=None):
+    # Skip archives that were already extracted here
+    if archive_hash == None:
+        archive_hash = HashFile(filename)
+    manifest = ReadExtractManifest(path)
+    if manifest["archive"] == archive_hash:
+        return path
+
     print(f"Extracting {filename} to {path}")
     with zipfile.ZipFile(filename) as zf:
-        zf.extractall(path)
+        infos = [ info for info in zf.infolist() if not info.is_dir() ]
+        members = { info.filename: [ info.CRC, info.file_size ] for info in infos }
 
+    # Only extract members that are missing or changed since the last extraction
+    old_members = manifest["members"]
+    names = [ ]
+    for name, member in members.items():
+        if old_members.get(name) != member or not os.path.exists(os.path.join(path, name)):
+            names.append(name)
+
+    # Remove members that are no longer in the archive
+    for name in old_members:
+        if name not in members:
+            Utils.RemoveFile(os.path.join(path, name))
+
+    Utils.Makedirs(path)
+    ExtractZipMembers(filename, path, names)
+
+    WriteExtractManifest(path, { "archive": archive_hash, "members": members })
     return path
 
 def ExtractZipFile(filename):
-    # Generate a temporary extract location
-    path = os.path.join(tempfile._get_default_tempdir(), next(tempfile._get_candidate_names()))
-    return ExtractZipFileTo(filename, path)
+    # Extract once into the package store, shared by every caller
+    return GetStoredPackagePath(StorePackage(filename))
 
 def ExtractMsiFileTo(filename, path):
     print(f"Extracting {filename} to {path}")
@@ -97,13 +287,14 @@ def ExtractMsiFileTo(filename, path):
     return path
 
 def ExtractMsiFile(filename):
-    path = os.path.join(tempfile._get_default_tempdir(), next(tempfile._get_candidate_names()))
-    return ExtractMsiFileTo(filename, path)
+    return GetStoredPackagePath(StorePackage(filename, ExtractMsiFileTo))
 
 # 7-Zip not installed by default
 SevenZipExe = None
 
 def Install7Zip(version, path):
+    global SevenZipExe
+
     # See if 7zip is already there first
     SevenZipExe = os.path.join(path, f"7zip\\{version}\\7za.exe")
     if not os.path.exists(SevenZipExe):
@@ -127,3 +318,246 @@ def Extract7ZipFileTo(filename, path):
     command_line = f"{SevenZipExe} x -o{path} {filename}"
     process = Process.OpenPiped(command_line)
     Process.PollPipeOutput(process, lambda t: print(t.strip("\r\n")))
+
+#
+# Machine-level store of extracted packages, shared by all workspaces. Each package is extracted once
+# into a directory named by its archive hash and workspaces get views of it, either a directory symlink
+# or a tree of hardlinks. Views are recorded as references to the package and CollectPackages, run
+# with "PiB -collect_packages", removes packages that no view refers to any more.
+#
+# Files in a view are the stored files so they must not be modified.
+#
+PackageStoreDir = os.getenv("PIB_PACKAGE_STORE", os.path.join(os.path.expanduser("~"), ".pib", "packages"))
+
+# Written into each stored package so that a view can tell which package it shows
+PackageIdName = ".pibpackage"
+
+# Packages stored this recently aren't collected, as their first view may still be on its way
+PackageCollectGraceSeconds = 3600
+
+def GetStoredPackagePath(package_hash):
+    return os.path.join(PackageStoreDir, package_hash[:24])
+
+def GetPackageRefsPath(package_hash):
+    return os.path.join(PackageStoreDir, "refs", package_hash[:24])
+
+def GetViewPackage(path):
+    try:
+        with open(os.path.join(path, PackageIdName), "r") as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+def StorePackage(filename, extract=None):
+    package_hash = HashFile(filename)
+    path = GetStoredPackagePath(package_hash)
+    if GetViewPackage(path) == package_hash:
+        return package_hash
+
+    # Extract somewhere private and move into place so that no process sees a partial package
+    temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}"
+    shutil.rmtree(temp_path, ignore_errors=True)
+    if extract == None:
+        ExtractZipFileTo(filename, temp_path, package_hash)
+    else:
+        extract(filename, temp_path)
+    with open(os.path.join(temp_path, PackageIdName), "w") as f:
+        f.write(package_hash)
+
+    # Leftovers of an interrupted store have no id
+    if os.path.exists(path) and GetViewPackage(path) == None:
+        shutil.rmtree(path, ignore_errors=True)
+    try:
+        os.replace(temp_path, path)
+    except OSError:
+        # Another process stored it first
+        shutil.rmtree(temp_path, ignore_errors=True)
+
+    return package_hash
+
+def AddPackageRef(package_hash, path):
+    path = os.path.abspath(path)
+    refs_path = GetPackageRefsPath(package_hash)
+    Utils.Makedirs(refs_path)
+    ref_name = hashlib.sha256(bytes(os.path.normcase(path), "utf-8")).hexdigest()[:24]
+    with open(os.path.join(refs_path, ref_name), "w") as f:
+        f.write(path)
+
+def IsPackageLink(path):
+    return os.path.islink(path) or (hasattr(os.path, "isjunction") and os.path.isjunction(path))
+
+def RemovePackageView(path):
+    # Links are removed without following them into the store
+    if IsPackageLink(path):
+        if os.name == "nt":
+            os.rmdir(path)
+        else:
+            os.unlink(path)
+    elif os.path.isdir(path):
+        shutil.rmtree(path)
+
+def LinkPackageDir(stored_path, path):
+    try:
+        os.symlink(stored_path, path, target_is_directory=True)
+    except OSError:
+        if os.name != "nt":
+            raise
+
+        # Symlinks need developer mode or admin rights on Windows, junctions don't
+        import _winapi
+        _winapi.CreateJunction(stored_path, path)
+
+def LinkPackageTree(stored_path, path):
+    for dir, dirnames, filenames in os.walk(stored_path):
+        view_dir = os.path.join(path, os.path.relpath(dir, stored_path))
+        Utils.Makedirs(view_dir)
+        for filename in filenames:
+            # Copy when the store is on another volume
+            try:
+                os.link(os.path.join(dir, filename), os.path.join(view_dir, filename))
+            except OSError:
+                shutil.copy2(os.path.join(dir, filename), os.path.join(view_dir, filename))
+
+def CreatePackageView(filename, path, link="symlink", extract=None):
+    package_hash = StorePackage(filename, extract)
+
+    # Replace any view of another package or of another type, or previous extraction
+    if GetViewPackage(path) != package_hash or IsPackageLink(path) != (link != "hardlink"):
+        print(f"Linking {path} to package {package_hash[:24]}")
+        RemovePackageView(path)
+        Utils.Makedirs(os.path.dirname(os.path.abspath(path)))
+        stored_path = os.path.abspath(GetStoredPackagePath(package_hash))
+        if link == "hardlink":
+            LinkPackageTree(stored_path, path)
+        else:
+            LinkPackageDir(stored_path, path)
+
+    AddPackageRef(package_hash, path)
+    return path
+
+def CollectPackages():
+    if not os.path.isdir(PackageStoreDir):
+        return
+
+    for name in os.listdir(PackageStoreDir):
+        # Skip the references and extractions in progress
+        path = os.path.join(PackageStoreDir, name)
+        if name == "refs" or "." in name or not os.path.isdir(path):
+            continue
+
+        package_hash = GetViewPackage(path)
+        if package_hash != None:
+            if time.time() - os.path.getmtime(os.path.join(path, PackageIdName)) < PackageCollectGraceSeconds:
+                continue
+
+            # References are dropped once their view is gone or shows another package
+            refs_path = GetPackageRefsPath(package_hash)
+            refs = os.listdir(refs_path) if os.path.isdir(refs_path) else [ ]
+            live_refs = 0
+            for ref in refs:
+                with open(os.path.join(refs_path, ref), "r") as f:
+                    view_path = f.read()
+                if GetViewPackage(view_path) == package_hash:
+                    live_refs += 1
+                else:
+                    Utils.RemoveFile(os.path.join(refs_path, ref))
+            if live_refs:
+                continue
+
+        print(f"Removing unused package {path}")
+        shutil.rmtree(path, ignore_errors=True)
+        shutil.rmtree(os.path.join(PackageStoreDir, "refs", name), ignore_errors=True)
+
+#
+# Package acquisition as build nodes, which build in the background so that compiles can start
+# straight away. Only nodes that depend on them, usually through PackageFileNode, wait. e.g.
+#
+#    sdk = Packages.ExtractNode(Packages.DownloadNode(url, sha256), "external/sdk")
+#    sdk_lib = Packages.PackageFileNode(sdk, "lib/sdk.lib")
+#    app = CppBuild(env, [ "src" ], "app.exe", ext_libs = [ sdk_lib ], deps = [ sdk ])
+#
+# Here compiles wait for the headers in the package and the link also waits for its library.
+#
+class DownloadNode (BuildSystem.Node):
+    def __init__(self, url, sha256=None, connections=1, cache_dir=None):
+        super().__init__()
+        self.Url = url
+        self.Sha256 = sha256
+        self.Connections = connections
+        self.Filename = GetDownloadFilename(url, sha256, cache_dir)
+
+    def Build(self, env):
+        # Failed downloads fail the build rather than stopping it
+        try:
+            return DownloadFile(self.Url, self.Sha256, self.Connections, os.path.dirname(self.Filename)) != None
+        except (OSError, ValueError, http.client.HTTPException) as e:
+            print(f"ERROR: Download of {self.Url} failed ({e})")
+            return False
+
+    def RunsInBackground(self, env):
+        return True
+
+    # The download is its own input so that it's fetched again if it goes missing
+    def GetInputFile(self, env):
+        return self.Filename
+
+    def GetOutputFiles(self, env):
+        return [ self.Filename ]
+
+    # Completed downloads are shared through the cache and never partially written
+    def GetTempOutputFiles(self, env):
+        return [ ]
+
+    # Cached downloads belong to every project using them so cleaning one leaves them alone
+    def GetCleanFiles(self, env):
+        return [ ]
+
+    def GetCommandLine(self, env):
+        return [ "download", self.Url, self.Sha256 or "" ]
+
+# Set link to "symlink" or "hardlink" to get a view of the package store rather than a private copy
+class ExtractNode (BuildSystem.Node):
+    def __init__(self, archive, path, link=None):
+        super().__init__()
+        self.Dependencies = [ archive ]
+        self.Archive = archive
+        self.Path = path
+        self.Link = link
+
+    def Build(self, env):
+        if self.Link != None:
+            return CreatePackageView(self.GetInputFile(env), self.Path, self.Link) != None
+        return ExtractZipFileTo(self.GetInputFile(env), self.Path) != None
+
+    def RunsInBackground(self, env):
+        return True
+
+    def GetInputFile(self, env):
+        return self.Archive.GetOutputFiles(env)[0]
+
+    # The manifest is written last so its presence marks a complete extraction
+    def GetOutputFiles(self, env):
+        return [ os.path.join(self.Path, ExtractManifestName) ]
+
+    # Keeping the previous manifest lets updates extract only the members that changed
+    def GetTempOutputFiles(self, env):
+        return [ ]
+
+    # Views are removed without touching the package store they show, which would otherwise lose its
+    # manifest and never be stored again. Links are removed like files, hardlink views are left alone.
+    def GetCleanFiles(self, env):
+        if self.Link != None:
+            return [ self.Path ]
+        return self.GetOutputFiles(env)
+
+class PackageFileNode (BuildSystem.Node):
+    def __init__(self, package, filename):
+        super().__init__()
+        self.Dependencies = [ package ]
+        self.Filename = os.path.join(package.Path, filename)
+
+    def GetInputFile(self, env):
+        return self.Filename
+
+    def GetOutputFiles(self, env):
+        return [ self.Filename ]
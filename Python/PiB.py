@@ -55,6 +55,8 @@ import sys
 sys.path.append(os.path.dirname(os.path.realpath(__file__)))
 
 import Utils
+import Analysis
+import Packages
 #import cProfile
 #import pstats
 from datetime import datetime
@@ -64,7 +66,12 @@ start_time = datetime.now()
 # See if the caller wants to use a custom build script name/location
 pibfile = Utils.GetSysArgvProperty("-pf", "pibfile")
 #cProfile.run('Utils.ExecPibfile(pibfile)', sort=pstats.SortKey.CUMULATIVE)
-Utils.ExecPibfile(pibfile)
+
+# Analysis of previous builds and package store collection don't need the pibfile to be run
+if "-collect_packages" in sys.argv:
+    Packages.CollectPackages()
+elif not Analysis.Run(pibfile):
+    Utils.ExecPibfile(pibfile)
 
 # Print closing message with time elapsed
 time_elapsed = (datetime.now() - start_time).total_seconds()
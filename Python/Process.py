@@ -28,29 +28,64 @@
 
 import subprocess
 import os
+import Utils
+
+
+# Executables found on each PATH by name, or None if they weren't found
+_ResolvedExecutables = { }
+
+
+def ResolveExecutable(paths, name):
+
+    # Searching a long PATH costs a call into the OS per directory so do it once per build
+    key = (paths, name)
+    if key in _ResolvedExecutables:
+        return _ResolvedExecutables[key]
+
+    # Try and find a path that hosts the executable
+    resolved = None
+    for path in paths.split(os.pathsep):
+        file = os.path.join(path, name)
+        if os.path.exists(file):
+            resolved = file
+            break
+
+    _ResolvedExecutables[key] = resolved
+    return resolved
 
 
 def OpenPiped(args, env = None):
 
     # Even if the executable is in the path of the modified environment, you need to specify the full path to execute it
     # This is because Popen uses the existing environment to find the executable, applying the modified environment after
-    if env != None:
+    name = None
+    if env != None and type(args) == list:
+        name = args[0]
+        resolved = ResolveExecutable(env["PATH"], name)
+        if resolved != None:
+            args[0] = resolved
 
-        # Split all paths
-        paths = env["PATH"]
-        paths = paths.split(";")
-
-        # Try and find a path that hosts the executable and modify the input
-        for path in paths:
-            file = os.path.join(path, args[0])
-            if os.path.exists(file):
-                args[0] = file
-                break
+    # Any buffered output belongs before the output of this process
+    Utils.FlushPrint()
 
     # Send output to a pipe, push stderr through stdout to ensure they're ordered correctly
     #print (args)
     try:
         output = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=env)
+    except OSError:
+
+        # The executable may have moved since it was resolved so search again before giving up
+        if name == None:
+            print(args)
+            raise
+        _ResolvedExecutables.pop((env["PATH"], name), None)
+        resolved = ResolveExecutable(env["PATH"], name)
+        args[0] = resolved if resolved != None else name
+        try:
+            output = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=env)
+        except:
+            print(args)
+            raise
     except:
         print(args)
         raise
@@ -69,7 +104,18 @@ def WaitForPipeOutput(process, line_handler=None):
     # process.wait()
     # output = process.communicate()[0]
 
-    if line_handler != None:
+    if line_handler != None and hasattr(line_handler, "ScanBytes"):
+
+        # Scanners work directly on the raw output
+        line_handler.ScanBytes(process.stdout.read())
+        line_handler.Finish()
+
+        # Force commit of the returncode parameter in process
+        while process.returncode == None:
+            process.poll()
+        Utils.FlushPrint()
+
+    elif line_handler != None:
 
         # Use a line handler if specified
         output = process.stdout.readlines()
@@ -79,6 +125,7 @@ def WaitForPipeOutput(process, line_handler=None):
         # Force commit of the returncode parameter in process
         while process.returncode == None:
             process.poll()
+        Utils.FlushPrint()
 
     else:
 
@@ -93,6 +140,18 @@ def WaitForPipeOutput(process, line_handler=None):
 
 def PollPipeOutput(process, line_handler):
 
+    if hasattr(line_handler, "ScanBytes"):
+
+        # Scanners work directly on the raw output, read in whatever chunks are available
+        for chunk in iter(lambda: process.stdout.read1(65536), b""):
+            line_handler.ScanBytes(chunk)
+        line_handler.Finish()
+
+        # Return exit code
+        Utils.FlushPrint()
+        process.stdout.close()
+        return process.wait()
+
     # Iteration on readline stalls until the next line immediately comes through. It also ensures all lines are read from the
     # process until shutdown.
     for line in iter(process.stdout.readline, b""):
@@ -103,5 +162,6 @@ def PollPipeOutput(process, line_handler):
         line_handler(line)
 
     # Return exit code
+    Utils.FlushPrint()
     process.stdout.close()
     return process.wait()
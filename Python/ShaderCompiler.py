@@ -28,14 +28,16 @@ class ShaderCompileOptions(FXCompileOptions):
         self.SourceRoot = None
         self.CppOutputPath = None
 
-    def UpdateCommandLine(self):
+    def BuildCommandLine(self):
 
-        super().UpdateCommandLine()
+        cmdline = super().BuildCommandLine()
 
         if self.SourceRoot:
-            self.CommandLine += [ "/SourceRoot" + self.SourceRoot ]
+            cmdline += [ "/SourceRoot" + self.SourceRoot ]
         if self.CppOutputPath:
-            self.CommandLine += [ "/CppOutputPath" + self.CppOutputPath ]
+            cmdline += [ "/CppOutputPath" + self.CppOutputPath ]
+
+        return cmdline
 
 
 class ShaderCompileNode(FXCompileNode):
@@ -46,23 +48,7 @@ class ShaderCompileNode(FXCompileNode):
 
     def Build(self, env):
 
-        # Node entry point takes precedence over config specified entry-point
-        entry_point = self.EntryPoint
-        if entry_point == None:
-            entry_point = env.CurrentConfig.ShaderCompileOptions.EntryPoint
-
-        # Build command line
-        cmdline = [ os.path.join(ShaderCompilerPath, "ShaderCompiler.exe") ]
-        cmdline += [ '/T' + self.Profile ]
-        cmdline += env.CurrentConfig.ShaderCompileOptions.CommandLine
-        cmdline += self.DefineCmdLine
-        cmdline += self.BuildCommandLine
-        if entry_point:
-            cmdline += [ '/E' + entry_point ]
-        cmdline += [ "/ShowCppOutputs" ]
-        if ShowTrace:
-            cmdline += [ "/trace" ]
-        cmdline += [ self.Path ]
+        cmdline = self.GetCommandLine(env)
         Utils.ShowCmdLine(env, cmdline)
 
         # Create the include scanner and launch the compiler
@@ -79,6 +65,32 @@ class ShaderCompileNode(FXCompileNode):
 
         return process.returncode == 0
 
+    def GetCommandLine(self, env):
+
+        # Generates the output file command-line
+        self.GetOutputFiles(env)
+
+        # Node entry point takes precedence over config specified entry-point
+        options = env.CurrentConfig.ShaderCompileOptions
+        entry_point = self.EntryPoint
+        if entry_point == None:
+            entry_point = options.EntryPoint
+
+        # Build command line
+        options.UpdateCommandLine()
+        cmdline = [ os.path.join(ShaderCompilerPath, "ShaderCompiler.exe") ]
+        cmdline += [ '/T' + self.Profile ]
+        cmdline += options.CommandLine
+        cmdline += self.DefineCmdLine
+        cmdline += self.BuildCommandLine
+        if entry_point:
+            cmdline += [ '/E' + entry_point ]
+        cmdline += [ "/ShowCppOutputs" ]
+        if ShowTrace:
+            cmdline += [ "/trace" ]
+        cmdline += [ self.Path ]
+        return cmdline
+
     def GetOutputFiles(self, env):
 
         return super()._GetOutputFiles(env, env.CurrentConfig.ShaderCompileOptions)
@@ -28,11 +28,13 @@
 
 import os
 import sys
+import time
 import errno
 import fnmatch
 import shutil
 import re
-import glob
+import functools
+import threading
 
 
 #
@@ -64,11 +66,41 @@ def enum(*sequential, **named):
     return type('Enum', (), enums)
 
 
+#
+# Paths are normalised many times over during a build (e.g. every include reported by the compiler)
+# so memoise the result for each input path.
+#
+_NormalisedPaths = { }
+
 def NormalisePath(path):
 
-    path = os.path.normpath(path)
-    path = os.path.normcase(path)
-    return path
+    normalised = _NormalisedPaths.get(path)
+    if normalised == None:
+        normalised = os.path.normcase(os.path.normpath(path))
+        _NormalisedPaths[path] = normalised
+    return normalised
+
+
+def IsPathUnder(path, dir):
+
+    path = os.path.abspath(NormalisePath(path))
+    dir = os.path.abspath(NormalisePath(dir))
+    return path == dir or path.startswith(os.path.join(dir, ""))
+
+
+#
+# Directory listings used to map filenames to how the OS references them, keyed by the case of the
+# filename as normalised for the OS. Returns None if the directory doesn't exist.
+#
+@functools.lru_cache(maxsize=4096)
+def GetDirectoryListing(path):
+
+    try:
+        names = os.listdir(path if path != "" else ".")
+    except OSError:
+        return None
+
+    return { os.path.normcase(name): name for name in names }
 
 
 #
@@ -76,9 +108,32 @@ def NormalisePath(path):
 # matters on Windows where filenames are case-insensitive but Windows preserves case
 # in its directory listing.
 #
+# Each directory is listed at most once as the listings are cached. If the file doesn't
+# exist the original path is returned.
+#
 def GetOSFilename(path):
-    r = glob.glob(re.sub(r'([^:/\\])(?=[/\\]|$)', r'[\1]', path))
-    return r and r[0] or path
+
+    # Split into alternating path components and separators, preserving the separators used
+    parts = re.split(r"([/\\])", path)
+
+    os_path = ""
+    for i in range(0, len(parts), 2):
+
+        # Drives, roots and relative components are kept as they are
+        part = parts[i]
+        if part != "" and part != "." and part != ".." and not part.endswith(":"):
+            listing = GetDirectoryListing(os_path)
+            if listing == None:
+                return path
+            part = listing.get(os.path.normcase(part))
+            if part == None:
+                return path
+
+        os_path += part
+        if i + 1 < len(parts):
+            os_path += parts[i + 1]
+
+    return os_path
 
 
 #
@@ -111,6 +166,44 @@ def RemoveFile(filename):
         return False
 
 
+#
+# Advisory lock between PiB processes, held by creating a lock file that no other process can
+# create until it's removed. Locks are only held briefly so one older than the timeout is
+# assumed to have been left behind by a process that was killed.
+#
+class FileLock:
+
+    def __init__(self, filename, timeout = 30):
+
+        self.Filename = filename
+        self.Timeout = timeout
+
+    def __enter__(self):
+
+        while True:
+            try:
+                fd = os.open(self.Filename, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                os.write(fd, bytes(str(os.getpid()), "utf-8"))
+                os.close(fd)
+                return self
+            except (FileExistsError, PermissionError):
+                pass
+
+            # Break stale locks, the file may be removed by its owner at any point
+            try:
+                if time.time() - os.path.getmtime(self.Filename) > self.Timeout:
+                    RemoveFile(self.Filename)
+                    continue
+            except OSError:
+                continue
+
+            time.sleep(0.05)
+
+    def __exit__(self, type, value, traceback):
+
+        RemoveFile(self.Filename)
+
+
 #
 # Copies files, returning True/False for whether the operation succeeded.
 #
@@ -185,6 +278,72 @@ def GetSysArgvProperties(name, default=None):
     return props
 
 
+def GetSysArgvConfigNames():
+
+    # Configs are given as "-config debug,release" or "-config all", defaulting to debug
+    return GetSysArgvProperty("-config", "debug").split(",")
+
+
+def GetSysArgvList(name):
+
+    # All arguments following the name up to the next option, or None if the option isn't there
+    if name not in sys.argv:
+        return None
+    args = sys.argv[sys.argv.index(name) + 1:]
+    for i, arg in enumerate(args):
+        if arg.startswith("-"):
+            return args[:i]
+    return args
+
+
+#
+# Base class for tool options that get converted to a command-line. Derived classes implement
+# BuildCommandLine and the result is cached until any option is assigned or any list option is
+# modified in-place, so that the command-line is only built when something has changed.
+#
+class CommandLineOptions:
+
+    def __init__(self):
+
+        self.__dict__["Dirty"] = True
+        self.__dict__["CommandLine"] = [ ]
+        self.__dict__["ListSnapshots"] = { }
+
+    def __setattr__(self, name, value):
+
+        # Assign the field and mark the command-line as dirty
+        self.__dict__[name] = value
+        self.__dict__["Dirty"] = True
+
+    def IsDirty(self):
+
+        if self.Dirty:
+            return True
+
+        # Lists such as defines and include paths are commonly appended to without assignment
+        for name, snapshot in self.ListSnapshots.items():
+            if self.__dict__[name] != snapshot:
+                return True
+
+        return False
+
+    def UpdateCommandLine(self):
+
+        if self.IsDirty():
+
+            cmdline = self.BuildCommandLine()
+            snapshots = { name: list(value) for name, value in self.__dict__.items() if type(value) == list and name != "CommandLine" }
+
+            # Update and mark as not dirty without calling into __setattr__
+            self.__dict__["CommandLine"] = cmdline
+            self.__dict__["ListSnapshots"] = snapshots
+            self.__dict__["Dirty"] = False
+
+    def BuildCommandLine(self):
+
+        raise Exception("Derived class hasn't implemented BuildCommandLine")
+
+
 class LineParser:
 
     def __init__(self, output_name, prefix, ignore_prefixes, parser):
@@ -194,6 +353,12 @@ class LineParser:
         self.IgnorePrefixes = ignore_prefixes
         self.Parser = parser
 
+        # Parsed lines are cached per parser. Lambdas made on each call share their code, which identifies
+        # them across calls as long as they don't capture any state.
+        self.ParserKey = parser
+        if getattr(parser, "__closure__", True) == None:
+            self.ParserKey = (parser.__code__, parser.__defaults__)
+
     def IgnoreLine(self, line):
 
         if self.IgnorePrefixes:
@@ -204,7 +369,66 @@ class LineParser:
         return False
 
 
+# https://bluesock.org/~willkg/dev/ansi.html
+ANSIColour = enum(
+    Black = "\033[30m",
+    Orange = "\033[38;2;255;165;0m",
+    Red = "\033[31m",
+    Cyan = "\033[36m",
+    End = "\033[0m",
+    Bold = "\033[1m"
+)
+
+
+# Filenames and keywords are coloured in a single pass over each line
 PrintFileRegex = re.compile(r"(\w:[/\\])?([/\\]?[\w\.\.])+(\.\w+)")
+PrintColourRegex = re.compile("(?P<file>" + PrintFileRegex.pattern + r")|(?P<error>error|ERROR)|(?P<warning>warning|WARNING)")
+
+
+def _ColourMatch(match):
+
+    filename = match.group("file")
+    if filename != None:
+
+        # Replace filenames with correct case as reported by the OS. This is to stop VSCode opening
+        # multiple copies of the same file when you click on the output.
+        # Bug: https://github.com/Microsoft/vscode/issues/12448
+        return ANSIColour.Cyan + GetOSFilename(filename) + ANSIColour.End
+
+    if match.group("error") != None:
+        return ANSIColour.Bold + ANSIColour.Red + match.group(0) + ANSIColour.End
+
+    return ANSIColour.Orange + match.group(0) + ANSIColour.End
+
+
+#
+# Tool output can run to thousands of lines so it's collected and written to stdout in blocks.
+# Any pending output is flushed before launching a process, after it completes and whenever
+# output has been pending for more than a fraction of a second, with a timer making sure of that
+# when nothing else is printed. Builds running in the background share the buffer so access to it
+# is locked.
+#
+_PrintBuffer = [ ]
+_PrintBufferTime = time.monotonic()
+_PrintBufferMaxLines = 256
+_PrintBufferMaxTime = 0.1
+_PrintLock = threading.RLock()
+_PrintTimer = None
+
+def FlushPrint():
+
+    global _PrintBufferTime, _PrintTimer
+    with _PrintLock:
+        _PrintBufferTime = time.monotonic()
+        if _PrintTimer != None:
+            _PrintTimer.cancel()
+            _PrintTimer = None
+        if len(_PrintBuffer):
+            sys.stdout.write("".join(_PrintBuffer))
+            sys.stdout.flush()
+            _PrintBuffer.clear()
+
+
 def Print(env, line):
 
     if env.NoToolOutput:
@@ -214,38 +438,19 @@ def Print(env, line):
         return
 
     if RunningFromBash:
+        line = PrintColourRegex.sub(_ColourMatch, line)
 
-        # https://bluesock.org/~willkg/dev/ansi.html
-        Black = "\033[30m"
-        Orange = "\033[38;2;255;165;0m"
-        Red = "\033[31m"
-        Cyan = "\033[36m"
-        End = "\033[0m"
-        Bold = "\033[1m"
-
-        # Scan for filenames
-        matches = PrintFileRegex.finditer(line)
-        if matches:
-            for match in matches:
-                filename = match.group(0)
-
-                # Colour filenames
-                line = line.replace(filename, f"{Cyan}" + filename + f"{End}")
-
-                # Replace filenames with correct case as reported by the OS. This is to stop VSCode opening
-                # multiple copies of the same file when you click on the output.
-                # Bug: https://github.com/Microsoft/vscode/issues/12448
-                if os.path.exists(filename):
-                    os_filename = GetOSFilename(filename)
-                    line = line.replace(filename, os_filename)
-
-        # Colour keywords
-        line = line.replace("error", f"{Bold}{Red}error{End}")
-        line = line.replace("ERROR", f"{Bold}{Red}ERROR{End}")
-        line = line.replace("warning", f"{Orange}warning{End}")
-        line = line.replace("WARNING", f"{Orange}WARNING{End}")
+    global _PrintTimer
+    with _PrintLock:
+        _PrintBuffer.append(line + "\n")
+        if len(_PrintBuffer) >= _PrintBufferMaxLines or time.monotonic() - _PrintBufferTime > _PrintBufferMaxTime:
+            FlushPrint()
 
-    print(line)
+        # Tools can go quiet for a long time after printing so don't wait for the next line
+        elif _PrintTimer == None:
+            _PrintTimer = threading.Timer(_PrintBufferMaxTime, FlushPrint)
+            _PrintTimer.daemon = True
+            _PrintTimer.start()
 
 
 #
@@ -253,54 +458,117 @@ def Print(env, line):
 # If the line reports what file is being included by the .c/.cpp file then it's not printed
 # and instead stored locally so that it can report all the files included.
 #
+# All prefixes are compiled into a single regex that is matched once against each line, in the
+# priority order the parsers were added with ignored prefixes first. Output is scanned as raw bytes
+# with only printed or newly parsed lines decoded. The parsed result of each line is cached so that
+# the same include reported by many files is only parsed and normalised once.
+#
+_LineScannerPatterns = { }
+_ParsedLines = { }
+
 class LineScanner():
 
     def __init__(self, env):
 
         self.Env = env
         self.LineParsers = []
+        self.Pattern = None
+        self.Actions = None
+        self.Remainder = b""
 
     def AddLineParser(self, output_name, prefix, ignore_prefixes, parser):
 
         # Add to the list and create an output field in the class instance
         self.LineParsers.append(LineParser(output_name, prefix, ignore_prefixes, parser))
         setattr(self, output_name, set())
+        self.Pattern = None
+
+    def Compile(self):
+
+        # Share the compiled pattern between all scanners with the same prefixes
+        key = tuple([ (lp.Prefix, tuple(lp.IgnorePrefixes or [ ])) for lp in self.LineParsers ])
+        if key not in _LineScannerPatterns:
+
+            # One capture group per prefix, recording the index of the parser it's for or None if ignored
+            alternatives = [ ]
+            parser_indices = [ None ]
+            for index, (prefix, ignore_prefixes) in enumerate(key):
+                for ignore_prefix in ignore_prefixes:
+                    alternatives += [ b"(" + re.escape(bytes(ignore_prefix, "utf-8")) + b")" ]
+                    parser_indices += [ None ]
+                alternatives += [ b"(" + re.escape(bytes(prefix, "utf-8")) + b")" ]
+                parser_indices += [ index ]
+
+            pattern = re.compile(rb"[ \t]*(?:" + b"|".join(alternatives) + b")")
+            _LineScannerPatterns[key] = (pattern, parser_indices)
+
+        (self.Pattern, parser_indices) = _LineScannerPatterns[key]
+
+        # Bind each group to the parser and its output set
+        self.Actions = [ ]
+        for index in parser_indices:
+            if index == None:
+                self.Actions += [ None ]
+            else:
+                line_parser = self.LineParsers[index]
+                self.Actions += [ (line_parser, getattr(self, line_parser.OutputName)) ]
+
+    def ScanLine(self, line):
+
+        # Strip newline
+        line = line.rstrip(b"\r\n")
+        if line == b"":
+            return
 
-    def __call__(self, line):
+        if self.Pattern == None:
+            self.Compile()
+
+        # If no parsers have filtered the line, print it
+        match = self.Pattern.match(line)
+        if match == None:
+            Print(self.Env, line.lstrip().decode(errors="replace"))
+            return
 
-        if line == "":
+        # Ignored lines have no action
+        action = self.Actions[match.lastindex]
+        if action == None:
             return
 
-        # Strip newline/whitespace
-        line = line.strip("\r\n")
-        line = line.lstrip()
+        # Scan for included files and add to the list
+        (line_parser, output) = action
+        key = (line_parser.ParserKey, line_parser.Prefix, line)
+        path = _ParsedLines.get(key)
+        if path == None:
+            path = line_parser.Parser(line.lstrip().decode(errors="replace"), len(line_parser.Prefix))
+            path = NormalisePath(path)
+            _ParsedLines[key] = path
+        output.add(path)
 
-        # Check each parser
-        print_line = True
-        for line_parser in self.LineParsers:
+    def ScanBytes(self, chunk):
 
-            # Prioritise checking for ignored lines
-            if line_parser.IgnoreLine(line):
-                print_line = False
-                break
+        # Split into lines, keeping any incomplete line until the next chunk arrives
+        lines = (self.Remainder + chunk).split(b"\n")
+        self.Remainder = lines.pop()
+        for line in lines:
+            self.ScanLine(line)
 
-            # Scan for included files and add to the list
-            if line.startswith(line_parser.Prefix):
-                path = line_parser.Parser(line, len(line_parser.Prefix))
-                path = NormalisePath(path)
-                getattr(self, line_parser.OutputName).add(path)
-                print_line = False
+    def Finish(self):
 
-        # If no parsers have filtered the line, print it
-        if print_line:
-            Print(self.Env, line)
+        if self.Remainder != b"":
+            self.ScanLine(self.Remainder)
+            self.Remainder = b""
+
+    def __call__(self, line):
 
+        # Line handler interface for decoded output
+        self.ScanLine(bytes(line, "utf-8"))
         return False
 
 
 def ShowCmdLine(env, cmdline):
 
     if env.ShowCmdLine:
+        FlushPrint()
         print(cmdline)
 
         for cmd in cmdline:
@@ -352,6 +620,7 @@ env.SaveFileMetadata()
     exec(prologue_compiled, global_symbols)
     exec(code_compiled, global_symbols)
     exec(epilogue_compiled, global_symbols)
+    FlushPrint()
 
     # Restore initial directory
     os.chdir(cur_dir)
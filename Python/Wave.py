@@ -20,13 +20,12 @@ def SetInstallPath(location):
     _InstallPath = location
 
 
-class Options:
+class Options (Utils.CommandLineOptions):
 
-    #
-    # TODO: Uses new dirty options checking mechanism.
-    #
     def __init__(self):
 
+        super().__init__()
+
         # List of normal/system include search paths
         self.IncludePaths = [ ]
         self.SystemIncludePaths = [ ]
@@ -40,34 +39,21 @@ class Options:
         self.C99 = False
         self.Cpp11 = False
 
-        self.Dirty = True
-        self.CommandLine = [ ]
-
-    def __setattr__(self, name, value):
-
-        # Assign the field and mark the command-line as dirty
-        self.__dict__[name] = value
-        self.__dict__["Dirty"] = True
-
-    def UpdateCommandLine(self):
+    def BuildCommandLine(self):
 
-        if self.Dirty:
+        cmdline = [ ]
+        cmdline += [ ('--include="' + os.path.normpath(path) + '"') for path in self.IncludePaths ]
+        cmdline += [ ('--sysinclude="' + os.path.normpath(path) + '"') for path in self.SystemIncludePaths ]
+        cmdline += [ '--undefine=' + macro for macro in self.UndefineMacros ]
 
-            cmdline = [ ]
-            cmdline += [ ('--include="' + os.path.normpath(path) + '"') for path in self.IncludePaths ]
-            cmdline += [ ('--sysinclude="' + os.path.normpath(path) + '"') for path in self.SystemIncludePaths ]
-            cmdline += [ '--undefine=' + macro for macro in self.UndefineMacros ]
+        self.FormatDefines(cmdline)
 
-            self.FormatDefines(cmdline)
+        if self.LongLong: cmdline += [ "--long_long" ]
+        if self.Variadics: cmdline += [ "--variadics" ]
+        if self.C99: cmdline += [ "--c99" ]
+        if self.Cpp11: cmdline += [ "--c++11" ]
 
-            if self.LongLong: cmdline += [ "--long_long" ]
-            if self.Variadics: cmdline += [ "--variadics" ]
-            if self.C99: cmdline += [ "--c99" ]
-            if self.Cpp11: cmdline += [ "--c++11" ]
-
-            # Update and mark as not dirty without calling into __setattr__
-            self.__dict__["CommandLine"] = cmdline
-            self.__dict__["Dirty"] = False
+        return cmdline
 
     def FormatDefines(self, cmdline):
 
@@ -96,16 +82,7 @@ class BuildNode (BuildSystem.Node):
 
     def Build(self, env):
 
-        # Ensure command -line for current configuration is up-to-date
-        options = self.OptionsMap[env.CurrentConfig.CmdLineArg]
-        options.UpdateCommandLine()
-
-        # Augment command-line with current environment
-        cmdline = [ os.path.join(_InstallPath, "wave.exe") ]
-        cmdline += self.OptionsMap[env.CurrentConfig.CmdLineArg].CommandLine
-        cmdline += [ '--output=' + self.GetOutputFiles(env)[0] ]
-        cmdline += [ '--listincludes=-' ]
-        cmdline += [ self.GetInputFile(env) ]
+        cmdline = self.GetCommandLine(env)
         Utils.ShowCmdLine(env, cmdline)
 
         # Launch Wave with a dependency scanner and wait for it to finish
@@ -120,6 +97,20 @@ class BuildNode (BuildSystem.Node):
 
         return process.returncode == 0
 
+    def GetCommandLine(self, env):
+
+        # Ensure command -line for current configuration is up-to-date
+        options = self.OptionsMap[env.CurrentConfig.CmdLineArg]
+        options.UpdateCommandLine()
+
+        # Augment command-line with current environment
+        cmdline = [ os.path.join(_InstallPath, "wave.exe") ]
+        cmdline += options.CommandLine
+        cmdline += [ '--output=' + self.GetOutputFiles(env)[0] ]
+        cmdline += [ '--listincludes=-' ]
+        cmdline += [ self.GetInputFile(env) ]
+        return cmdline
+
     def GetInputFile(self, env):
 
         path = self.Source.GetOutputFiles(env)[0]
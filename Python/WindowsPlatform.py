@@ -1,5 +1,4 @@
 
-import winreg
 import os
 import string
 
@@ -85,7 +84,8 @@ SDKVersions = [
 # Locate program files
 ProgramFilesx86 = os.getenv("ProgramFiles(x86)")
 if ProgramFilesx86 == None:
-	print("ERROR: Couldn't locate Program Files (x86) directory")
+	if os.name == "nt":
+		print("ERROR: Couldn't locate Program Files (x86) directory")
 	ProgramFilesx86 = ""
 
 
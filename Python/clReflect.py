@@ -28,17 +28,10 @@ class CppExportNode(BuildSystem.Node):
 
     def Build(self, env):
 
-        input_file = self.GetInputFile(env)
         output_file = self.GetOutputFiles(env)[0]
         Utils.Print(env, "clexport: " + os.path.basename(output_file))
 
-        # Construct the command-line
-        cmdline = [ _MakePath("clexport.exe") ]
-        cmdline += [ input_file ]
-        cmdline += [ "-cpp", output_file ]
-        cmdline += [ "-cpp_log", output_file + ".log" ]
-        if self.MapFile != None:
-            cmdline += [ "-map", self.MapFile.GetOutputFiles(env)[0] ]
+        cmdline = self.GetCommandLine(env)
         Utils.ShowCmdLine(env, cmdline)
 
         # Launch the exporter and wait for it to finish
@@ -49,6 +42,20 @@ class CppExportNode(BuildSystem.Node):
 
         return process.returncode == 0
 
+    def GetCommandLine(self, env):
+
+        input_file = self.GetInputFile(env)
+        output_file = self.GetOutputFiles(env)[0]
+
+        # Construct the command-line
+        cmdline = [ _MakePath("clexport.exe") ]
+        cmdline += [ input_file ]
+        cmdline += [ "-cpp", output_file ]
+        cmdline += [ "-cpp_log", output_file + ".log" ]
+        if self.MapFile != None:
+            cmdline += [ "-map", self.MapFile.GetOutputFiles(env)[0] ]
+        return cmdline
+
     def GetInputFile(self, env):
 
         return self.Input.GetOutputFiles(env)[0]
@@ -78,14 +85,7 @@ class MergeNode (BuildSystem.Node):
         output_file = self.GetOutputFiles(env)[0]
         Utils.Print(env, "clmerge: " + os.path.basename(output_file))
 
-        # Construct the command-line
-        cmdline = [ _MakePath("clmerge.exe") ]
-        cmdline += [ output_file ]
-        if self.CppCodeGen != None:
-            cmdline += [ "-cpp_codegen", self.CppCodeGen.GetInputFile(env) ]
-        if self.HCodeGen != None:
-            cmdline += [ "-h_codegen", self.HCodeGen.GetInputFile(env) ]
-        cmdline += [ file.GetOutputFiles(env)[0] for file in self.Dependencies ]
+        cmdline = self.GetCommandLine(env)
         Utils.ShowCmdLine(env, cmdline)
 
         # Launch the merger and wait for it to finish
@@ -96,6 +96,20 @@ class MergeNode (BuildSystem.Node):
 
         return process.returncode == 0
 
+    def GetCommandLine(self, env):
+
+        output_file = self.GetOutputFiles(env)[0]
+
+        # Construct the command-line
+        cmdline = [ _MakePath("clmerge.exe") ]
+        cmdline += [ output_file ]
+        if self.CppCodeGen != None:
+            cmdline += [ "-cpp_codegen", self.CppCodeGen.GetInputFile(env) ]
+        if self.HCodeGen != None:
+            cmdline += [ "-h_codegen", self.HCodeGen.GetInputFile(env) ]
+        cmdline += [ file.GetOutputFiles(env)[0] for file in self.Dependencies ]
+        return cmdline
+
     def GetInputFile(self, env):
 
         path = os.path.join(env.CurrentConfig.IntermediatePath, self.Path)
@@ -129,9 +143,24 @@ class CppScanNode (BuildSystem.Node):
     def Build(self, env):
 
         input_file = self.GetInputFile(env)
-        output_files = self.GetOutputFiles(env)
         Utils.Print(env, "clscan: " + Utils.GetOSFilename(os.path.basename(input_file)))
 
+        cmdline = self.GetCommandLine(env)
+        Utils.ShowCmdLine(env, cmdline)
+
+        # Launch the scanner and wait for it to finish
+        output = Utils.LineScanner(env)
+        output.AddLineParser("Includes", "Included:", None, lambda line, length: line[length:].lstrip())
+        process = Process.OpenPiped(cmdline)
+        Process.WaitForPipeOutput(process, output)
+
+        return process.returncode == 0
+
+    def GetCommandLine(self, env):
+
+        input_file = self.GetInputFile(env)
+        output_files = self.GetOutputFiles(env)
+
         # Construct the command-line
         cmdline = [ _MakePath("clscan.exe") ]
         cmdline += [ input_file ]
@@ -155,15 +184,7 @@ class CppScanNode (BuildSystem.Node):
             cmdline += [ "-I", path ]
         for define in self.Defines:
             cmdline += [ "-D", define ]
-        Utils.ShowCmdLine(env, cmdline)
-
-        # Launch the scanner and wait for it to finish
-        output = Utils.LineScanner(env)
-        output.AddLineParser("Includes", "Included:", None, lambda line, length: line[length:].lstrip())
-        process = Process.OpenPiped(cmdline)
-        Process.WaitForPipeOutput(process, output)
-
-        return process.returncode == 0
+        return cmdline
 
     def GetInputFile(self, env):
 
@@ -0,0 +1,1055 @@
+
+#
+# --- MIT Open Source License --------------------------------------------------
+# PiB - Python Build System
+# Copyright (C) 2011 by Don Williamson
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+# ------------------------------------------------------------------------------
+#
+# Tests.py: Regression tests, run with "python Tests.py" from this directory.
+#
+# Tests that build projects write them to a temporary directory and run PiB on them, skipping
+# if the toolchain they need isn't available.
+#
+
+import os
+import sys
+import time
+import struct
+import shutil
+import tempfile
+import unittest
+import threading
+import subprocess
+import http.server
+import io
+import json
+import pickle
+import contextlib
+import zipfile
+
+PythonDir = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "Python")
+sys.path.append(PythonDir)
+
+import Analysis
+import BuildSystem
+import Distribute
+import Environment
+import GCCPlatform
+import MSVCGeneration
+import MSVCPlatform
+import Packages
+import Process
+import Utils
+
+
+class BuildTestCase (unittest.TestCase):
+
+    def setUp(self):
+
+        self.Dir = tempfile.mkdtemp(prefix = "pib_test_")
+
+    def tearDown(self):
+
+        shutil.rmtree(self.Dir, ignore_errors = True)
+
+    def WriteFile(self, filename, text):
+
+        filename = os.path.join(self.Dir, filename)
+        os.makedirs(os.path.dirname(filename), exist_ok = True)
+        with open(filename, "w") as f:
+            f.write(text)
+
+    def TouchFile(self, filename, text):
+
+        # Make sure the new modification time differs from the recorded one
+        time.sleep(1)
+        self.WriteFile(filename, text)
+
+    def RunPiB(self, *args):
+
+        result = subprocess.run([ sys.executable, os.path.join(PythonDir, "PiB.py") ] + list(args),
+            cwd = self.Dir, stdout = subprocess.PIPE, stderr = subprocess.STDOUT)
+        self.assertEqual(result.returncode, 0, result.stdout.decode(errors = "replace"))
+        return result.stdout.decode(errors = "replace")
+
+    def RunExe(self, filename):
+
+        return subprocess.run([ os.path.join(self.Dir, filename) ]).returncode
+
+    def ReadExplain(self):
+
+        # Everything the last build run with -explain rebuilt
+        with open(os.path.join(self.Dir, "pib_explain.jsonl"), "r") as f:
+            return [ json.loads(line) for line in f ]
+
+
+@unittest.skipIf(sys.platform == "win32" or shutil.which("g++") == None, "Needs the GCC toolchain")
+class TestSharedNodes (BuildTestCase):
+
+    def test_shared_object_header_change(self):
+
+        # An object linked into two targets is built for the first but both must see its headers
+        self.WriteFile("src/value.h", "#define VALUE 7\n")
+        self.WriteFile("src/value.cpp", "#include \"value.h\"\nint GetValue() { return VALUE; }\n")
+        self.WriteFile("src/main.cpp", "int GetValue();\nint main() { return GetValue(); }\n")
+        self.WriteFile("pibfile",
+            "obj = env.CPPFile(\"src/value.cpp\")\n"
+            "main = env.CPPFile(\"src/main.cpp\")\n"
+            "env.Build(env.Link(\"app1.exe\", [ main, obj ]), \"app1\")\n"
+            "env.Build(env.Link(\"app2.exe\", [ main, obj ]), \"app2\")\n")
+
+        self.RunPiB()
+        self.assertEqual(self.RunExe("bin/Debug/app1"), 7)
+        self.assertEqual(self.RunExe("bin/Debug/app2"), 7)
+
+        self.TouchFile("src/value.h", "#define VALUE 9\n")
+        self.RunPiB()
+        self.assertEqual(self.RunExe("bin/Debug/app1"), 9)
+        self.assertEqual(self.RunExe("bin/Debug/app2"), 9)
+
+        # Both targets now record the header so another change rebuilds and relinks both
+        self.TouchFile("src/value.h", "#define VALUE 11\n")
+        self.RunPiB()
+        self.assertEqual(self.RunExe("bin/Debug/app1"), 11)
+        self.assertEqual(self.RunExe("bin/Debug/app2"), 11)
+
+
+def MakeImportLibrary(exports, timestamp = 0):
+
+    # An archive of short import objects, one for each (name, ordinal) export of the DLL
+    data = b"!<arch>\n"
+    for (name, ordinal) in exports:
+        names = name.encode() + b"\x00test.dll\x00"
+        member = struct.pack("<HHHHIIHH", 0, 0xFFFF, 0, 0x8664, timestamp, len(names), ordinal, 0) + names
+        header = b"test.dll/".ljust(16) + str(timestamp).encode().ljust(12) + b"0".ljust(6) + b"0".ljust(6)
+        header += b"644".ljust(8) + str(len(member)).encode().ljust(10) + b"`\n"
+        data += header + member + (b"\n" if len(member) & 1 else b"")
+    return bytearray(data)
+
+
+class TestImportLibraryHash (unittest.TestCase):
+
+    def test_timestamp_ignored(self):
+
+        a = BuildSystem.HashImportLibrary(MakeImportLibrary([ ("Add", 1), ("Sub", 2) ], 100))
+        b = BuildSystem.HashImportLibrary(MakeImportLibrary([ ("Add", 1), ("Sub", 2) ], 200))
+        self.assertNotEqual(a, None)
+        self.assertEqual(a, b)
+
+    def test_ordinal_change(self):
+
+        a = BuildSystem.HashImportLibrary(MakeImportLibrary([ ("Add", 1), ("Sub", 2) ]))
+        b = BuildSystem.HashImportLibrary(MakeImportLibrary([ ("Add", 1), ("Sub", 3) ]))
+        self.assertNotEqual(a, b)
+
+    def test_export_added(self):
+
+        a = BuildSystem.HashImportLibrary(MakeImportLibrary([ ("Add", 1) ]))
+        b = BuildSystem.HashImportLibrary(MakeImportLibrary([ ("Add", 1), ("Sub", 2) ]))
+        self.assertNotEqual(a, b)
+
+
+def MakeCOFF(timestamp, code = b"\xc3"):
+
+    # A COFF object header with no sections, followed by some code
+    return struct.pack("<HHIIIHH", 0x8664, 0, timestamp, 0, 0, 0, 0) + code
+
+
+def MakeArchive(members, date):
+
+    data = b"!<arch>\n"
+    for (name, member) in members:
+        header = name.ljust(16) + str(date).encode().ljust(12) + b"0".ljust(6) + b"0".ljust(6)
+        header += b"644".ljust(8) + str(len(member)).encode().ljust(10) + b"`\n"
+        data += header + member + (b"\n" if len(member) & 1 else b"")
+    return data
+
+
+def MakePE(timestamp, checksum, code = b"\xc3"):
+
+    # DOS header pointing at a PE header, its COFF header and the start of an optional header
+    data = bytearray(0x40)
+    data[0:2] = b"MZ"
+    struct.pack_into("<I", data, 0x3C, 0x40)
+    data += b"PE\x00\x00" + struct.pack("<HHIIIHH", 0x8664, 0, timestamp, 0, 0, 0xF0, 0)
+    data += bytearray(64) + struct.pack("<I", checksum) + code
+    return bytes(data)
+
+
+class TestContentHash (unittest.TestCase):
+
+    def setUp(self):
+
+        self.Dir = tempfile.mkdtemp(prefix = "pib_test_")
+
+    def tearDown(self):
+
+        shutil.rmtree(self.Dir, ignore_errors = True)
+
+    def Hash(self, filename, data):
+
+        filename = os.path.join(self.Dir, filename)
+        with open(filename, "wb") as f:
+            f.write(data)
+        return BuildSystem.HashFile(filename)
+
+    def test_obj_timestamp(self):
+
+        self.assertEqual(self.Hash("a.obj", MakeCOFF(100)), self.Hash("b.obj", MakeCOFF(200)))
+        self.assertNotEqual(self.Hash("a.obj", MakeCOFF(100)), self.Hash("b.obj", MakeCOFF(100, b"\x90\xc3")))
+
+    def test_archive_dates(self):
+
+        # Member dates and the timestamps of the objects within are ignored
+        a = MakeArchive([ (b"a.obj/", MakeCOFF(100)), (b"b.obj/", MakeCOFF(100, b"\x90")) ], 100)
+        b = MakeArchive([ (b"a.obj/", MakeCOFF(200)), (b"b.obj/", MakeCOFF(200, b"\x90")) ], 200)
+        c = MakeArchive([ (b"a.obj/", MakeCOFF(200)), (b"b.obj/", MakeCOFF(200, b"\x91")) ], 200)
+        self.assertEqual(self.Hash("a.lib", a), self.Hash("b.lib", b))
+        self.assertNotEqual(self.Hash("a.lib", a), self.Hash("c.lib", c))
+
+    def test_pe_timestamp_and_checksum(self):
+
+        self.assertEqual(self.Hash("a.exe", MakePE(100, 1)), self.Hash("b.exe", MakePE(200, 2)))
+        self.assertNotEqual(self.Hash("a.exe", MakePE(100, 1)), self.Hash("b.exe", MakePE(100, 1, b"\x90")))
+
+
+#
+# Just enough of an environment to ask nodes for their command-lines and outputs
+#
+class Config:
+
+    def __init__(self, cpp_opts):
+
+        self.IntermediatePath = "obj"
+        self.CPPOptions = cpp_opts
+
+class Env:
+
+    def __init__(self, cpp_opts):
+
+        self.CurrentConfig = Config(cpp_opts)
+        self.Distributor = None
+        self.NoToolOutput = False
+
+
+@unittest.skipIf(MSVCPlatform.VCCrossCompile, "Cross-compiles always use /Z7")
+class TestVCCompileNode (unittest.TestCase):
+
+    def test_obj_debugging_info_has_no_pdb(self):
+
+        cpp_opts = MSVCPlatform.VCCompileOptions(MSVCPlatform.VCBaseConfig.DEBUG)
+        cpp_opts.DebuggingInfo = MSVCPlatform.VCDebuggingInfo.OBJ
+        env = Env(cpp_opts)
+        node = MSVCPlatform.VCCompileNode("src/a.cpp", None)
+        self.assertEqual(node.GetOutputFiles(env), [ os.path.join("obj", "src", "a.obj") ])
+        self.assertFalse(any(arg.startswith("/Fd") for arg in node.GetCommandLine(env)))
+
+    def test_pch_users_share_pdb(self):
+
+        # Users of the precompiled header in other directories must write to the PDB it was built with
+        env = Env(MSVCPlatform.VCCompileOptions(MSVCPlatform.VCBaseConfig.DEBUG))
+        pch = MSVCPlatform.VCPCHNode("pch/stdafx.cpp", "stdafx.h", None)
+        node = MSVCPlatform.VCCompileNode("src/a.cpp", None, pch)
+        pdb_file = os.path.join("obj", "pch", "vc100.pdb")
+        self.assertIn(pdb_file, pch.GetOutputFiles(env))
+        self.assertIn(pdb_file, node.GetOutputFiles(env))
+        self.assertIn("/Fd" + pdb_file, node.GetCommandLine(env))
+        self.assertIn(pch, node.Dependencies)
+
+
+class TestParseDepfile (unittest.TestCase):
+
+    # (depfile contents, expected dependencies)
+    Cases = [
+        (b"main.o: main.cpp main.h\n", [ "main.cpp", "main.h" ]),
+        (b"main.o: main.cpp \\\n  main.h \\\n  /usr/include/stdio.h\n", [ "main.cpp", "main.h", "/usr/include/stdio.h" ]),
+        (b"main.o: main.cpp \\\r\n  main.h\r\n", [ "main.cpp", "main.h" ]),
+        (b"main.o: src/my\\ file.cpp my\\ header.h\n", [ "src/my file.cpp", "my header.h" ]),
+        (b"main.o: cost$$.h hash\\#.h\n", [ "cost$.h", "hash#.h" ]),
+        (b"main.o main.d: main.cpp main.h\n", [ "main.cpp", "main.h" ]),
+        (b"main.o: main.cpp main.h\nmain.h:\n\nother.h:\n", [ "main.cpp", "main.h" ]),
+        (b"C:\\obj\\main.o: C:\\src\\main.cpp C:\\src\\main.h\n", [ "C:\\src\\main.cpp", "C:\\src\\main.h" ]),
+        (b"main.o:\n", [ ]),
+        (b"no rule here\n", None),
+    ]
+
+    def test_cases(self):
+
+        with tempfile.TemporaryDirectory(prefix = "pib_test_") as dir:
+            filename = os.path.join(dir, "main.d")
+            for (data, deps) in self.Cases:
+                with self.subTest(data = data):
+                    with open(filename, "wb") as f:
+                        f.write(data)
+                    self.assertEqual(GCCPlatform.ParseDepfile(filename), deps)
+
+    def test_missing_file(self):
+
+        self.assertEqual(GCCPlatform.ParseDepfile(os.path.join(tempfile.gettempdir(), "pib_missing.d")), None)
+
+
+class TestToolchainEnvCache (unittest.TestCase):
+
+    def setUp(self):
+
+        self.Dir = tempfile.mkdtemp(prefix = "pib_test_")
+        self.Cache = MSVCPlatform.ToolchainEnvCache(self.Dir)
+        self.Calls = 0
+
+    def tearDown(self):
+
+        shutil.rmtree(self.Dir, ignore_errors = True)
+
+    def Provider(self):
+
+        # Stands in for running vcvarsall.bat
+        self.Calls += 1
+        return { "PATH": "toolchain" + str(self.Calls) }
+
+    def test_hit_and_miss(self):
+
+        fingerprint = [ "vcvarsall.bat", 100.0, "x64", None ]
+        self.assertEqual(self.Cache.Get(fingerprint, self.Provider), { "PATH": "toolchain1" })
+        self.assertEqual(self.Cache.Get(fingerprint, self.Provider), { "PATH": "toolchain1" })
+
+        # Other processes share the entry
+        cache = MSVCPlatform.ToolchainEnvCache(self.Dir)
+        self.assertEqual(cache.GetAsync(fingerprint, self.Provider)(), { "PATH": "toolchain1" })
+        self.assertEqual(self.Calls, 1)
+
+    def test_invalidation(self):
+
+        # Toolchain updates change the batch file's modification time, other keys select another environment
+        self.Cache.Get([ "vcvarsall.bat", 100.0, "x64", None ], self.Provider)
+        self.assertEqual(self.Cache.Get([ "vcvarsall.bat", 200.0, "x64", None ], self.Provider), { "PATH": "toolchain2" })
+        self.assertEqual(self.Cache.Get([ "vcvarsall.bat", 200.0, "x86", None ], self.Provider), { "PATH": "toolchain3" })
+        self.assertEqual(self.Cache.Get([ "vcvarsall.bat", 200.0, "x86", "2019" ], self.Provider), { "PATH": "toolchain4" })
+        self.assertEqual(self.Calls, 4)
+
+    def test_fingerprint_tracks_toolchain(self):
+
+        vcvars = os.path.join(self.Dir, "vcvarsall.bat")
+        with open(vcvars, "w") as f:
+            f.write("")
+        os.utime(vcvars, (100, 100))
+
+        vcvars_path = MSVCPlatform.VCVarsPath
+        try:
+            MSVCPlatform.VCVarsPath = vcvars
+            fingerprint = MSVCPlatform.GetVisualCEnvFingerprint()
+            os.utime(vcvars, (200, 200))
+            self.assertNotEqual(MSVCPlatform.GetVisualCEnvFingerprint(), fingerprint)
+        finally:
+            MSVCPlatform.VCVarsPath = vcvars_path
+
+    def test_corrupt_entry(self):
+
+        fingerprint = [ "vcvarsall.bat", 100.0, "x64", None ]
+        self.Cache.Get(fingerprint, self.Provider)
+        with open(self.Cache.GetFilename(fingerprint), "w") as f:
+            f.write("{ not json")
+
+        # The entry is fetched again and replaced
+        self.assertEqual(self.Cache.Get(fingerprint, self.Provider), { "PATH": "toolchain2" })
+        self.assertEqual(self.Cache.Get(fingerprint, self.Provider), { "PATH": "toolchain2" })
+        self.assertEqual(self.Calls, 2)
+
+
+class TestMSVCGeneration (unittest.TestCase):
+
+    def test_project_guid_host_independent(self):
+
+        # Windows and POSIX hosts write the same project path differently
+        guid = MSVCGeneration.ProjectGUID("Code/TestProject")
+        self.assertEqual(MSVCGeneration.ProjectGUID("code\\TestProject"), guid)
+        self.assertEqual(MSVCGeneration.ProjectGUID("./Code/Other/../TestProject"), guid)
+        self.assertEqual(MSVCGeneration.ProjectGUID(os.path.abspath("Code/TestProject")), guid)
+        self.assertNotEqual(MSVCGeneration.ProjectGUID("Code/OtherProject"), guid)
+
+
+class TestDistributeWorker (unittest.TestCase):
+
+    def setUp(self):
+
+        # A worker with a single compile slot
+        self.Server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Distribute.WorkerRequestHandler)
+        self.Server.Slots = threading.BoundedSemaphore(1)
+        threading.Thread(target = self.Server.serve_forever, daemon = True).start()
+        self.Distributor = Distribute.Distributor([ "127.0.0.1:" + str(self.Server.server_address[1]) ], 1)
+
+    def tearDown(self):
+
+        self.Server.shutdown()
+        self.Server.server_close()
+
+    def test_failed_compile_releases_slot(self):
+
+        # Each compile fails to launch but must still leave the slot for the next
+        host = self.Distributor.Hosts[0]
+        for i in range(2):
+            with self.assertRaises(Distribute.RequestError) as context:
+                self.Distributor.CompileRemote(host, [ "clang++-0", "-c" ], ".ii", b"int x;")
+            self.assertIn("500", str(context.exception))
+
+    def test_bad_request(self):
+
+        host = self.Distributor.Hosts[0]
+        with self.assertRaises(Distribute.RequestError) as context:
+            self.Distributor.CompileRemote(host, [ "clang++", "-c", "-oout" ], ".ii", b"int x;")
+        self.assertIn("400", str(context.exception))
+
+    def test_compiler_path_rejected(self):
+
+        host = self.Distributor.Hosts[0]
+        for compiler in [ "/tmp/evil/cl", "../../x/gcc", "C:\\evil\\cl.exe" ]:
+            with self.assertRaises(Distribute.RequestError) as context:
+                self.Distributor.CompileRemote(host, [ compiler, "-c" ], ".ii", b"int x;")
+            self.assertIn("400", str(context.exception))
+
+
+class TestPrint (unittest.TestCase):
+
+    def setUp(self):
+
+        self.Stdout = sys.stdout
+        sys.stdout = io.StringIO()
+
+    def tearDown(self):
+
+        Utils.FlushPrint()
+        sys.stdout = self.Stdout
+
+    def test_single_line_flushed(self):
+
+        # A tool that prints a line and goes quiet must still have it shown
+        Utils.FlushPrint()
+        Utils.Print(Env(None), "a single line")
+        time.sleep(Utils._PrintBufferMaxTime * 5)
+        self.assertIn("a single line", sys.stdout.getvalue())
+
+
+class TestLineScanner (unittest.TestCase):
+
+    def Scan(self, parser, line):
+
+        scanner = Utils.LineScanner(Env(None))
+        scanner.AddLineParser("Includes", "Note: including file:", None, parser)
+        scanner.ScanBytes(line)
+        scanner.Finish()
+        return scanner.Includes
+
+    def test_parsers_cached_separately(self):
+
+        # The same line parsed by different parsers must not share results
+        line = b"Note: including file: a.h\n"
+        self.assertEqual(self.Scan(lambda line, length: line[length:].lstrip(), line), set([ "a.h" ]))
+        self.assertEqual(self.Scan(lambda line, length: "inc/" + line[length:].lstrip(), line), set([ "inc/a.h" ]))
+
+        # Parsers with the same code but different captured state are different parsers
+        def MakeParser(dir):
+            return lambda line, length: dir + line[length:].lstrip()
+        self.assertEqual(self.Scan(MakeParser("x/"), line), set([ "x/a.h" ]))
+        self.assertEqual(self.Scan(MakeParser("y/"), line), set([ "y/a.h" ]))
+
+
+#
+# Serves a file with byte ranges, optionally closing each response early
+#
+class DownloadRequestHandler (http.server.BaseHTTPRequestHandler):
+
+    def do_HEAD(self):
+
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(self.server.Data)))
+        self.send_header("Accept-Ranges", "bytes")
+        self.end_headers()
+
+    def do_GET(self):
+
+        (start, end) = (0, len(self.server.Data))
+        range = self.headers.get("Range")
+        if range != None:
+            (first, last) = range[len("bytes="):].split("-")
+            start = int(first)
+            end = int(last) + 1 if last != "" else end
+            self.send_response(206)
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", str(end - start))
+        self.end_headers()
+
+        data = self.server.Data[start:end]
+        if self.server.SendBytes != None:
+            data = data[:self.server.SendBytes]
+        self.wfile.write(data)
+        self.close_connection = True
+
+    def log_message(self, format, *args):
+
+        pass
+
+
+class TestDownload (unittest.TestCase):
+
+    def setUp(self):
+
+        self.Dir = tempfile.mkdtemp(prefix = "pib_test_")
+        self.Server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), DownloadRequestHandler)
+        self.Server.Data = bytes(range(256)) * 400
+        self.Server.SendBytes = None
+        threading.Thread(target = self.Server.serve_forever, daemon = True).start()
+        self.Url = "http://127.0.0.1:" + str(self.Server.server_address[1]) + "/file.bin"
+
+    def tearDown(self):
+
+        self.Server.shutdown()
+        self.Server.server_close()
+        shutil.rmtree(self.Dir, ignore_errors = True)
+
+    def test_truncated_download_not_cached(self):
+
+        self.Server.SendBytes = 5000
+        with self.assertRaises(ValueError):
+            Packages.DownloadFile(self.Url, cache_dir = self.Dir)
+        self.assertEqual([ name for name in os.listdir(self.Dir) if ".part" not in name ], [ ])
+
+    def test_resume_with_different_split(self):
+
+        # Parts from the first attempt don't line up with the second's ranges
+        self.Server.SendBytes = 5000
+        with self.assertRaises(ValueError):
+            Packages.DownloadFile(self.Url, connections = 3, cache_dir = self.Dir)
+
+        self.Server.SendBytes = None
+        filename = Packages.DownloadFile(self.Url, connections = 2, cache_dir = self.Dir)
+        with open(filename, "rb") as f:
+            self.assertEqual(f.read(), self.Server.Data)
+        self.assertEqual(os.listdir(self.Dir), [ os.path.basename(filename) ])
+
+    def test_node_command_line(self):
+
+        # Command-lines are lists of arguments, hashed the same way as any other node's
+        node = Packages.DownloadNode(self.Url, cache_dir = self.Dir)
+        self.assertEqual(node.GetCommandLine(None), [ "download", self.Url, "" ])
+        node = Packages.DownloadNode(self.Url, "abc", cache_dir = self.Dir)
+        self.assertEqual(node.GetCommandLine(None), [ "download", self.Url, "abc" ])
+
+    def test_node_failure(self):
+
+        self.Server.SendBytes = 5000
+        node = Packages.DownloadNode(self.Url, cache_dir = self.Dir)
+        self.assertFalse(node.Build(None))
+
+
+class TestPackageNodes (BuildTestCase):
+
+    def setUp(self):
+
+        super().setUp()
+
+        # Builds share a package store and download cache of their own
+        self.Environ = os.environ.copy()
+        os.environ["PIB_PACKAGE_STORE"] = os.path.join(self.Dir, "store")
+        os.environ["PIB_DOWNLOAD_CACHE"] = os.path.join(self.Dir, "downloads")
+
+        archive = io.BytesIO()
+        with zipfile.ZipFile(archive, "w") as zip:
+            zip.writestr("include/package.h", "#define PACKAGE 1\n")
+        self.Server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), DownloadRequestHandler)
+        self.Server.Data = archive.getvalue()
+        self.Server.SendBytes = None
+        threading.Thread(target = self.Server.serve_forever, daemon = True).start()
+        url = "http://127.0.0.1:" + str(self.Server.server_address[1]) + "/package.zip"
+
+        self.WriteFile("pibfile",
+            "import Packages\n"
+            "package = Packages.ExtractNode(Packages.DownloadNode(\"" + url + "\"), \"external/package\", \"symlink\")\n"
+            "env.Build(package, \"package\")\n")
+
+    def tearDown(self):
+
+        self.Server.shutdown()
+        self.Server.server_close()
+        os.environ.clear()
+        os.environ.update(self.Environ)
+        super().tearDown()
+
+    @unittest.skipIf(sys.platform == "win32", "Symlinks need developer mode on Windows")
+    def test_clean_linked_package(self):
+
+        self.RunPiB()
+        self.assertTrue(os.path.islink(os.path.join(self.Dir, "external/package")))
+
+        # Cleaning removes the view but leaves the stored package intact
+        self.RunPiB("clean")
+        self.assertFalse(os.path.lexists(os.path.join(self.Dir, "external/package")))
+        stored = os.listdir(os.path.join(self.Dir, "store"))
+        self.assertTrue(any(os.path.exists(os.path.join(self.Dir, "store", name, Packages.ExtractManifestName)) for name in stored))
+
+        # The next build links it again, after which the package is up to date
+        self.RunPiB()
+        self.assertTrue(os.path.exists(os.path.join(self.Dir, "external/package/include/package.h")))
+        self.RunPiB("-explain")
+        self.assertEqual(self.ReadExplain(), [ ])
+
+    def test_clean_keeps_download_cache(self):
+
+        self.RunPiB()
+        downloads = os.listdir(os.path.join(self.Dir, "downloads"))
+        self.assertEqual(len(downloads), 1)
+        self.RunPiB("clean")
+        self.assertEqual(os.listdir(os.path.join(self.Dir, "downloads")), downloads)
+
+
+#
+# A node whose build writes the given contents to its output and any other files
+#
+class WriteNode (BuildSystem.Node):
+
+    def __init__(self, input, output, contents, hash_files = None):
+
+        super().__init__()
+        self.Input = input
+        self.Output = output
+        self.Contents = contents
+        self.HashFiles = hash_files
+        self.CommandLine = None
+        self.Builds = 0
+
+    def Build(self, env):
+
+        self.Builds += 1
+        for filename, data in self.Contents.items():
+            with open(filename, "wb" if type(data) == bytes else "w") as f:
+                f.write(data)
+        return True
+
+    def GetInputFile(self, env):
+
+        return self.Input
+
+    def GetOutputFiles(self, env):
+
+        return [ self.Output ]
+
+    def GetContentHashFiles(self, env):
+
+        return self.HashFiles if self.HashFiles != None else [ self.Output ]
+
+    def GetCommandLine(self, env):
+
+        return self.CommandLine
+
+
+class EnvironmentTestCase (unittest.TestCase):
+
+    def setUp(self):
+
+        self.Dir = tempfile.mkdtemp(prefix = "pib_test_")
+        self.CurDir = os.getcwd()
+        os.chdir(self.Dir)
+
+        # File state is cached by path, which each test reuses
+        BuildSystem._ModTimes.clear()
+        BuildSystem._ContentHashes.clear()
+        self.Metadata = BuildSystem.BuildMetadata()
+
+    def tearDown(self):
+
+        os.chdir(self.CurDir)
+        shutil.rmtree(self.Dir, ignore_errors = True)
+
+    def NewEnvironment(self, metadata = None):
+
+        env = Environment.Environment(None, metadata or BuildSystem.BuildMetadata(), GCCPlatform)
+        env.CurrentBuildTarget = "Debug:test"
+        return env
+
+    def WriteFile(self, filename, text):
+
+        with open(filename, "w") as f:
+            f.write(text)
+
+    def TouchFile(self, filename, text):
+
+        # Make sure the new modification time differs from the recorded one
+        self.WriteFile(filename, text)
+        mod_time = os.path.getmtime(filename) + 10
+        os.utime(filename, (mod_time, mod_time))
+        BuildSystem.InvalidateFileState(filename)
+
+    def BuildTarget(self, graphs, target = "test", args = [ ]):
+
+        # Build as a new run would, with the metadata as saved by the previous run
+        BuildSystem._ModTimes.clear()
+        BuildSystem._ContentHashes.clear()
+        self.Metadata = pickle.loads(pickle.dumps(self.Metadata))
+        argv = sys.argv
+        sys.argv = [ "PiB.py" ] + args
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                env = self.NewEnvironment(self.Metadata)
+                env.Build(graphs, target)
+        finally:
+            sys.argv = argv
+        return env
+
+
+class TestOutputInvalidation (EnvironmentTestCase):
+
+    def test_content_hash_file_invalidated(self):
+
+        # Hashed files that aren't declared outputs, like import libraries, must be hashed after the build
+        self.WriteFile("input.txt", "")
+        env = self.NewEnvironment()
+        node = WriteNode("input.txt", "out.dll", { "out.dll": "1", "out.lib": "1" }, [ "out.lib" ])
+        self.assertEqual(env.RunNodeBuild(node, None, None), (True, True))
+        env.BuildMetadata.UpdateModTimes(env.CurrentBuildTarget)
+
+        env = self.NewEnvironment(env.BuildMetadata)
+        BuildSystem.GetContentHash("out.lib")
+        node.Contents = { "out.dll": "2", "out.lib": "2" }
+        self.assertEqual(env.RunNodeBuild(node, None, None), (True, True))
+
+
+class TestEarlyCutoff (EnvironmentTestCase):
+
+    def Build(self, metadata, node):
+
+        env = self.NewEnvironment(metadata)
+        result = env.RunNodeBuild(node, None, None)
+        env.BuildMetadata.UpdateModTimes(env.CurrentBuildTarget)
+        return result
+
+    def test_unchanged_output(self):
+
+        # Rebuilding an object that only differs by its timestamp doesn't change it for dependents
+        metadata = BuildSystem.BuildMetadata()
+        self.WriteFile("a.cpp", "")
+        node = WriteNode("a.cpp", "a.obj", { "a.obj": MakeCOFF(100) })
+        self.assertEqual(self.Build(metadata, node), (True, True))
+        node.Contents = { "a.obj": MakeCOFF(200) }
+        self.assertEqual(self.Build(metadata, node), (True, False))
+        node.Contents = { "a.obj": MakeCOFF(200, b"\x90") }
+        self.assertEqual(self.Build(metadata, node), (True, True))
+        self.assertTrue(metadata.IsOutputFile("a.obj"))
+
+
+class TestFileState (EnvironmentTestCase):
+
+    def test_invalidation(self):
+
+        # State is read once per run until a build step invalidates it
+        self.WriteFile("a.obj", "1")
+        mod_time = BuildSystem.GetModTime("a.obj")
+        content_hash = BuildSystem.GetContentHash("a.obj")
+        self.WriteFile("a.obj", "2")
+        os.utime("a.obj", (mod_time + 10, mod_time + 10))
+        self.assertEqual(BuildSystem.GetModTime("a.obj"), mod_time)
+        self.assertEqual(BuildSystem.GetContentHash("a.obj"), content_hash)
+
+        BuildSystem.InvalidateFileState("a.obj")
+        self.assertEqual(BuildSystem.GetModTime("a.obj"), mod_time + 10)
+        self.assertNotEqual(BuildSystem.GetContentHash("a.obj"), content_hash)
+
+        # Outputs deleted before a build are seen as missing
+        Environment.Environment.DeleteTempOutput([ "a.obj" ])
+        self.assertEqual(BuildSystem.GetModTime("a.obj"), None)
+
+    def test_shared_node_built_once(self):
+
+        # A node shared by two targets in one run is built for the first and recorded for both
+        metadata = self.Metadata
+        self.WriteFile("a.cpp", "")
+        node = WriteNode("a.cpp", "a.obj", { "a.obj": "1" })
+        env = self.NewEnvironment(self.Metadata)
+        with contextlib.redirect_stdout(io.StringIO()):
+            env.Build(node, "first")
+            env.Build(node, "second")
+        self.assertEqual(node.Builds, 1)
+        a_obj = metadata.AddToFileMap("a.obj")
+        self.assertIn(a_obj, metadata.TargetOutputs["Debug:first"])
+        self.assertIn(a_obj, metadata.TargetOutputs["Debug:second"])
+
+
+class TestResolveExecutable (unittest.TestCase):
+
+    def setUp(self):
+
+        self.Dir = tempfile.mkdtemp(prefix = "pib_test_")
+        self.Paths = os.pathsep.join([ os.path.join(self.Dir, "a"), os.path.join(self.Dir, "b") ])
+        os.makedirs(os.path.join(self.Dir, "a"))
+        os.makedirs(os.path.join(self.Dir, "b"))
+
+    def tearDown(self):
+
+        shutil.rmtree(self.Dir, ignore_errors = True)
+
+    def WriteTool(self, dir, name):
+
+        filename = os.path.join(self.Dir, dir, name)
+        with open(filename, "w") as f:
+            f.write("#!/bin/sh\necho " + dir + "\n")
+        os.chmod(filename, 0o755)
+        return filename
+
+    def test_memoised(self):
+
+        # The first directory in the PATH wins and the result is kept once found, or not found
+        tool_b = self.WriteTool("b", "tool")
+        self.assertEqual(Process.ResolveExecutable(self.Paths, "tool"), tool_b)
+        self.WriteTool("a", "tool")
+        self.assertEqual(Process.ResolveExecutable(self.Paths, "tool"), tool_b)
+        self.assertEqual(Process.ResolveExecutable(self.Paths, "missing"), None)
+        self.WriteTool("a", "missing")
+        self.assertEqual(Process.ResolveExecutable(self.Paths, "missing"), None)
+
+    @unittest.skipIf(sys.platform == "win32", "Uses shell scripts as tools")
+    def test_moved_executable(self):
+
+        # A resolved executable that's gone is searched for again when launching it
+        tool_a = self.WriteTool("a", "moved")
+        env = { "PATH": self.Paths }
+        self.assertEqual(Process.ResolveExecutable(self.Paths, "moved"), tool_a)
+        os.remove(tool_a)
+        self.WriteTool("b", "moved")
+        process = Process.OpenPiped([ "moved" ], env)
+        self.assertEqual(process.stdout.read().strip(), b"b")
+        process.wait()
+        process.stdout.close()
+
+
+class TestClean (EnvironmentTestCase):
+
+    def test_recorded_outputs_cleaned(self):
+
+        # Outputs are recorded with the metadata so they're cleaned after leaving the graph
+        self.WriteFile("a.cpp", "")
+        node = WriteNode("a.cpp", "a.obj", { "a.obj": "1", "a.pdb": "1" })
+        node.GetCleanFiles = lambda env: [ "a.obj", "a.pdb" ]
+        self.BuildTarget(node)
+        self.Metadata.Save()
+
+        self.Metadata = BuildSystem.BuildMetadata.Load()
+        self.BuildTarget([ ], args = [ "clean" ])
+        self.assertFalse(os.path.exists("a.obj"))
+        self.assertFalse(os.path.exists("a.pdb"))
+        self.assertTrue(os.path.exists("a.cpp"))
+
+    def test_other_targets_kept(self):
+
+        self.WriteFile("a.cpp", "")
+        self.WriteFile("b.cpp", "")
+        self.BuildTarget(WriteNode("a.cpp", "a.obj", { "a.obj": "1" }), "a")
+        self.BuildTarget(WriteNode("b.cpp", "b.obj", { "b.obj": "1" }), "b")
+        self.BuildTarget([ ], "a", [ "clean" ])
+        self.assertFalse(os.path.exists("a.obj"))
+        self.assertTrue(os.path.exists("b.obj"))
+        self.assertEqual(len(self.Metadata.TargetOutputs["Debug:a"]), 0)
+
+
+#
+# A node with no build step that passes on its dependencies, like a file in a package
+#
+class PassNode (BuildSystem.Node):
+
+    def __init__(self, filename, deps):
+
+        super().__init__()
+        self.Filename = filename
+        self.Dependencies = deps
+
+    def GetInputFile(self, env):
+
+        return self.Filename
+
+    def GetOutputFiles(self, env):
+
+        return [ self.Filename ]
+
+
+class TestAffected (EnvironmentTestCase):
+
+    def setUp(self):
+
+        super().setUp()
+
+        # A package extracted from an archive, a library in it and an executable linking with that
+        self.WriteFile("package.zip", "")
+        self.WriteFile("main.cpp", "")
+        self.Package = WriteNode("package.zip", ".pibextract", { ".pibextract": "", "package.lib": "" })
+        self.Lib = PassNode("package.lib", [ self.Package ])
+        self.Obj = WriteNode("main.cpp", "main.obj", { "main.obj": "" })
+        self.Exe = WriteNode("app.exe", "app.exe", { "app.exe": "" })
+        self.Exe.Dependencies = [ self.Obj, self.Lib ]
+        self.BuildTarget(self.Exe, "app")
+
+    def GetFilenames(self, ids):
+
+        # Files are looked up by several spellings of their path, not all of which are known
+        return set(self.Metadata.GetFilename(id) for id in ids if id in self.Metadata.FileMap)
+
+    def test_reverse_deps(self):
+
+        # Dependencies are followed through nodes with no build step
+        affected = self.Metadata.GetAffectedFiles("Debug:app", [ "package.zip" ])
+        self.assertEqual(self.GetFilenames(affected), set([ "package.zip", "package.lib", "app.exe" ]))
+        affected = self.Metadata.GetAffectedFiles("Debug:app", [ "main.cpp" ])
+        self.assertEqual(self.GetFilenames(affected), set([ "main.cpp", "app.exe" ]))
+
+    def test_report(self):
+
+        argv = sys.argv
+        sys.argv = [ "PiB.py", "-affected", "package.zip" ]
+        try:
+            output = io.StringIO()
+            with contextlib.redirect_stdout(output):
+                Analysis.ReportAffected(self.Metadata)
+        finally:
+            sys.argv = argv
+        self.assertIn("Affected nodes in 'Debug:app':", output.getvalue())
+        self.assertIn("   app.exe\n", output.getvalue())
+        self.assertNotIn("main.cpp", output.getvalue())
+
+    def test_build_affected(self):
+
+        # Only nodes depending on the changed files are evaluated
+        self.TouchFile("package.zip", "1")
+        self.TouchFile("main.cpp", "1")
+        self.BuildTarget(self.Exe, "app", [ "-build_affected", "package.zip" ])
+        self.assertEqual((self.Package.Builds, self.Obj.Builds, self.Exe.Builds), (2, 1, 2))
+
+
+class TestCommandLineOptions (unittest.TestCase):
+
+    class Options (Utils.CommandLineOptions):
+
+        def __init__(self):
+
+            super().__init__()
+            self.Builds = 0
+            self.Level = 1
+            self.Defines = [ ]
+
+        def BuildCommandLine(self):
+
+            self.__dict__["Builds"] += 1
+            return [ "-O" + str(self.Level) ] + [ "-D" + define for define in self.Defines ]
+
+    def test_dirty_tracking(self):
+
+        options = self.Options()
+        options.UpdateCommandLine()
+        options.UpdateCommandLine()
+        self.assertEqual((options.Builds, options.CommandLine), (1, [ "-O1" ]))
+
+        # Assignment and appending to lists both change the command-line
+        options.Level = 2
+        options.UpdateCommandLine()
+        self.assertEqual((options.Builds, options.CommandLine), (2, [ "-O2" ]))
+        options.Defines.append("NDEBUG")
+        options.UpdateCommandLine()
+        self.assertEqual((options.Builds, options.CommandLine), (3, [ "-O2", "-DNDEBUG" ]))
+        options.UpdateCommandLine()
+        self.assertEqual(options.Builds, 3)
+
+
+class TestCommandLineFingerprint (EnvironmentTestCase):
+
+    def test_command_line_change(self):
+
+        self.WriteFile("a.cpp", "")
+        node = WriteNode("a.cpp", "a.obj", { "a.obj": "1" })
+        node.CommandLine = [ "cc", "-O0" ]
+        self.BuildTarget(node)
+        self.BuildTarget(node)
+        self.assertEqual(node.Builds, 1)
+
+        # Only the change of options causes a rebuild
+        node.CommandLine = [ "cc", "-O2" ]
+        self.BuildTarget(node)
+        self.BuildTarget(node)
+        self.assertEqual(node.Builds, 2)
+
+
+class TestAnalysisTargets (unittest.TestCase):
+
+    def GetTargets(self, args):
+
+        metadata = BuildSystem.BuildMetadata()
+        for target in [ "Debug:app", "Release:app", "Release:lib", "Profile:app" ]:
+            metadata.FileMetadata[target] = { }
+        argv = sys.argv
+        sys.argv = [ "PiB.py" ] + args
+        try:
+            return Analysis.GetTargets(metadata)
+        finally:
+            sys.argv = argv
+
+    def test_config_names(self):
+
+        # Configs are parsed as the environment parses them
+        cases = [
+            ([ ], [ "Debug:app" ]),
+            ([ "-config", "release" ], [ "Release:app", "Release:lib" ]),
+            ([ "-config", "debug,release" ], [ "Debug:app", "Release:app", "Release:lib" ]),
+            ([ "-config", "all" ], [ "Debug:app", "Profile:app", "Release:app", "Release:lib" ]),
+            ([ "-config", "all", "-target", "app" ], [ "Debug:app", "Profile:app", "Release:app" ]),
+        ]
+        for args, targets in cases:
+            with self.subTest(args = args):
+                self.assertEqual(self.GetTargets(args), targets)
+
+
+class TestExplain (EnvironmentTestCase):
+
+    def ReadRecords(self, env):
+
+        env.Explain.File.close()
+        with open("pib_explain.jsonl") as f:
+            return [ json.loads(line) for line in f ]
+
+    def test_root_cause(self):
+
+        self.WriteFile("main.cpp", "")
+        obj = WriteNode("main.cpp", "main.obj", { "main.obj": "1" })
+        exe = WriteNode("app.exe", "app.exe", { "app.exe": "" })
+        exe.Dependencies = [ obj ]
+        self.BuildTarget(exe)
+
+        # The executable rebuilds because of its dependency, with the edited source as the root cause
+        obj.Contents = { "main.obj": "2" }
+        self.TouchFile("main.cpp", "int x;")
+        records = self.ReadRecords(self.BuildTarget(exe, args = [ "-explain" ]))
+        self.assertEqual(records, [
+            { "target": "Debug:test", "node": "main.cpp", "reason": "input_changed", "path": "main.cpp", "root_reason": "input_changed", "root": "main.cpp" },
+            { "target": "Debug:test", "node": "app.exe", "reason": "explicit_dependency", "path": "main.cpp", "root_reason": "input_changed", "root": "main.cpp" } ])
+
+    def test_up_to_date(self):
+
+        self.WriteFile("main.cpp", "")
+        obj = WriteNode("main.cpp", "main.obj", { "main.obj": "1" })
+        self.BuildTarget(obj)
+        self.assertEqual(self.ReadRecords(self.BuildTarget(obj, args = [ "-explain" ])), [ ])
+
+
+if __name__ == "__main__":
+    unittest.main()